@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import collections
+
+import sitekicker
+from sitekicker.site import Site
+from sitekicker.util import parse_command_line_options
+
+from .synthetic_site import generate_site
+
+SCENARIOS = ['cold', 'warm', 'one-file-changed']
+
+class timed:
+    """ Hook handler adding its time to timings, copies sent to worker processes with the site time nothing here """
+    def __init__(self, timings, name, handler):
+        self.timings = timings
+        self.name = name
+        self.handler = handler
+        self.__name__ = handler.__name__
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        try:
+            return self.handler(*args)
+        finally:
+            self.timings[self.name] += time.perf_counter() - start
+
+def instrument(site, site_timings, entry_timings):
+    """ Wrap all site and entry hook handlers, to time every phase """
+    for hook, handlers in site.site_hooks.items():
+        site.site_hooks[hook] = [timed(site_timings, hook, h) for h in handlers]
+    for hook, handlers in site.entry_hooks.items():
+        site.entry_hooks[hook] = [timed(entry_timings, hook, h) for h in handlers]
+
+def run_build(site_path, output_path, cli_arguments):
+    site_timings = collections.OrderedDict()
+    entry_timings = collections.OrderedDict()
+    site = Site(parse_command_line_options(cli_arguments + ['-o', output_path, site_path]))
+    for hook in site.site_hooks:
+        site_timings[hook] = 0.0
+    for hook in site.entry_hooks:
+        entry_timings[hook] = 0.0
+    instrument(site, site_timings, entry_timings)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        site.build()
+    total = time.perf_counter() - start
+    site.close_task_pool(terminate=True)
+    return {
+        'total': total,
+        'entries': len(site.entries),
+        'built_entries': len([e for e in site.entries.values() if e.dirty]),
+        'site_hooks': site_timings,
+        'entry_hooks': entry_timings,
+    }
+
+def touch_entry(entry_file):
+    with open(entry_file, 'at', encoding='utf8') as f:
+        f.write('\nOne more line.\n')
+
+def run_scenarios(site_path, entry_files, repeat, cli_arguments):
+    """ Run every scenario repeat times, keep the fastest run of each """
+    results = collections.OrderedDict()
+    for scenario in SCENARIOS:
+        runs = []
+        for i in range(repeat):
+            output_path = os.path.join(site_path, '.dist')
+            if scenario == 'cold':
+                shutil.rmtree(output_path, ignore_errors=True)
+            else:
+                if not os.path.isdir(output_path):
+                    run_build(site_path, output_path, cli_arguments)
+                if scenario == 'one-file-changed':
+                    touch_entry(entry_files[len(entry_files) // 2])
+            runs.append(run_build(site_path, output_path, cli_arguments))
+        results[scenario] = min(runs, key=lambda r: r['total'])
+        print("{:>18}: {:8.3f}s, {} of {} entries built".format(scenario, results[scenario]['total'], results[scenario]['built_entries'], results[scenario]['entries']))
+    return results
+
+def flatten(results):
+    """ scenario/metric -> seconds """
+    metrics = collections.OrderedDict()
+    for scenario, result in results.items():
+        metrics[scenario + '/total'] = result['total']
+        for group in ('site_hooks', 'entry_hooks'):
+            for hook, seconds in result[group].items():
+                metrics['{}/{}/{}'.format(scenario, group, hook)] = seconds
+    return metrics
+
+def compare_with_baseline(results, baseline, threshold, min_seconds):
+    """ Print metrics slower than baseline by more than threshold, return number of regressions """
+    current_metrics = flatten(results)
+    baseline_metrics = flatten(baseline['results'])
+    regressions = 0
+    for name, seconds in current_metrics.items():
+        base_seconds = baseline_metrics.get(name)
+        if base_seconds is None or max(seconds, base_seconds) < min_seconds:
+            continue
+        # a phase not timed in baseline, e.g. entry hooks run by worker processes
+        if not base_seconds:
+            print("not in baseline {}: {:.3f}s".format(name, seconds))
+            continue
+        change = (seconds - base_seconds) / base_seconds
+        if change > threshold:
+            regressions += 1
+            print("REGRESSION {}: {:.3f}s -> {:.3f}s ({:+.0%})".format(name, base_seconds, seconds, change))
+        elif change < -threshold:
+            print("improved {}: {:.3f}s -> {:.3f}s ({:+.0%})".format(name, base_seconds, seconds, change))
+    return regressions
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark site builds on synthetic sites")
+    ap.add_argument('--entries', type=int, default=200, help="Number of entries")
+    ap.add_argument('--images', type=int, default=1, help="Images per entry")
+    ap.add_argument('--depth', type=int, default=2, help="Depth of nested folders with folder.yml")
+    ap.add_argument('--tags', type=int, default=3, help="Tags per entry")
+    ap.add_argument('--inlined-files', type=int, default=1, dest='inlined_files', help="Inlined files per entry")
+    ap.add_argument('--repeat', type=int, default=1, help="Runs of each scenario, the fastest one is reported")
+    ap.add_argument('--no-parallel', action="store_true", default=False, help="Build without worker processes, entry hooks of workers are not timed otherwise")
+    ap.add_argument('--site', default='', help="Use this folder for the synthetic site, default is a temporary folder")
+    ap.add_argument('--output', '-o', default='', help="Save results as JSON to this file")
+    ap.add_argument('--baseline', '-b', default='', help="Compare results with a previously saved JSON file")
+    ap.add_argument('--threshold', type=float, default=0.1, help="Relative slowdown reported as regression, default is 0.1")
+    ap.add_argument('--min-seconds', type=float, default=0.05, dest='min_seconds', help="Ignore metrics faster than this in both runs")
+    args = ap.parse_args()
+
+    site_path = args.site or tempfile.mkdtemp(prefix='sitekicker-benchmark-')
+    shutil.rmtree(site_path, ignore_errors=True)
+    parameters = collections.OrderedDict([
+        ('entries', args.entries),
+        ('images', args.images),
+        ('depth', args.depth),
+        ('tags', args.tags),
+        ('inlined_files', args.inlined_files),
+        ('parallel', not args.no_parallel),
+    ])
+    print("Generating site at {}: {}".format(site_path, dict(parameters)))
+    entry_files = generate_site(site_path, args.entries, args.images, args.depth, args.tags, args.inlined_files)
+    cli_arguments = ['--log-level', 'error'] + (['--no-parallel'] if args.no_parallel else [])
+    try:
+        results = run_scenarios(site_path, entry_files, args.repeat, cli_arguments)
+    finally:
+        if not args.site:
+            shutil.rmtree(site_path, ignore_errors=True)
+    report = collections.OrderedDict([
+        ('sitekicker', sitekicker.__version__),
+        ('python', platform.python_version()),
+        ('machine', platform.machine()),
+        ('cpus', os.cpu_count()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('parameters', parameters),
+        ('results', results),
+    ])
+    if args.output:
+        with open(args.output, 'wt', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+        print("Results saved to {}".format(args.output))
+    if args.baseline:
+        with open(args.baseline, 'rt', encoding='utf8') as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != parameters:
+            print("Baseline parameters differ: {}".format(baseline.get('parameters')))
+        if compare_with_baseline(results, baseline, args.threshold, args.min_seconds):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
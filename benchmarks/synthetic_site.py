@@ -0,0 +1,128 @@
+import os
+import random
+import argparse
+import datetime
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+SITEKICKER_YML = """name: Synthetic Site
+base_url: https://example.org
+output_dir: .dist
+"""
+
+DEFAULT_TEMPLATE = """<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="utf-8">
+    {% block title %}<title>{{ site.user_options['name'] }}</title>{% endblock %}
+    <link rel="stylesheet" href="/assets/main.css">
+  </head>
+  <body>
+    {% block content %}{{ entry_content }}{% endblock %}
+  </body>
+</html>
+"""
+
+POST_TEMPLATE = """{% extends "default.j2" %}
+{% block title %}<title>Post: {{ title }}</title>{% endblock %}
+{% block content %}
+  <h1>{{ title }}</h1>
+  <div>{{ date.strftime('%b %d, %Y') }}</div>
+  {{ entry_content }}
+  {% for t in tags %}<a href="/tags#{{ t }}">{{ t }}</a>{% endfor %}
+{% endblock %}
+"""
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore "
+    "et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip"
+).split()
+
+CODE_SNIPPET = """def fibonacci(n):
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+"""
+
+def paragraph(rng, words=80):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wt', encoding='utf8') as f:
+        f.write(content)
+
+def write_image(path, width, height, rng):
+    color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    im = Image.new('RGB', (width, height), color)
+    # some detail, so the encoder has real work to do
+    for x in range(0, width, 16):
+        im.paste((x % 256, 255 - x % 256, color[2]), (x, 0, min(width, x + 8), height))
+    im.save(path, 'JPEG', quality=90)
+
+def generate_site(path, entries=100, images=1, depth=2, tags=3, inlined_files=1, paragraphs=8, image_width=1600, seed=1):
+    """ Write a synthetic site to path, return the paths of all generated entry files """
+    rng = random.Random(seed)
+    if images and Image is None:
+        print("Pillow is not installed, no images will be generated")
+        images = 0
+    write_file(os.path.join(path, 'sitekicker.yml'), SITEKICKER_YML)
+    write_file(os.path.join(path, 'templates', 'default.j2'), DEFAULT_TEMPLATE)
+    write_file(os.path.join(path, 'templates', 'post.j2'), POST_TEMPLATE)
+    write_file(os.path.join(path, 'assets', 'main.css'), 'body { margin: 0 auto; max-width: 50em; }\n')
+    # nested enclosure folders, each with a folder.yml
+    enclosure = os.path.join(path, 'articles')
+    write_file(os.path.join(enclosure, 'folder.yml'), 'type: post\nlayout: post\n')
+    for level in range(1, depth):
+        enclosure = os.path.join(enclosure, 'level-{}'.format(level))
+        write_file(os.path.join(enclosure, 'folder.yml'), 'tags:\n  - level-{}\n'.format(level))
+    all_tags = ['tag-{}'.format(i) for i in range(max(tags * 4, 1))]
+    start_date = datetime.date(2010, 1, 1)
+    entry_files = []
+    for i in range(entries):
+        entry_id = 'entry-{}'.format(i)
+        entry_dir = os.path.join(enclosure, entry_id)
+        body = []
+        for p in range(paragraphs):
+            body.append(paragraph(rng))
+            if p == 1:
+                for f in range(inlined_files):
+                    name = 'code-{}.py'.format(f)
+                    write_file(os.path.join(entry_dir, name), CODE_SNIPPET)
+                    body.append('```\n[[file: {}]]\n```'.format(name))
+            if p == 2:
+                for m in range(images):
+                    name = 'image-{}.jpg'.format(m)
+                    os.makedirs(entry_dir, exist_ok=True)
+                    write_image(os.path.join(entry_dir, name), image_width, image_width * 2 // 3, rng)
+                    body.append('![Image {}]({})'.format(m, name))
+        front_matter = [
+            '---',
+            'id: {}'.format(entry_id),
+            'title: Synthetic Entry {}'.format(i),
+            'date: {}'.format(start_date + datetime.timedelta(days=i)),
+            'tags:',
+        ] + ['  - {}'.format(t) for t in rng.sample(all_tags, min(tags, len(all_tags)))] + ['---', '']
+        entry_file = os.path.join(entry_dir, 'index.md')
+        write_file(entry_file, '\n'.join(front_matter) + '\n\n'.join(body) + '\n')
+        entry_files.append(entry_file)
+    return entry_files
+
+def main():
+    ap = argparse.ArgumentParser(description="Generate a synthetic site")
+    ap.add_argument('--entries', type=int, default=100, help="Number of entries")
+    ap.add_argument('--images', type=int, default=1, help="Images per entry")
+    ap.add_argument('--depth', type=int, default=2, help="Depth of nested folders with folder.yml")
+    ap.add_argument('--tags', type=int, default=3, help="Tags per entry")
+    ap.add_argument('--inlined-files', type=int, default=1, dest='inlined_files', help="Inlined files per entry")
+    ap.add_argument('--seed', type=int, default=1, help="Random seed")
+    ap.add_argument('path', help="Folder to write the site")
+    args = ap.parse_args()
+    generate_site(args.path, args.entries, args.images, args.depth, args.tags, args.inlined_files, seed=args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,8 @@ import time
 import subprocess
 
 from .site import Site
-from .util import parse_command_line_options
+from .util import parse_command_line_options, LOG_FORMAT, LOG_DATE_FORMAT
+from .site_profiler import BuildProfiler
 
 def main():
     argv_options=parse_command_line_options(sys.argv[1:])
@@ -13,11 +14,13 @@ def main():
     logging_level = getattr(logging, argv_options.log_level.upper(), logging.WARNING)
     logging.basicConfig(
         level=logging_level,
-        format="%(asctime)s::%(levelname)s::%(message)s",
-        datefmt="%H:%M:%S"
+        format=LOG_FORMAT,
+        datefmt=LOG_DATE_FORMAT
     )
     site = Site(argv_options)
     logging.info("%s", site)
+    if argv_options.profile:
+        BuildProfiler(site, argv_options.profile_output, argv_options.profile_memory, argv_options.profile_top).install()
 
     if argv_options.watch:
         site.build()
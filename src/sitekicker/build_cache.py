@@ -0,0 +1,94 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+class BuildCache:
+    """
+    Records of previous builds, stored in a SQLite database in the output dir.
+    Records are read from the database on demand, changes are kept in memory and written in bulk by dump(),
+    worker processes read the database on their own and send their changes back to parent process.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.updates = {}
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+
+    def __str__(self):
+        return "BuildCache: [%s]" % self.path
+
+    def __getstate__(self):
+        # only the location is sent to worker processes, records are read from database there
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def get_connection(self):
+        # connections could not be shared with forked processes
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, value TEXT)")
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    def load(self):
+        """ Forget records of this process, they are read from database again """
+        with self.lock:
+            self.records = {}
+            self.updates = {}
+            try:
+                self.get_connection()
+            except sqlite3.DatabaseError as e:
+                logging.warning("Build cache is broken, start a new one: [%s], %s", self.path, e)
+                self.connection = None
+                os.remove(self.path)
+                self.get_connection()
+
+    def dump(self):
+        """ Write all changes to database in one transaction """
+        with self.lock:
+            updates = self.updates
+            self.updates = {}
+            if not updates:
+                return
+            connection = self.get_connection()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO records (key, value) VALUES (?, ?)",
+                    [(k, json.dumps(v)) for k, v in updates.items()]
+                )
+
+    def pop_updates(self):
+        updates = self.updates
+        self.updates = {}
+        return updates
+
+    def merge(self, updates):
+        self.records.update(updates)
+        self.updates.update(updates)
+
+    def get(self, key, default=None):
+        if key not in self.records:
+            with self.lock:
+                row = self.get_connection().execute("SELECT value FROM records WHERE key = ?", (key,)).fetchone()
+            self.records[key] = json.loads(row[0]) if row else None
+        value = self.records[key]
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.records[key] = value
+        self.updates[key] = value
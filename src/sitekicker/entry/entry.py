@@ -1,18 +1,141 @@
 import os
+import json
 import logging
+import datetime
 import yaml
 
-from ..util import merge_options
+from ..util import merge_options, get_file_signature, get_content_hash, YamlLoader
+
+DATE_FORMAT = '%Y-%m-%d'
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def parse_front_matter(text):
+    """ Split entry file text into front matter options and content """
+    all_lines = text.splitlines(keepends=True)
+    try:
+        first_line_index = all_lines.index("---\n", 0)
+        second_line_index = all_lines.index("---\n", 1)
+        user_options = yaml.load(''.join(all_lines[first_line_index+1:second_line_index]), Loader=YamlLoader) or {}
+        content = ''.join(all_lines[second_line_index+1:])
+    except Exception as e:
+        logging.debug("Entry read exception: %s", e)
+        return {}, ''
+    return user_options, content
+
+def encode_front_matter(value):
+    """ Front matter options to json values, dates are tagged ISO strings, TypeError for values json could not keep """
+    if isinstance(value, dict):
+        if not all(isinstance(k, str) for k in value):
+            raise TypeError("Front matter with non string keys")
+        return dict((k, encode_front_matter(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [encode_front_matter(v) for v in value]
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            raise TypeError("Front matter with time zone")
+        return {'$datetime': value.strftime(DATETIME_FORMAT)}
+    if isinstance(value, datetime.date):
+        return {'$date': value.strftime(DATE_FORMAT)}
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    raise TypeError("Front matter with {} value".format(type(value).__name__))
+
+def decode_front_matter(value):
+    if isinstance(value, dict):
+        if list(value) == ['$datetime']:
+            return datetime.datetime.strptime(value['$datetime'], DATETIME_FORMAT)
+        if list(value) == ['$date']:
+            return datetime.datetime.strptime(value['$date'], DATE_FORMAT).date()
+        return dict((k, decode_front_matter(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [decode_front_matter(v) for v in value]
+    return value
+
+def read_entry_file(site, path):
+    """
+    Read an entry file once, return its front matter options and content.
+    Parsed front matter is indexed in build cache by inode, mtime and size, unchanged files are not parsed again,
+    front matter json could not keep, like tuples or time zones, is parsed every time.
+    """
+    stat = os.stat(path)
+    with open(path, 'rb') as mf:
+        # same as reading in text mode, with universal newlines
+        text = mf.read().decode('utf8').replace('\r\n', '\n').replace('\r', '\n')
+    key = "{}-front-matter".format(path)
+    signature = [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+    record = site.build_cache.get(key)
+    if record and record['signature'] == signature and isinstance(record.get('options'), dict):
+        return decode_front_matter(record['options']), text[record['content_offset']:]
+    user_options, content = parse_front_matter(text)
+    record = {
+        'signature': signature,
+        'content_offset': len(text) - len(content),
+    }
+    if isinstance(user_options, dict):
+        try:
+            record['options'] = encode_front_matter(user_options)
+        except TypeError as e:
+            logging.debug("Front matter of %s is not indexed: %s", path, e)
+    site.build_cache[key] = record
+    return user_options, content
+
+def is_valid_entry_options(user_options):
+    """ Valid entry must have valid front matter, with id and title """
+    return isinstance(user_options, dict) and 'id' in user_options and 'title' in user_options
+
+class EntryRecord:
+    """
+    Metadata of an entry used by listings and templates of other pages, in streaming build.
+    All options of the entry are kept, only its content is dropped, so templates work with both records and entries.
+    """
+    __slots__ = ('id', 'path', 'date', 'title', 'tags', 'link', 'perm_link', 'meta_tags', 'source_hash', 'options')
+
+    def __init__(self, entry):
+        self.update(entry)
+
+    def update(self, entry):
+        self.id = entry.id
+        self.path = entry.path
+        self.date = entry.date
+        self.title = entry.options.get('title')
+        self.tags = list(entry.options.get('tags', []))
+        self.link = entry.link
+        self.perm_link = entry.perm_link
+        self.meta_tags = entry.options.get('meta_tags')
+        self.source_hash = entry.source_hash
+        # front matter and folder options are small, they are kept as they are
+        self.options = entry.options
+
+    def __str__(self):
+        return "EntryRecord(%s): [%s]" % (self.id, self.path)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __eq__(self, other):
+        return self.date == other.date
+
+    def __gt__(self, other):
+        return self.date > other.date
+
+    def __lt__(self, other):
+        return self.date < other.date
 
 class Entry:
     """
     An entry usually a folder with main content file and assets, images etc. It corresponds to a unique url in generated site.
     """
-    def __init__(self, site, path):
+    def __init__(self, site, path, user_options=None, source_content=None):
         self.site = site
         self.path = path
         self.dir = os.path.dirname(path)
-        self.read_entry_content()
+        if user_options is None:
+            self.read_entry_content()
+        else:
+            self.user_options = user_options
+            self.source_content = source_content
+        # content to compile, source content is kept untouched, so the entry could be built again in watch mode
+        self.raw_content = self.source_content
         self.resolve_entry_options()
         self.id = self.user_options.get('id')
         self.date = self.user_options.get('date')
@@ -26,6 +149,18 @@ class Entry:
         self.inlined_files = []
         self.linked_files = []
         self.resolve_output_path()
+        # fingerprint of the entry source, folder options included, used to detect changes between builds
+        self.source_hash = get_content_hash(json.dumps(self.options, sort_keys=True, default=str), self.raw_content)
+        # only dirty entries will be built, see the mark phase
+        self.dirty = True
+        # dirty because of its templates only, compiled html is kept and linked again
+        self.relink = False
+        # metadata seen by other pages in streaming build
+        self.record = None
+        if site.build_options['streaming_build']:
+            # read again when the entry is built
+            self.source_content = None
+            self.raw_content = None
 
     def __str__(self):
         return "Entry(%s): [%s], %d images, %d external images, %d files, %d inlined files." % (self.id, self.path, len(self.linked_images), len(self.external_images), len(self.linked_files), len(self.inlined_files))
@@ -43,17 +178,7 @@ class Entry:
         return self.date < other.date
 
     def read_entry_content(self):
-        with open(self.path, 'rt', encoding='utf8') as mf:
-            all_lines = mf.readlines()
-            try:
-                first_line_index = all_lines.index("---\n", 0)
-                second_line_index = all_lines.index("---\n", 1)
-                self.user_options = yaml.load(''.join(all_lines[first_line_index+1:second_line_index]), Loader=yaml.FullLoader) or {}
-                self.raw_content = ''.join(all_lines[second_line_index+1:])
-            except Exception as e:
-                logging.debug("Entry read exception: %s", e)
-                self.user_options = {}
-                self.raw_content = ''
+        self.user_options, self.source_content = read_entry_file(self.site, self.path)
 
     def resolve_output_path(self):
         user_output_path = self.options.get('output_path', None)
@@ -61,6 +186,7 @@ class Entry:
             self.output_path = os.path.join(self.site.output_path, self.options.get('output_path'))
         else:
             self.output_path = os.path.join(self.site.output_path, *self.options.get('prefix', []), self.id)
+        self.output_file = os.path.join(self.output_path, self.options.get('output_name', 'index.html'))
 
     def resolve_entry_options(self):
         self.options = {}
@@ -69,7 +195,66 @@ class Entry:
         merge_options(self.options, enclosing_folder_options)
         merge_options(self.options, self.user_options)
 
-    def build(self):
+    def get_record(self):
+        """ The record of the entry, kept up to date, the same one is shared by all lists of entries """
+        if self.record is None:
+            self.record = EntryRecord(self)
+        else:
+            self.record.update(self)
+        return self.record
+
+    def release_content(self):
+        """ Drop the content of the entry once it is written, it is compiled again when it is built next time """
+        self.source_content = None
+        self.raw_content = None
+        for name in ('compile_output', 'html_output'):
+            if hasattr(self, name):
+                delattr(self, name)
+
+    def get_template_name(self):
+        return self.options.get('layout', 'default')+'.j2'
+
+    def get_dependencies(self):
+        """ Local files used to build the entry: inlined files, linked files and images """
+        dependencies = list(self.inlined_files)
+        for fi in self.linked_files + self.linked_images:
+            if not fi.is_external:
+                dependencies.append(fi.fullpath)
+        return dependencies
+
+    def fingerprint(self, dependencies):
+        """ Fingerprint of all the inputs of the entry, it changes when any of the inputs changes """
+        parts = [self.source_hash]
+        template = self.site.template_registry.get(self.get_template_name())
+        template_dependencies = template.dependencies if template else []
+        for path in list(template_dependencies) + list(dependencies):
+            parts.append(path)
+            parts.append(get_file_signature(path))
+        return get_content_hash(*parts)
+
+    def __getstate__(self):
+        # the site is not picklable, entries built in worker processes are sent back without it
+        state = dict(self.__dict__)
+        state.pop('site', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.site = None
+
+    def adopt_build_state(self, other):
+        """ Take over the state of the same entry, built in another process """
+        for key, value in other.__dict__.items():
+            # the record is shared by lists of entries in this process
+            if key not in ('site', 'record'):
+                setattr(self, key, value)
+        for fi in self.linked_files + self.linked_images:
+            fi.entry = self
+
+    def build(self, hook_names=None):
+        """ Run entry hooks, all of them by default, or only the ones in hook_names """
         for name, hooks in self.site.entry_hooks.items():
+            if hook_names is not None and name not in hook_names:
+                continue
             for hook in hooks:
                 hook(self)
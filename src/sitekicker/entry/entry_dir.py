@@ -1,4 +1,3 @@
-import shutil
 import os
 import logging
 
@@ -12,8 +11,9 @@ class EntryDir:
 
     def copy(self):
         dest = os.path.join(
-            self.entry.output_dir,
+            self.entry.output_path,
             os.path.basename(self.src)
         )
         logging.debug("Copy %s to %s" % (self.src, dest))
-        shutil.copytree(self.src, dest)
+        # only changed files are copied, an existing target is updated in place
+        self.entry.site.file_sync.sync_tree(self.src, dest)
@@ -1,6 +1,5 @@
 import os
 import logging
-import shutil
 
 class EntryFile:
     """ Represents a binary file inside an entry """
@@ -27,8 +26,6 @@ class EntryFile:
     def copy(self):
         if not self.file_exists:
             return
-        dest_dir = os.path.dirname(self.dest_fullpath)
         logging.debug("Copy entry file from %s to %s" % (self.fullpath, self.dest_fullpath))
-        if not os.path.isdir(dest_dir):
-            os.makedirs(dest_dir)
-        shutil.copyfile(self.fullpath, self.dest_fullpath)
+        # unchanged files are skipped, the copy runs in thread pool
+        self.entry.site.file_sync.submit(self.fullpath, self.dest_fullpath)
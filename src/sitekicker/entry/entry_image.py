@@ -4,24 +4,132 @@ import re
 import subprocess
 import shlex
 import shutil
-from ..util import get_image_size
+import functools
 from .entry_file import EntryFile
 
-def compress_resize_image(src, dest, target_width, quality=80, caches=None, full_build=False):
-    options_cache_key = "{}-options".format(src)
+try:
+    from PIL import Image, ImageFilter
+except ImportError:
+    Image = None
+
+# formats pillow may open as animated, multi frame MPO photos are not animated
+ANIMATED_FORMATS = ('GIF', 'WEBP', 'PNG')
+
+# images shared by entries, in output dir, named by their content hash
+SHARED_IMAGE_DIR = '_img'
+
+def is_image_cached(src, dest, target_width, quality, caches, shared=False):
+    options_cache_key = "{}-options".format(dest)
     options_cache_value = "{},{}".format(target_width, quality)
-    cache_hit = (
-        src in caches and
-        os.path.getmtime(src) == caches[src] and
+    return (
+        # shared images are named by the content hash of src, they are valid for any copy of it
+        (shared or src in caches and os.path.getmtime(src) == caches[src]) and
         dest in caches and
         os.path.isfile(dest) and
         os.path.getmtime(dest) == caches[dest] and
         options_cache_key in caches and
         options_cache_value == caches[options_cache_key]
     )
-    if caches is not None and not full_build and cache_hit:
-        logging.debug("Cache hit for {}!".format(src))
-        return
+
+def cache_image(src, dest, target_width, quality, caches):
+    caches[src] = os.path.getmtime(src)
+    caches[dest] = os.path.getmtime(dest)
+    caches["{}-options".format(dest)] = "{},{}".format(target_width, quality)
+
+def compress_resize_image(src, dest, target_width, quality=80, caches=None, full_build=False, engine='pillow'):
+    process_image(src, [(dest, target_width, quality)], caches, full_build, engine)
+
+def process_image(src, derivatives, caches=None, full_build=False, engine='pillow', shared=False):
+    """ Generate all derivatives of an image, each derivative is a (dest, target_width, quality) tuple, return the written dests """
+    pending = []
+    seen = set()
+    for dest, target_width, quality in derivatives:
+        if dest in seen:
+            continue
+        seen.add(dest)
+        if caches is not None and not full_build and is_image_cached(src, dest, target_width, quality, caches, shared):
+            logging.debug("Cache hit for {}!".format(dest))
+            continue
+        pending.append((dest, int(target_width), quality))
+    if not pending:
+        return []
+    engine = get_image_engine(engine)
+    if engine == 'pillow':
+        pillow_resize_images(src, pending)
+    elif engine == 'mogrify':
+        for dest, target_width, quality in pending:
+            mogrify_resize_image(src, dest, target_width, quality)
+    else:
+        for dest, target_width, quality in pending:
+            shutil.copyfile(src, dest)
+    if caches is not None:
+        for dest, target_width, quality in pending:
+            cache_image(src, dest, target_width, quality, caches)
+    return [d[0] for d in pending]
+
+@functools.lru_cache()
+def get_image_engine(engine):
+    """ The engine to use, pillow falls back to mogrify, None when none is installed, warned once in a process """
+    if engine == 'pillow' and Image is None:
+        logging.warning("Pillow is not installed(pip install sitekicker[images]), fall back to mogrify to process images")
+        engine = 'mogrify'
+    if engine == 'mogrify' and shutil.which('mogrify') is None:
+        logging.warning("Neither Pillow nor ImageMagick mogrify is installed, images are copied without resizing")
+        return None
+    return engine
+
+def process_image_task(src, derivatives, caches, full_build=False, engine='pillow', shared=False):
+    """ Runs in task pool, cache changes and written dests are sent back to parent process """
+    written = process_image(src, derivatives, caches, full_build, engine, shared)
+    return caches.pop_updates(), written
+
+def merge_processed_images(site, result):
+    """ Callback of process_image_task, in parent process """
+    cache_updates, written = result
+    site.build_cache.merge(cache_updates)
+    for dest in written:
+        site.file_sync.add_changed_file(dest)
+
+def pillow_resize_images(src, derivatives):
+    """ Decode the image once, then resize, sharpen and compress it to all derivatives """
+    with Image.open(src) as im:
+        if im.format in ANIMATED_FORMATS and getattr(im, 'is_animated', False):
+            # resizing would drop all frames but the first one, keep animated images untouched
+            for dest, target_width, quality in derivatives:
+                logging.debug("Copy animated image from %s to %s" % (src, dest))
+                shutil.copyfile(src, dest)
+            return
+        # MPO photos of phones are saved as their first frame, a JPEG
+        image_format = 'JPEG' if im.format == 'MPO' else im.format
+        im.load()
+        pillow_save_derivatives(src, im, image_format, derivatives)
+
+def pillow_save_derivatives(src, im, image_format, derivatives):
+    """ Resize, sharpen and compress a decoded image to all derivatives """
+    if im.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        im = im.convert('RGBA' if 'transparency' in im.info or im.mode in ('P', 'PA') else 'RGB')
+    if image_format == 'JPEG' and im.mode != 'RGB' and im.mode != 'L':
+        im = im.convert('RGB')
+    for dest, target_width, quality in derivatives:
+        logging.debug("Pillow Resize and Compress image from {} to {}, target_width: {}px, qulity: {}%".format(src, dest, target_width, quality))
+        resized = im
+        # shrink only, same as '{WIDTH}x10000>' geometry of ImageMagick
+        if im.width > target_width:
+            target_height = max(1, round(im.height * target_width / im.width))
+            resized = im.resize((target_width, target_height), Image.BILINEAR)
+        # same sharpen as '-unsharp 0.25x0.08+8.3+0.045' of mogrify, pillow radius is the sigma
+        resized = resized.filter(ImageFilter.UnsharpMask(radius=0.08, percent=830, threshold=11))
+        # metadata(exif, icc profile, comments) is stripped, pillow only saves what is passed explicitly
+        if image_format == 'PNG':
+            resized.save(dest, 'PNG', optimize=True, compress_level=9)
+        elif image_format == 'GIF':
+            resized.convert('P', palette=Image.ADAPTIVE).save(dest, 'GIF', optimize=True)
+        elif image_format == 'WEBP':
+            resized.save(dest, 'WEBP', quality=quality)
+        else:
+            resized.save(dest, image_format or 'JPEG', quality=quality, optimize=True, progressive=False)
+
+def mogrify_resize_image(src, dest, target_width, quality):
     logging.debug("IM Resize and Compress image from {} to {}, target_width: {}px, qulity: {}%".format(src, dest, target_width, quality))
     COMPRESS_CMD = "mogrify -write {OUTPUT_PATH} -thumbnail '{OUTPUT_WIDTH}x10000>' -filter Triangle -define filter:support=2 -unsharp 0.25x0.08+8.3+0.045 -dither None -posterize 136 -quality {QUALITY} -define jpeg:fancy-upsampling=off -define png:compression-filter=5 -define png:compression-level=9 -define png:compression-strategy=1 -define png:exclude-chunk=all -interlace none -colorspace sRGB {INPUT_PATH}"
     logging.debug("Copy and compress entry image from %s to %s" % (src, dest))
@@ -32,15 +140,11 @@ def compress_resize_image(src, dest, target_width, quality=80, caches=None, full
         INPUT_PATH=shlex.quote(src)),
         shell=True
     )
-    if caches is not None:
-        caches[src] = os.path.getmtime(src)
-        caches[dest] = os.path.getmtime(dest)
-        caches[options_cache_key] = options_cache_value
 
 class EntryImage(EntryFile):
     def __init__(self, entry, title, name):
         super().__init__(entry, title, name)
-        self.real_width, self.real_height = get_image_size(self.fullpath) if not self.is_external else 0, 0
+        self.real_width, self.real_height = entry.site.image_index.get_size(self.fullpath) if not self.is_external else (0, 0)
         matches = re.match(r'(.+)\.([^\.]+)', self.name)
         self.name_no_ext = matches.group(1) if matches else ''
         self.ext = matches.group(2) if matches else ''
@@ -53,71 +157,106 @@ class EntryImage(EntryFile):
     def __str__(self):
         return "Entry image: %s" % self.fullpath
 
+    def is_shared(self):
+        """ With dedupe_images, local images are stored once under /_img/<content hash>/, for all entries using them """
+        return not self.is_external and self.entry.site.build_options['dedupe_images']
+
+    def get_shared_name(self, width=None):
+        name = 'image' if width is None else str(width) + 'px'
+        return '/'.join([SHARED_IMAGE_DIR, self.entry.site.image_index.get_hash(self.fullpath), name + '.' + self.ext])
+
+    def get_output_path(self, shared=None):
+        if self.is_shared() if shared is None else shared:
+            return os.path.join(self.entry.site.output_path, *self.get_shared_name().split('/'))
+        return self.dest_fullpath
+
+    def get_output_paths(self, shared=None):
+        """ Files the image is written to, as a shared image or next to the entry, by responsive_process or copy """
+        if self.entry.site.build_options['responsive_images']:
+            return sorted(set(self.get_derivative_path(width, shared) for width in self.get_derivative_widths()))
+        return [self.get_output_path(shared)]
+
+    def get_link(self):
+        """ Link of the shared image """
+        return '/' + self.get_shared_name()
+
     def copy(self):
-        logging.debug("Copy entry image from %s to %s" % (self.fullpath, self.dest_fullpath))
-        dest_dir = os.path.dirname(self.dest_fullpath)
-        if not os.path.isdir(dest_dir):
-            os.makedirs(dest_dir)
+        dest = self.get_output_path()
+        logging.debug("Copy entry image from %s to %s" % (self.fullpath, dest))
         if self.entry.site.build_options['compress_image']:
-            task_arguments = (
-                self.fullpath,
-                self.dest_fullpath,
+            # page writes in thread pool may create the same dir
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            self.submit_process_task([(
+                dest,
                 self.entry.site.build_options['maximum_image_width'],
                 self.entry.site.build_options['compress_image_quality'],
-                self.entry.site.snapshots,
-                self.entry.site.cli_options.full_build
-            )
-            if not self.entry.site.cli_options.no_parallel:
-                self.entry.site.task_pool.apply_async(compress_resize_image, task_arguments)
-            else:
-                compress_resize_image(*task_arguments)
-        else:
-            shutil.copy(self.fullpath, self.dest_fullpath)
+            )])
+        elif self.claim_shared_paths([dest]):
+            self.entry.site.file_sync.submit(self.fullpath, dest)
+
+    def get_derivative_path(self, width, shared=None):
+        if self.is_shared() if shared is None else shared:
+            return os.path.join(self.entry.site.output_path, *self.get_shared_name(width).split('/'))
+        save_name = self.name_no_ext + '-' + str(width) + 'px.' + self.ext
+        return os.path.join(os.path.dirname(self.dest_fullpath), save_name)
+
+    def get_derivative_link(self, src, width):
+        """ Link of a derivative in entry html, next to src, or under /_img/ for shared images """
+        if self.is_shared():
+            return '/' + self.get_shared_name(width)
+        src_parts = src.rsplit(sep='.', maxsplit=1)
+        return src_parts[0] + '-' + str(width) + 'px' + '.' + src_parts[1]
+
+    def claim_shared_paths(self, paths):
+        """ Paths of shared images not generated by other entries in this build, they are generated by this entry """
+        if not self.is_shared():
+            return paths
+        generated = self.entry.site.shared_images
+        paths = [p for p in paths if p not in generated]
+        generated.update(paths)
+        return paths
+
+    def get_derivative_widths(self):
+        """ Widths of responsive derivatives, images are never enlarged, the last one is the placeholder """
+        widths = [min(self.real_width, width) for width in self.entry.site.build_options['responsive_image_sizes']]
+        widths.append(self.entry.site.build_options['image_placeholder_size'])
+        return widths
 
     def responsive_process(self):
-        # generate process task array
-        target_widths = self.entry.site.build_options['responsive_image_sizes']
-        task_array=[]
-        for tw in target_widths:
-            if self.real_width<tw:
-                save_name=self.name_no_ext + '-' + str(self.real_width) + 'px.' + self.ext
-                new_dest_fullpath = os.path.join(os.path.dirname(self.dest_fullpath), save_name)
-                logging.debug("Resize(save-no-resize) %s to %s", self.fullpath, new_dest_fullpath)
-                arg=(
-                    self.fullpath,
-                    new_dest_fullpath,
-                    self.real_width,
-                    self.entry.site.build_options['compress_image_quality'],
-                    self.entry.site.snapshots,
-                    self.entry.site.cli_options.full_build
-                )
-            else:
-                ratio = self.real_height/self.real_width
-                new_height = int(ratio * tw)
-                save_name = self.name_no_ext + '-' + str(tw) + 'px.' + self.ext
-                new_dest_fullpath = os.path.join(os.path.dirname(self.dest_fullpath), save_name)
-                logging.debug("Resize %s to new size: %ix%i, saved to %s", self.fullpath, tw, new_height, new_dest_fullpath)
-                arg=(
-                    self.fullpath,
-                    new_dest_fullpath,
-                    tw,
-                    self.entry.site.build_options['compress_image_quality'],
-                    self.entry.site.snapshots,
-                    self.entry.site.cli_options.full_build
-                )
-            task_array.append(arg)
-        # add placeholder image generation task
-        task_array.append((
-            self.fullpath,
-            self.entry.dest_fullpath,
-            self.entry.site.build_options['image_placeholder_size'],
-            self.entry.site.build_options['image_placeholder_quality'],
-            self.entry.site.snapshots,
-            self.entry.site.cli_options.full_build
+        dest_dir = os.path.dirname(self.get_derivative_path(self.real_width))
+        # page writes in thread pool may create the same dir
+        os.makedirs(dest_dir, exist_ok=True)
+        # all derivatives of the image are generated by one task, the image is decoded only once
+        widths = self.get_derivative_widths()
+        derivatives = []
+        for width in widths[:-1]:
+            logging.debug("Resize %s to new width: %i, saved to %s", self.fullpath, width, self.get_derivative_path(width))
+            derivatives.append((self.get_derivative_path(width), width, self.entry.site.build_options['compress_image_quality']))
+        # placeholder image
+        derivatives.append((
+            self.get_derivative_path(widths[-1]),
+            widths[-1],
+            self.entry.site.build_options['image_placeholder_quality']
         ))
-        # parallel or serial
+        self.submit_process_task(derivatives)
+
+    def submit_process_task(self, derivatives):
+        """ Process image in the site task pool, or right away if parallel processing is disabled """
+        claimed = self.claim_shared_paths([d[0] for d in derivatives])
+        derivatives = [d for d in derivatives if d[0] in claimed]
+        if not derivatives:
+            return
+        task_arguments = (
+            self.fullpath,
+            derivatives,
+            self.entry.site.build_cache,
+            self.entry.site.cli_options.full_build,
+            self.entry.site.build_options['image_engine'],
+            self.is_shared()
+        )
         if not self.entry.site.cli_options.no_parallel:
-            self.entry.site.task_pool.starmap_async(compress_resize_image, task_array)
+            callback = functools.partial(merge_processed_images, self.entry.site)
+            self.entry.site.task_pool.apply_async(process_image_task, task_arguments, callback=callback)
         else:
-            for task in task_array:
-                compress_resize_image(*task)
+            for dest in process_image(*task_arguments):
+                self.entry.site.file_sync.add_changed_file(dest)
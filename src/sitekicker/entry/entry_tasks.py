@@ -3,27 +3,27 @@ import markdown
 import logging
 import shutil
 from datetime import date
-from bs4 import BeautifulSoup
 import re
 import yaml
 import html
+from html.parser import HTMLParser
 import jinja2
+import pymdownx
 
 import sitekicker
 
 from .entry_dir import EntryDir
 from .entry_file import EntryFile
 from .entry_image import EntryImage
-from ..util import get_image_size
+from ..util import get_content_hash
+from ..site_search import collect_search_terms, stream_search_terms
 
 def register_entry_tasks(site):
     site.register_entry('pre-compile', resolve_inlined_files)
     site.register_entry('compile', compile_markdown)
-    site.register_entry('post-compile', resolve_linked_file)
-    site.register_entry('post-compile', resolve_all_images)
-    if site.build_options['responsive_images']:
-        site.register_entry('post-compile', process_responsive_images_tags)
-    site.register_entry('post-compile', setup_meta_tags)
+    site.register_entry('post-compile', process_compiled_html)
+    if site.build_options['search_index']:
+        site.register_entry('post-compile', collect_search_terms)
     site.register_entry('link', link_entry)
     site.register_entry('post-link', write_entry_output)
     site.register_entry('post-link', copy_entry_files)
@@ -32,10 +32,19 @@ def register_entry_tasks(site):
     else:
         site.register_entry('post-link', copy_entry_images)
     site.register_entry('post-link', summary)
+    if site.build_options['streaming_build']:
+        if site.build_options['search_index']:
+            site.register_entry('post-link', stream_search_terms)
+        site.register_entry('post-link', release_entry_content)
 
 def summary(entry):
     print(entry)
 
+def release_entry_content(entry):
+    """ Streaming build, only the record of a written entry is kept """
+    entry.get_record()
+    entry.release_content()
+
 def copy_entry_images(entry):
     for img in entry.linked_images:
         if not img.is_external:
@@ -53,6 +62,9 @@ def process_responsive_entry_images(entry):
 def resolve_inlined_files(entry):
     """ Inlined files must be read and insert to its anchor point, before compilation """
     entry.inlined_files = []
+    if entry.source_content is None:
+        # dropped after scanning in streaming build
+        entry.read_entry_content()
     def read_file(match):
         name = match.group(1)
         fullpath = os.path.join(entry.dir, name)
@@ -60,103 +72,220 @@ def resolve_inlined_files(entry):
         logging.debug("Find inlined file: [%s]", fullpath)
         with open(fullpath, 'rt', encoding="utf8") as f:
             return f.read()
-    raw_content = entry.raw_content
     # read and insert file content for [[file: filename]] tags before build
-    entry.raw_content = re.sub(r'\[\[file: ([^]]+)\]\]', read_file, raw_content)
+    entry.raw_content = re.sub(r'\[\[file: ([^]]+)\]\]', read_file, entry.source_content)
+
+MARKDOWN_EXTENSIONS = [
+    'markdown.extensions.extra',
+    'pymdownx.tilde',
+    'pymdownx.magiclink',
+    'pymdownx.arithmatex',
+]
+MARKDOWN_OUTPUT_FORMAT = "html5"
+
+# markdown engine of current process, extensions are initialized once and engine is reset between entries
+markdown_engine = None
+
+def get_markdown_engine():
+    global markdown_engine
+    if markdown_engine is None:
+        markdown_engine = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS, output_format=MARKDOWN_OUTPUT_FORMAT)
+    return markdown_engine
+
+def get_markdown_cache_path(entry):
+    """ Compiled html is cached by the hash of markdown content and the compiler config """
+    content_hash = get_content_hash(
+        markdown.__version__,
+        pymdownx.__version__,
+        MARKDOWN_OUTPUT_FORMAT,
+        ','.join(MARKDOWN_EXTENSIONS),
+        entry.raw_content
+    )
+    return os.path.join(get_markdown_cache_dir(entry.site), content_hash[:2], content_hash + '.html')
+
+def get_markdown_cache_dir(site):
+    return os.path.join(site.output_path, '.markdowncache')
 
 def compile_markdown(entry):
     """ Build the main content of the entry, which is written in markdown at the moment """
-    md_out = markdown.markdown(
-        entry.raw_content,
-        extensions=[
-            'markdown.extensions.extra',
-            'pymdownx.tilde',
-            'pymdownx.magiclink',
-            'pymdownx.arithmatex',
-        ],
-        output_format="html5"
-    )
-    entry.compile_output = md_out
-
-def setup_meta_tags(entry):
-    entry.options['meta_tags'] = set()
-    # Detect MathJax usage
-    if re.search(r'\\\(.*\\\)|\\\[.*\\\]', entry.compile_output):
-        entry.options['meta_tags'].add('math')
-    # Detect Images
-    if entry.external_images or entry.linked_images:
-        entry.options['meta_tags'].add('image')
-        if re.search(r'srcset', entry.compile_output):
-            entry.options['meta_tags'].add('responsive-image')
-        if re.search(r'lazyload', entry.compile_output):
-            entry.options['meta_tags'].add('lazyload-image')
-    # Detect Code Blocks
-    if re.search(r'\<code[^>]*>', entry.compile_output) or re.search(r'\<pre[^>]*>', entry.compile_output):
-        entry.options['meta_tags'].add('code')
-
-def resolve_linked_file(entry):
-    """ Find out all files linked with <a> """
-    entry.linked_files = []
-    def tap_link(link_match):
-        link_text = link_match.group(0)
-        link = BeautifulSoup(link_text, 'html.parser').a
-        attrs = link.attrs
-        href = attrs.get('href')
-        title = link.string
-        if href.startswith('http://') or href.startswith('https://') or href.startswith('//'):
-            pass
-        else:
-            entry.linked_files.append(EntryFile(entry, title, href))
-    re.sub(r'\<a\s+[^>]*\s*\>([^<]+)</a>', tap_link, entry.compile_output)
+    cache_path = get_markdown_cache_path(entry)
+    # cached html of content no entry has any more is removed after the build
+    entry.site.build_cache["{}-markdown-cache".format(entry.path)] = os.path.basename(cache_path)
+    if not entry.site.cli_options.full_build and os.path.isfile(cache_path):
+        logging.debug("Markdown cache hit for %s", entry.path)
+        with open(cache_path, 'rt', encoding='utf8') as cf:
+            entry.compile_output = cf.read()
+        return
+    entry.compile_output = get_markdown_engine().reset().convert(entry.raw_content)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # write to a temporary file first, the cache may be read by other processes
+    temp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+    with open(temp_path, 'wt', encoding='utf8') as cf:
+        cf.write(entry.compile_output)
+    os.replace(temp_path, cache_path)
+
+def prune_markdown_cache(site):
+    """ Site hook, remove cached html no entry uses, every change of an entry adds one """
+    cache_dir = get_markdown_cache_dir(site)
+    if not os.path.isdir(cache_dir):
+        return
+    used = set(site.build_cache.get("{}-markdown-cache".format(entry.path)) for entry in site.entries.values())
+    removed = 0
+    for sub_dir in os.scandir(cache_dir):
+        if not sub_dir.is_dir():
+            continue
+        for item in os.scandir(sub_dir.path):
+            if item.name not in used:
+                os.remove(item.path)
+                removed += 1
+    logging.debug("%d unused compiled html removed from %s", removed, cache_dir)
+
+# inline and block math markers, found in text content of compiled html
+MATH_PATTERN = re.compile(r'\\\(.*\\\)|\\\[.*\\\]', re.DOTALL)
+
+def is_external_link(link):
+    return link.startswith('http://') or link.startswith('https://') or link.startswith('//')
 
-def resolve_all_images(entry):
-    """ Find out all images used by <image/> tag """
+class CompiledHtmlParser(HTMLParser):
+    """
+    Walk compiled html once: collect links(with text of nested tags), images and meta tags,
+    <img> tags are replaced by the result of process_img, the rest of html is kept as is
+    """
+    def __init__(self, source, process_img):
+        super().__init__(convert_charrefs=True)
+        self.source = source
+        self.process_img = process_img
+        # getpos() only counts '\n' as line break, str.splitlines() also breaks at form feeds and others
+        self.line_offsets = [0]
+        for line in source.split('\n'):
+            self.line_offsets.append(self.line_offsets[-1] + len(line) + 1)
+        self.links = []
+        self.link_stack = []
+        self.meta_tags = set()
+        self.replacements = []
+        self.text = []
+
+    def get_offset(self):
+        line, column = self.getpos()
+        return self.line_offsets[line - 1] + column
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: value or '' for name, value in attrs}
+        if 'class' in attrs:
+            attrs['class'] = attrs['class'].split()
+        if tag == 'a':
+            self.link_stack.append((attrs.get('href'), []))
+        elif tag == 'img':
+            start = self.get_offset()
+            tag_text = self.get_starttag_text()
+            replacement = self.process_img(tag_text, attrs)
+            if replacement != tag_text:
+                self.replacements.append((start, start + len(tag_text), replacement))
+        elif tag in ('code', 'pre'):
+            self.meta_tags.add('code')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag != 'a':
+            self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self.link_stack:
+            href, text = self.link_stack.pop()
+            self.links.append((href, ''.join(text)))
+
+    def handle_data(self, data):
+        for _, text in self.link_stack:
+            text.append(data)
+        self.text.append(data)
+
+    def close(self):
+        super().close()
+        if MATH_PATTERN.search(''.join(self.text)):
+            self.meta_tags.add('math')
+
+    def get_output(self):
+        parts = []
+        position = 0
+        for start, end, replacement in self.replacements:
+            parts.append(self.source[position:start])
+            parts.append(replacement)
+            position = end
+        parts.append(self.source[position:])
+        return ''.join(parts)
+
+def process_compiled_html(entry):
+    """
+    Walk compiled html once: find linked files and images, rewrite <img> tags for responsive images,
+    and setup meta tags(math, image, code) of the entry
+    """
+    entry.linked_files = []
     entry.external_images = []
     entry.linked_images = []
-    def sub_img(image_match):
-        img_text = image_match.group(0)
-        img = BeautifulSoup(img_text, 'html.parser').img
-        attrs = img.attrs
-        title = attrs.get('alt') or ''
-        name = attrs.get('src') or attrs.get('data-src')
-        if name.startswith('http://') or name.startswith('https://') or name.startswith('//'):
-            entry.external_images.append(name)
-        else:
-            entry.linked_images.append(EntryImage(entry, title, name))
-    re.sub(r'\<img\s+[^>]*\s*\>', sub_img, entry.compile_output)
-
-def process_responsive_images_tags(entry):
-    # Substitute <img> tag for lazy-responsive-load
-    def sub_img(image_match):
-        img_text = image_match.group(0)
-        img = BeautifulSoup(img_text, 'html.parser').img
-        attrs = img.attrs
+    responsive_images = entry.site.build_options['responsive_images']
+    def process_img(img_text, attrs):
         src = attrs.get('src') or attrs.get('data-src')
-        alt = html.escape(attrs.get('alt') or src)
-        classes = attrs.get('class') or []
-        if src.startswith('http://') or src.startswith('https://') or src.startswith('//'):
-            sub = '<img data-src="' + src + '" class="lazyload" />'
+        if not src:
+            return img_text
+        if is_external_link(src):
+            entry.external_images.append(src)
+            img = None
         else:
-            alt = attrs.get('alt', '')
-            src_parts = src.rsplit(sep='.', maxsplit=1)
-            src_width, src_height = get_image_size(os.path.join(entry.dir, src))
-            srcsets = []
-            for width in entry.site.build_options['responsive_image_sizes']:
-                if src_width<width:
-                    srcsets.append(src_parts[0] + '-'+ str(src_width) +'px' + '.' + src_parts[1] + ' ' + str(src_width) + 'w')
-                    break
-                else:
-                    srcsets.append(src_parts[0] + '-'+ str(width) +'px' + '.' + src_parts[1] + ' ' + str(width) + 'w')
-            srcset_text = ','.join(srcsets)
-            default_src = src_parts[0] + '-'+ str(entry.site.build_options['responsive_image_sizes'][1]) +'px' + '.' + src_parts[1]
-            lqip_src = src_parts[0] + '-'+ str(entry.site.build_options['image_placeholder_size']) +'px' + '.' + src_parts[1]
-            sub = '<img style="max-width: {max_width}px; max-height: {max_height}px;" src="{lqip_src}" data-src="{default_src}" data-sizes="auto" data-srcset="{src_set}" class="lazyload lqip-blur {classes}" alt="{alt}"/>'.format(max_width=str(src_width), max_height=str(src_height), lqip_src=lqip_src, default_src=default_src, src_set=srcset_text, alt=alt, classes=' '.join(classes))
-        return sub
-    entry.compile_output = re.sub(r'\<img\s+[^>]*\s*\>', sub_img, entry.compile_output)
+            img = EntryImage(entry, attrs.get('alt') or '', src)
+            entry.linked_images.append(img)
+        if responsive_images:
+            img_text = get_responsive_image_tag(entry, img, src, attrs)
+        elif img is not None and img.is_shared():
+            img_text = get_shared_image_tag(img, src, attrs)
+        if 'srcset' in img_text:
+            parser.meta_tags.add('responsive-image')
+        if 'lazyload' in img_text:
+            parser.meta_tags.add('lazyload-image')
+        return img_text
+    parser = CompiledHtmlParser(entry.compile_output, process_img)
+    parser.feed(entry.compile_output)
+    parser.close()
+    for href, text in parser.links:
+        if href and not is_external_link(href):
+            entry.linked_files.append(EntryFile(entry, text, href))
+    entry.compile_output = parser.get_output()
+    meta_tags = parser.meta_tags
+    if entry.external_images or entry.linked_images:
+        meta_tags.add('image')
+    entry.options['meta_tags'] = meta_tags
+
+def get_responsive_image_tag(entry, img, src, attrs):
+    """ Substitute <img> tag for lazy-responsive-load """
+    if img is None:
+        return '<img data-src="' + src + '" class="lazyload" />'
+    classes = attrs.get('class') or []
+    alt = html.escape(attrs.get('alt', ''))
+    src_width, src_height = img.real_width, img.real_height
+    srcsets = []
+    for width in entry.site.build_options['responsive_image_sizes']:
+        if src_width<width:
+            srcsets.append(img.get_derivative_link(src, src_width) + ' ' + str(src_width) + 'w')
+            break
+        else:
+            srcsets.append(img.get_derivative_link(src, width) + ' ' + str(width) + 'w')
+    srcset_text = ','.join(srcsets)
+    default_src = img.get_derivative_link(src, entry.site.build_options['responsive_image_sizes'][1])
+    lqip_src = img.get_derivative_link(src, entry.site.build_options['image_placeholder_size'])
+    return '<img style="max-width: {max_width}px; max-height: {max_height}px;" src="{lqip_src}" data-src="{default_src}" data-sizes="auto" data-srcset="{src_set}" class="lazyload lqip-blur {classes}" alt="{alt}"/>'.format(max_width=str(src_width), max_height=str(src_height), lqip_src=lqip_src, default_src=default_src, src_set=srcset_text, alt=alt, classes=' '.join(classes))
+
+def get_shared_image_tag(img, src, attrs):
+    """ <img> tag linking to the shared copy of the image, other attributes are kept """
+    parts = ['<img']
+    for name, value in attrs.items():
+        if name in ('src', 'data-src') and value == src:
+            value = img.get_link()
+        elif name == 'class':
+            value = ' '.join(value)
+        parts.append('{}="{}"'.format(name, html.escape(value)))
+    return ' '.join(parts) + ' />'
 
 def link_entry(entry):
     """ Link entry content with header, footer to get the final html output for the entry """
-    entry_template_name = entry.options.get('layout', 'default')+'.j2'
+    entry_template_name = entry.get_template_name()
     page_template = entry.site.template_registry.get(entry_template_name)
     if not page_template:
         if entry_template_name=='default.j2':
@@ -175,11 +304,10 @@ def link_entry(entry):
 
 def write_entry_output(entry):
     """ Save the final html output to file """
-    logging.debug('Output path: %s', entry.output_path)
-    if not os.path.isdir(entry.output_path):
-        os.makedirs(entry.output_path)
-    output_name = entry.options.get('output_name', 'index.html')
-    output_path = os.path.join(entry.output_path, output_name)
-    with open(output_path, 'wt', encoding="utf8") as of:
-        logging.debug("Writing built html to: %s", output_path)
-        of.write(entry.html_output)
+    logging.debug("Writing built html to: %s", entry.output_file)
+    if entry.site.build_options['streaming_build']:
+        # written at once, the html is not held by pending writes
+        entry.site.file_sync.write_file(entry.output_file, entry.html_output)
+        return
+    # skipped when the html is not changed, written in thread pool
+    entry.site.file_sync.submit_write(entry.output_file, entry.html_output)
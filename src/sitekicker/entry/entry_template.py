@@ -1,9 +1,13 @@
 import jinja2
 
 class EntryTemplate():
-    def __init__(self, path, template):
+    def __init__(self, path, template, dependencies=None, reads_entries=True):
         self.path = path
         self.template = template
+        # template files used when rendering, the template itself, and the ones it extends, includes or imports
+        self.dependencies = dependencies or []
+        # whether any of the template files reads entries of the site, like site.sorted_entries
+        self.reads_entries = reads_entries
 
     def __str__(self):
         return "Entry Template At: [%s]" % self.path
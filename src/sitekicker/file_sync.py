@@ -0,0 +1,337 @@
+import os
+import shutil
+import hashlib
+import logging
+import threading
+import concurrent.futures
+
+from .util import get_file_signature, get_file_hash
+
+COPY_METHODS = ['copy', 'hardlink', 'reflink']
+
+# ioctl request to clone a file on btrfs/xfs, see linux/fs.h
+FICLONE = 0x40049409
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+def is_same_file(src, dest, check_hash=False):
+    """ Whether dest is an up to date copy of src, compared by size and mtime, and content hash when they differ """
+    try:
+        src_stat = os.stat(src)
+        dest_stat = os.stat(dest)
+    except OSError:
+        return False
+    if src_stat.st_size != dest_stat.st_size:
+        return False
+    if src_stat.st_mtime_ns == dest_stat.st_mtime_ns:
+        return True
+    if check_hash and get_file_hash(src) == get_file_hash(dest):
+        # same content, sync mtime so it is not hashed again next time
+        os.utime(dest, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        return True
+    return False
+
+def copy_in_kernel(sf, df, size):
+    """ Copy file data with copy_file_range or sendfile, data never goes through user space, False if not supported """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    for copy_func in (copy_file_range, sendfile):
+        if copy_func is None:
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if copy_func is sendfile:
+                    copied = sendfile(df.fileno(), sf.fileno(), offset, size - offset)
+                else:
+                    copied = copy_file_range(sf.fileno(), df.fileno(), size - offset, offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            pass
+        if offset >= size:
+            return True
+        df.truncate(0)
+    return False
+
+def clone_file(src, dest):
+    """ Copy file data with reflink, copy_file_range or sendfile when supported, so data is shared or copied inside kernel """
+    with open(src, 'rb') as sf, open(dest, 'wb') as df:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(df.fileno(), FICLONE, sf.fileno())
+                return
+            except OSError:
+                pass
+        if not copy_in_kernel(sf, df, os.fstat(sf.fileno()).st_size):
+            sf.seek(0)
+            df.seek(0)
+            shutil.copyfileobj(sf, df, 1024 * 1024)
+
+def get_temp_path(dest):
+    # next to dest, so it could be renamed to dest atomically
+    return os.path.join(os.path.dirname(dest), '.{}.{}.tmp'.format(os.path.basename(dest), threading.get_ident()))
+
+class FileSync:
+    """
+    Copy and write files to output dir, files already up to date are skipped, so their mtime is kept and deploy tools
+    don't upload them again. Files are written to a temp file and renamed, by a bounded thread pool.
+    Files are copied with one of the methods:
+    copy(plain copy), hardlink(link to source file, falls back to copy), reflink(clone or copy_file_range).
+    Hashes of written files are kept in manifest(the build cache), so existing files are not read to compare.
+    With memory_output, written, copied and removed files are kept in memory instead, output dir is not changed,
+    unless flush is set, then files are also written to, copied to and removed from output dir.
+    """
+    def __init__(self, method='copy', check_hash=False, threads=8, manifest=None, memory_output=None, flush=False):
+        if method not in COPY_METHODS:
+            raise Exception("Invalid copy method: {}, should be one of {}".format(method, ', '.join(COPY_METHODS)))
+        self.method = method
+        self.check_hash = check_hash
+        self.threads = max(1, int(threads))
+        self.manifest = manifest
+        self.memory_output = memory_output
+        self.flush = flush
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = []
+        # output files written, copied or removed, until they are popped
+        self.changed_files = set()
+
+    def __str__(self):
+        return "FileSync: [%s], %d threads" % (self.method, self.threads)
+
+    def __getstate__(self):
+        # thread pool could not be sent to worker processes
+        state = dict(self.__dict__)
+        state['lock'] = None
+        state['executor'] = None
+        state['pending'] = []
+        state['changed_files'] = set()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add_changed_file(self, path):
+        with self.lock:
+            self.changed_files.add(path)
+
+    def get_changed_files(self):
+        """ Output files changed since they were last popped, they are kept """
+        with self.lock:
+            return set(self.changed_files)
+
+    def pop_changed_files(self):
+        with self.lock:
+            changed_files = self.changed_files
+            self.changed_files = set()
+        return changed_files
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+            return self.executor
+
+    def is_memory_only(self):
+        return self.memory_output is not None and not self.flush
+
+    def copy_to_memory(self, src, dest):
+        """ Copy a single file to memory output if dest is not up to date, in memory or on disk """
+        if not self.memory_output.is_known(dest) and is_same_file(src, dest):
+            # the file in output dir is up to date, it is served from there
+            return False
+        signature = get_file_signature(src)
+        existing = self.memory_output.lookup(dest)
+        if existing is not None and existing.source_signature == signature:
+            return False
+        with open(src, 'rb') as f:
+            self.memory_output.write(dest, f.read(), signature)
+        self.add_changed_file(dest)
+        return True
+
+    def copy_file(self, src, dest):
+        """ Copy a single file if dest is not up to date, return whether it is copied """
+        if self.is_memory_only():
+            return self.copy_to_memory(src, dest)
+        if is_same_file(src, dest, self.check_hash):
+            return False
+        dest_dir = os.path.dirname(dest)
+        os.makedirs(dest_dir, exist_ok=True)
+        # written next to dest and renamed, so dest is never seen half written
+        temp_dest = get_temp_path(dest)
+        try:
+            if self.method == 'hardlink':
+                try:
+                    os.link(src, temp_dest)
+                except OSError:
+                    shutil.copy2(src, temp_dest)
+            elif self.method == 'reflink':
+                clone_file(src, temp_dest)
+                shutil.copystat(src, temp_dest)
+            else:
+                shutil.copy2(src, temp_dest)
+            os.replace(temp_dest, dest)
+        finally:
+            if os.path.lexists(temp_dest):
+                os.remove(temp_dest)
+        self.add_changed_file(dest)
+        return True
+
+    def get_output_hash(self, dest):
+        """ Content hash of an output file, from manifest when the file is not changed since it is recorded """
+        signature = get_file_signature(dest)
+        if signature is None:
+            return None
+        key = "{}-output".format(dest)
+        if self.manifest is not None:
+            record = self.manifest.get(key)
+            if record and record['signature'] == signature:
+                return record['hash']
+        content_hash = get_file_hash(dest)
+        if self.manifest is not None:
+            self.manifest[key] = {'signature': signature, 'hash': content_hash}
+        return content_hash
+
+    def write_file(self, dest, content):
+        """ Write content(str or bytes) to dest, skipped if dest has the same content, return whether it is written """
+        if not isinstance(content, bytes):
+            content = content.encode('utf8')
+        # hashed the same way as files in output dir, so their hashes could be compared
+        content_hash = hashlib.sha1(content).hexdigest()
+        if self.memory_output is not None:
+            existing = self.memory_output.lookup(dest)
+            if existing is not None and existing.data == content:
+                return False
+            self.memory_output.write(dest, content)
+            if not self.flush:
+                self.add_changed_file(dest)
+                return True
+        if self.get_output_hash(dest) == content_hash:
+            logging.debug("Output not changed: %s", dest)
+            return False
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        temp_dest = get_temp_path(dest)
+        try:
+            with open(temp_dest, 'wb') as f:
+                f.write(content)
+            os.replace(temp_dest, dest)
+        finally:
+            if os.path.lexists(temp_dest):
+                os.remove(temp_dest)
+        if self.manifest is not None:
+            self.manifest["{}-output".format(dest)] = {'signature': get_file_signature(dest), 'hash': content_hash}
+        self.add_changed_file(dest)
+        return True
+
+    def submit_write(self, dest, content):
+        """ Write content to dest in thread pool, wait() for all submitted writes to finish """
+        future = self.get_executor().submit(self.write_file, dest, content)
+        with self.lock:
+            self.pending.append(future)
+        return future
+
+    def submit(self, src, dest):
+        """ Copy a single file in thread pool, wait() for all submitted copies to finish """
+        future = self.get_executor().submit(self.copy_file, src, dest)
+        with self.lock:
+            self.pending.append(future)
+        return future
+
+    def wait(self):
+        """ Wait for all submitted copies and writes, errors of them are raised here, return number of changed files """
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        return sum(future.result() for future in pending)
+
+    def cancel(self):
+        """ Drop submitted copies and writes not started yet, wait for running ones, their errors are ignored """
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        for future in pending:
+            future.cancel()
+        concurrent.futures.wait(pending)
+
+    def copy_files(self, pairs):
+        """ Copy (src, dest) pairs in thread pool, return number of copied files """
+        pairs = list(pairs)
+        if len(pairs) < 2:
+            return sum(self.copy_file(src, dest) for src, dest in pairs)
+        results = self.get_executor().map(lambda p: self.copy_file(*p), pairs)
+        return sum(results)
+
+    def sync_tree(self, src_dir, dest_dir, delete=True):
+        """ Make dest_dir a copy of src_dir, only changed files are copied, stale ones are removed """
+        pairs = []
+        expected = set()
+        for root, dirs, files in os.walk(src_dir, followlinks=True):
+            dest_root = os.path.join(dest_dir, os.path.relpath(root, src_dir))
+            expected.add(os.path.normpath(dest_root))
+            for name in files:
+                dest = os.path.normpath(os.path.join(dest_root, name))
+                expected.add(dest)
+                pairs.append((os.path.join(root, name), dest))
+        if not self.is_memory_only():
+            os.makedirs(dest_dir, exist_ok=True)
+        copied = self.copy_files(pairs)
+        removed = self.remove_stale(dest_dir, expected) if delete else 0
+        logging.debug("Synced [%s] to [%s]: %d files, %d copied, %d removed", src_dir, dest_dir, len(pairs), copied, removed)
+        return copied, removed
+
+    def remove_stale(self, dest_dir, expected):
+        removed = 0
+        for root, dirs, files in os.walk(dest_dir, topdown=False):
+            for name in files + dirs:
+                path = os.path.normpath(os.path.join(root, name))
+                # precompressed variants of synced files are kept, see precompress_output
+                if path in expected or path.endswith('.gz') and path[:-3] in expected:
+                    continue
+                if self.is_memory_only() and self.memory_output.is_known(path):
+                    # removed in memory already, or written there
+                    continue
+                self.remove(path)
+                removed += 1
+        if self.is_memory_only():
+            for path in self.memory_output.list_files(dest_dir):
+                if path not in expected:
+                    self.remove(path)
+                    removed += 1
+        return removed
+
+    def exists(self, path):
+        """ Whether an output file exists, in memory output or on disk """
+        if self.memory_output is not None and self.memory_output.is_known(path):
+            return self.memory_output.lookup(path) is not None
+        return os.path.isfile(path)
+
+    def read_file(self, path):
+        """ Content of an output file, in memory output or on disk """
+        if self.memory_output is not None and self.memory_output.is_known(path):
+            memory_file = self.memory_output.lookup(path)
+            if memory_file is None:
+                raise FileNotFoundError(path)
+            return memory_file.data
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def remove(self, dest):
+        """ Remove a file or folder, in memory output, and in output dir unless only memory output is changed """
+        if self.memory_output is not None:
+            self.memory_output.remove(dest)
+            self.add_changed_file(dest)
+            if not self.flush:
+                return
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest)
+        elif os.path.lexists(dest):
+            os.remove(dest)
+        else:
+            return
+        self.add_changed_file(dest)
@@ -1,5 +1,4 @@
 import os
-import shutil
 import logging
 
 class AssetFolder:
@@ -11,8 +10,18 @@ class AssetFolder:
         return "AssetFolder: [%s]" % self.path
 
     def copy(self):
+        """ Sync the asset folder to output, only changed files are copied, files removed from it are removed from output """
         dest_path = os.path.join(self.site.output_path, os.path.basename(self.path))
-        logging.debug('Copy Asset Folder from [{}] to [{}]'.format(self.path, dest_path))
-        if os.path.isdir(dest_path):
-            shutil.rmtree(dest_path)
-        shutil.copytree(self.path, dest_path)
+        logging.debug('Sync Asset Folder from [{}] to [{}]'.format(self.path, dest_path))
+        self.site.file_sync.sync_tree(self.path, dest_path)
+
+    def copy_path(self, path):
+        """ Copy a single changed file or folder inside the asset folder, remove it from output if it is gone """
+        dest_path = os.path.join(self.site.output_path, os.path.basename(self.path), os.path.relpath(path, self.path))
+        logging.debug('Copy Asset from [{}] to [{}]'.format(path, dest_path))
+        if os.path.isfile(path):
+            self.site.file_sync.copy_file(path, dest_path)
+        elif os.path.isdir(path):
+            self.site.file_sync.sync_tree(path, dest_path)
+        else:
+            self.site.file_sync.remove(dest_path)
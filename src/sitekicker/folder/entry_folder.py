@@ -1,53 +1,33 @@
 import os
 import glob
 
-from ..entry.entry import Entry
+from ..entry.entry import Entry, read_entry_file, is_valid_entry_options
 
 class EntryFolder:
-    def __init__(self, site, path):
+    def __init__(self, site, path, entry_files=None):
         self.path = path
         self.site = site
+        # entry files read when scanning, (path, options, content), they are not read again to find entries
+        self.entry_files = entry_files
 
     def __str__(self):
         return "EntryFolder: [%s]" % self.path
 
     def find_entries(self):
-        entries = []
-        glob_pattern = os.path.join(self.path, '*.md')
-        main_candidates = glob.glob(glob_pattern)
-        if(main_candidates):
-            for candidate in main_candidates:
-                if EntryFolder.detect_file_content(candidate):
-                    entries.append(Entry(self.site, candidate))
-        return entries
+        entry_files = self.entry_files
+        if entry_files is None:
+            entry_files = EntryFolder.read_entry_files(self.site, self.path)
+        # content is kept by entries from now on
+        self.entry_files = None
+        return [Entry(self.site, path, user_options, content) for path, user_options, content in entry_files]
 
     @staticmethod
-    def is_entry_folder(path):
-        """ Detect if a folder contains a valid entry inside it """
+    def read_entry_files(site, path):
+        """ Read all valid entry files inside a folder, a folder with any valid entry file is an entry folder """
+        entry_files = []
         glob_pattern = os.path.join(path, '*.md')
-        main_candidates = glob.glob(glob_pattern)
-        if(main_candidates):
-            for candidate in main_candidates:
-                return EntryFolder.detect_file_content(candidate)
-            else:
-                return False
-        else:
-            False
-
-    @staticmethod
-    def detect_file_content(path):
-        """ Check if a file is valid entry file, by check its front matter """
-        with open(path, 'rt', encoding='utf8') as mf:
-            all_lines = ''.join(mf.readlines())
-            try:
-                # valid entry must have valid "front matter" block(options block)
-                start_index = all_lines.index("---\n", 0)
-                end_index = all_lines.index("---\n", 4)
-                # valid entry must have id, title
-                all_lines.index("\nid: ", start_index, end_index)
-                all_lines.index("\ntitle: ", start_index, end_index)
-                # all_lines.index("\ndate: ", start_index, end_index)
-            except Exception:
-                return False
-            else:
-                return True
+        for candidate in sorted(glob.glob(glob_pattern)):
+            user_options, content = read_entry_file(site, candidate)
+            if is_valid_entry_options(user_options):
+                entry_files.append((candidate, user_options, content))
+        return entry_files
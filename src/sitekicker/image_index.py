@@ -0,0 +1,114 @@
+import os
+import re
+import struct
+import logging
+import subprocess
+
+from .util import get_file_hash
+
+def read_image_size(path):
+    """ Read image dimensions from file header, support JPEG, PNG, GIF and WebP, return None for other formats """
+    with open(path, 'rb') as im:
+        head = im.read(32)
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return read_webp_size(head)
+        if head[:2] == b'\xff\xd8':
+            im.seek(2)
+            return read_jpeg_size(im)
+    return None
+
+def probe_image_size(path):
+    """ Get image dimensions, in process for common formats, fall back to ImageMagick identify for others """
+    try:
+        size = read_image_size(path)
+    except (OSError, struct.error, ValueError) as e:
+        logging.debug("Failed to read image header of [%s]: %s", path, e)
+        size = None
+    if size:
+        return size
+    im_raw_size = subprocess.check_output(['identify', path])
+    im_raw_size_match = re.search(r'\s(\d+)x(\d+)\s', im_raw_size.decode('utf8') if im_raw_size else '')
+    if im_raw_size_match:
+        return int(im_raw_size_match.group(1)), int(im_raw_size_match.group(2))
+    else:
+        return 0, 0
+
+def read_webp_size(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', head[26:30])
+        return width & 0x3fff, height & 0x3fff
+    elif chunk == b'VP8L':
+        b0, b1, b2, b3 = head[21:25]
+        return 1 + (((b1 & 0x3f) << 8) | b0), 1 + (((b3 & 0xf) << 10) | (b2 << 2) | ((b1 & 0xc0) >> 6))
+    elif chunk == b'VP8X':
+        return 1 + int.from_bytes(head[24:27], 'little'), 1 + int.from_bytes(head[27:30], 'little')
+    return None
+
+def read_jpeg_size(im):
+    """ Walk JPEG segments until the start of frame segment, which has the dimensions """
+    while True:
+        marker = im.read(1)
+        while marker and marker != b'\xff':
+            marker = im.read(1)
+        while marker == b'\xff':
+            marker = im.read(1)
+        if not marker:
+            return None
+        code = marker[0]
+        # standalone markers, no segment length
+        if code == 0x01 or 0xd0 <= code <= 0xd9:
+            continue
+        length_bytes = im.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0]
+        # SOF0 - SOF15, except DHT(C4), JPG(C8) and DAC(CC)
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            frame = im.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return width, height
+        im.seek(length - 2, os.SEEK_CUR)
+
+class ImageIndex:
+    """
+    Image metadata(dimensions, content hash) kept in build cache, keyed by path and validated by mtime and size,
+    unchanged images are never opened again.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __str__(self):
+        return "ImageIndex: [%s]" % self.cache
+
+    def lookup(self, path):
+        """ Get metadata of an image, probe the image only when it is new or changed """
+        stat = os.stat(path)
+        key = "{}-image-meta".format(path)
+        record = self.cache.get(key)
+        if record and record['mtime'] == stat.st_mtime_ns and record['size'] == stat.st_size:
+            return record
+        logging.debug("Probing image: [%s]", path)
+        width, height = probe_image_size(path)
+        record = {
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'width': width,
+            'height': height,
+            'hash': get_file_hash(path),
+        }
+        self.cache[key] = record
+        return record
+
+    def get_size(self, path):
+        record = self.lookup(path)
+        return record['width'], record['height']
+
+    def get_hash(self, path):
+        return self.lookup(path)['hash']
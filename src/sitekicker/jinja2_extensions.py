@@ -0,0 +1,101 @@
+import json
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from .util import get_content_hash, get_file_signature
+
+FRAGMENT_DEPENDENCIES = ['entries', 'tags', 'site', 'none']
+
+class FragmentCache:
+    """
+    Rendered template fragments, shared by all entries in a build, optionally kept in build cache between builds.
+    A fragment is rendered again only when its declared dependency changes:
+    entries(any entry), tags(entries grouped by tag), site(site options) or none.
+    Task pool workers building entries have caches of their own, fragments rendered there are sent back
+    with the entries and merged, so pages rendered in parent process, like listings, reuse them.
+    """
+    def __init__(self, site, persistent=False):
+        self.site = site
+        self.persistent = persistent
+        self.fragments = {}
+        self.tokens = {}
+        # fragments rendered since they were last popped
+        self.rendered = {}
+
+    def __str__(self):
+        return "FragmentCache: %d fragments" % len(self.fragments)
+
+    def get_token(self, depends):
+        """ Changes when the dependency changes, computed once in a build """
+        if depends not in self.tokens:
+            site = self.site
+            parts = [json.dumps(site.build_options, sort_keys=True, default=str), self.get_templates_token()]
+            if depends == 'entries':
+                parts.extend(sorted(e.source_hash for e in site.entries.values()))
+            elif depends == 'tags':
+                for tag, entries in sorted(site.grouped_entries.items()):
+                    parts.append(tag)
+                    parts.extend(e.source_hash for e in entries)
+            elif depends not in FRAGMENT_DEPENDENCIES:
+                raise Exception("Invalid fragment cache dependency: {}, should be one of {}".format(depends, ', '.join(FRAGMENT_DEPENDENCIES)))
+            self.tokens[depends] = get_content_hash(*parts)
+        return self.tokens[depends]
+
+    def get_templates_token(self):
+        # fragments kept between builds are invalid when any template changes
+        paths = set()
+        for template in self.site.template_registry.values():
+            paths.update(template.dependencies)
+        return get_content_hash(*[p + str(get_file_signature(p)) for p in sorted(paths)])
+
+    def render(self, key, depends, caller):
+        token = self.get_token(depends)
+        fragment = self.fragments.get(key)
+        if fragment is None and self.persistent:
+            fragment = self.site.build_cache.get("{}-fragment".format(key))
+        if fragment is None or fragment['token'] != token:
+            fragment = {'token': token, 'html': str(caller())}
+            if self.persistent:
+                self.site.build_cache["{}-fragment".format(key)] = fragment
+            self.rendered[key] = fragment
+        self.fragments[key] = fragment
+        return Markup(fragment['html'])
+
+    def pop_rendered(self):
+        """ Fragments rendered in a worker process, sent back to parent process """
+        rendered = self.rendered
+        self.rendered = {}
+        return rendered
+
+    def merge(self, fragments):
+        for key, fragment in fragments.items():
+            self.fragments.setdefault(key, fragment)
+
+class FragmentCacheExtension(Extension):
+    """
+    {% cache "key", "entries" %}...{% endcache %}, the block is rendered once and reused by all pages,
+    until the dependency(entries by default) changes. It must not use data of a single entry.
+    """
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const('entries'))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render_fragment', args), [], [], body).set_lineno(lineno)
+
+    def _render_fragment(self, key, depends, caller):
+        fragment_cache = self.environment.fragment_cache
+        if fragment_cache is None:
+            return caller()
+        return fragment_cache.render(str(key), depends, caller)
@@ -0,0 +1,114 @@
+import os
+import time
+import threading
+
+from .util import get_content_hash
+
+class MemoryFile:
+    """ A file written to memory output, with the same attributes as files cached by the server """
+    def __init__(self, path, data, source_signature=None):
+        self.path = path
+        self.data = data
+        # signature of the file it is copied from, for copied files
+        self.source_signature = source_signature
+        self.size = len(data)
+        self.mtime = time.time()
+        self.hash = get_content_hash(data)
+        self.etag = '"{}"'.format(self.hash)
+
+    def __str__(self):
+        return "MemoryFile: [%s], %d bytes" % (self.path, self.size)
+
+def find_path(files, path):
+    """
+    (whether the path is known, the file or None if it is removed), a removed folder hides everything in it,
+    unless written after it is removed
+    """
+    if path in files:
+        return True, files[path]
+    parent = os.path.dirname(path)
+    while parent and parent != path:
+        if parent in files and files[parent] is None:
+            return True, None
+        path, parent = parent, os.path.dirname(parent)
+    return False, None
+
+class MemoryOutput:
+    """
+    Build output kept in memory, for the preview server in watch mode.
+    Files written by a build are staged, readers only see them after commit(), when they are swapped in at once.
+    Removed files and folders are kept as None, so the ones in output dir are not served either.
+    """
+    def __init__(self):
+        self.files = {}
+        self.staged = {}
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "MemoryOutput: %d files, %d staged" % (len(self.files), len(self.staged))
+
+    def __getstate__(self):
+        # worker processes never write output
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def get(self, path):
+        """ Committed file, seen by the server """
+        return find_path(self.files, os.path.normpath(path))[1]
+
+    def is_removed(self, path):
+        """ Whether a committed file or folder is removed, it is not served from disk then """
+        known, memory_file = find_path(self.files, os.path.normpath(path))
+        return known and memory_file is None
+
+    def find(self, path):
+        """ (whether the path is written or removed in memory, the latest file or None), staged files included """
+        path = os.path.normpath(path)
+        with self.lock:
+            known, memory_file = find_path(self.staged, path)
+            if known:
+                # files removed with a folder are staged one by one, see remove()
+                return known, memory_file
+        return find_path(self.files, path)
+
+    def lookup(self, path):
+        """ Latest file, including the ones staged by current build, None for a removed file """
+        return self.find(path)[1]
+
+    def is_known(self, path):
+        """ Whether the path is written or removed in memory, disk is not checked then """
+        return self.find(path)[0]
+
+    def list_files(self, folder):
+        """ Paths of files in a folder, not removed, staged files included """
+        folder = os.path.normpath(folder)
+        with self.lock:
+            paths = set(self.files) | set(self.staged)
+        return sorted(p for p in paths if p.startswith(folder + os.sep) and self.lookup(p) is not None)
+
+    def write(self, path, data, source_signature=None):
+        memory_file = MemoryFile(os.path.normpath(path), data, source_signature)
+        with self.lock:
+            self.staged[memory_file.path] = memory_file
+
+    def remove(self, path):
+        """ Remove a file, or a folder with all files in it """
+        path = os.path.normpath(path)
+        with self.lock:
+            for known_path in list(self.files) + list(self.staged):
+                if known_path.startswith(path + os.sep):
+                    self.staged[known_path] = None
+            self.staged[path] = None
+
+    def commit(self):
+        """ Swap in files staged by a build, return their paths """
+        with self.lock:
+            staged = self.staged
+            self.staged = {}
+            files = dict(self.files)
+            files.update(staged)
+            # a single assignment, the server sees either all or none of the changes
+            self.files = files
+        return set(staged)
@@ -1,14 +1,21 @@
 import os
 import yaml
+import shutil
+import logging
 import time
-from multiprocessing import Pool, Manager
+import threading
+import multiprocessing
 import collections
 
-from .util import resolve_path, dotdict, get_default_site_options
-from .site_tasks import register_site_tasks
+from .util import resolve_path, dotdict, get_default_site_options, YamlLoader, LOG_FORMAT, LOG_DATE_FORMAT
+from .site_tasks import register_site_tasks, refresh_changed_items
 from .entry.entry_tasks import register_entry_tasks
-from .site_watcher import watch_site
+from .site_watcher import watch_site, BuildCancelled
 from .site_server import serve
+from .image_index import ImageIndex
+from .build_cache import BuildCache
+from .file_sync import FileSync
+from .memory_output import MemoryOutput
 
 SITE_HOOK_NAMES = [
     'pre-scan',
@@ -34,33 +41,64 @@ ENTRY_HOOK_NAMES = [
     'post-link',
 ]
 
+def get_task_pool_context():
+    """
+    Task pool workers are started by a forkserver, or spawned, never forked from this process:
+    it has threads(file writes, watcher, preview server), and locks held by them would be copied locked
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        # workers are forked from the server with sitekicker already imported
+        context.set_forkserver_preload(['sitekicker.site'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+def init_task_worker(log_level):
+    logging.basicConfig(level=log_level, format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+
 class Site:
     def __init__(self, argv_options):
         self.working_path = resolve_path(argv_options.folder)
         # Command line options
         self.cli_options = argv_options
-        # Default options
-        self.default_options = get_default_site_options()
-        # This is the options from sitekicker.yml and command line options
-        user_options_dict = dict(self.default_options)
-        user_options_dict.update(self.read_sitekicker_yml())
-        self.user_options = dotdict(user_options_dict)
-        # This is the derived options from user settings, cli options etc
-        self.build_options = dotdict({})
-        self.build_options.update(self.default_options)
-        self.build_options.update(self.user_options)
-        self.output_path = resolve_path(argv_options.output_dir or self.user_options.output_dir or '.dist')
-        self.build_options.output_path = self.output_path
-        self.build_options.working_path = self.working_path
+        # pages kept in memory for the preview server, it is kept when options are loaded again
+        self.memory_output = None
+        if argv_options.memory_output:
+            if argv_options.serve:
+                self.memory_output = MemoryOutput()
+            else:
+                logging.warning("--memory-output only works with --serve, pages are written to output dir")
+        self.load_options()
+        if self.memory_output is not None and not argv_options.flush_output:
+            # start from records of output dir, they are valid for files on disk, which are served until built in memory
+            disk_cache_path = os.path.join(self.output_path, '.buildcache')
+            if os.path.isfile(disk_cache_path):
+                shutil.copyfile(disk_cache_path, self.build_cache.path)
+        # paths changed since last build, only set when rebuilding in watch mode
+        self.changed_paths = None
+        # set by the rebuild scheduler when new changes come in, the running build stops at the next check
+        self.cancel_event = threading.Event()
+        # build profiler, only set in profile mode
+        self.profiler = None
+        # local preview server, only set when serving
+        self.server = None
+        # search index of the running build, terms of entries are added to it as they are built in streaming build
+        self.search_index = None
         # data placeholders
         self.time = time.localtime()
         self.timestamp = time.time()
         self.template_registry = []
+        # jinja2 environment kept between builds, and the map of template files to entries using them
+        self.template_env = None
+        self.template_env_key = None
+        self.template_dependents = {}
         self.folders = {}
         self.folder_entries = {}
         self.entries = {}
         self.sorted_entries = []
         self.grouped_entries = {}
+        # paths of images shared by entries, generated in current build
+        self.shared_images = set()
         # build hook registry
         self.site_hooks = collections.OrderedDict()
         self.entry_hooks = collections.OrderedDict()
@@ -71,10 +109,39 @@ class Site:
         # register site task
         register_site_tasks(self)
         register_entry_tasks(self)
-        # global task pool for parallel processing
-        self.task_pool = Pool()
-        self.task_pool_manager = Manager()
-        self.snapshots = self.task_pool_manager.dict()
+        # global task pool for parallel processing, opened for every build and closed when its tasks are done
+        self.task_pool = None
+
+    def load_options(self):
+        # Default options
+        self.default_options = get_default_site_options()
+        # This is the options from sitekicker.yml and command line options
+        user_options_dict = dict(self.default_options)
+        user_options_dict.update(self.read_sitekicker_yml())
+        self.user_options = dotdict(user_options_dict)
+        # This is the derived options from user settings, cli options etc
+        self.build_options = dotdict({})
+        self.build_options.update(self.default_options)
+        self.build_options.update(self.user_options)
+        self.output_path = resolve_path(self.cli_options.output_dir or self.user_options.output_dir or '.dist')
+        self.build_options.output_path = self.output_path
+        self.build_options.working_path = self.working_path
+        # records of previous builds, kept in output dir
+        cache_name = '.buildcache'
+        if self.memory_output is not None and not self.cli_options.flush_output:
+            # records of pages only kept in memory must not be used for output dir
+            cache_name = '.buildcache-memory'
+        self.build_cache = BuildCache(os.path.join(self.output_path, cache_name))
+        self.image_index = ImageIndex(self.build_cache)
+        # copies files to output dir, skips unchanged ones
+        self.file_sync = FileSync(
+            self.build_options.copy_method,
+            self.build_options.copy_check_hash,
+            self.build_options.copy_threads,
+            self.build_cache,
+            self.memory_output,
+            self.cli_options.flush_output
+        )
 
     def reset(self):
         self.time = time.gmtime()
@@ -84,17 +151,61 @@ class Site:
         self.entries = {}
         self.sorted_entries = []
         self.grouped_entries = {}
-        self.task_pool = Pool()
-        self.snapshots = self.task_pool_manager.dict()
+
+    def open_task_pool(self):
+        """ A new task pool for a build, the pool left by an unfinished build is terminated """
+        self.close_task_pool(terminate=True)
+        self.task_pool = get_task_pool_context().Pool(initializer=init_task_worker, initargs=(logging.getLogger().level,))
+
+    def close_task_pool(self, terminate=False):
+        """ Wait for all tasks, or drop them when terminating, then stop worker processes """
+        if self.task_pool is None:
+            return
+        if terminate:
+            self.task_pool.terminate()
+        else:
+            self.task_pool.close()
+        self.task_pool.join()
+        self.task_pool = None
+
+    def __getstate__(self):
+        # sent to task pool workers to build entries, pools, threads and site hooks stay in this process
+        state = dict(self.__dict__)
+        state['task_pool'] = None
+        state['cancel_event'] = None
+        state['server'] = None
+        state['search_index'] = None
+        state['site_hooks'] = None
+        # templates are loaded again by workers
+        state['template_env'] = None
+        state['template_registry'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cancel_event = threading.Event()
+        for entry in self.entries.values():
+            entry.site = self
+
+    def cancel_build(self):
+        self.cancel_event.set()
+
+    def check_cancelled(self):
+        """ Called between steps of a build, stops it when it is cancelled """
+        if self.cancel_event.is_set():
+            raise BuildCancelled(str(self))
 
     def __str__(self):
         return "Site: [%s], output to [%s]" % (self.working_path, self.output_path)
 
+    def get_sitekicker_yml_path(self):
+        return os.path.join(self.working_path, 'sitekicker.yml')
+
     def read_sitekicker_yml(self):
-        site_yml_path = os.path.join(self.working_path, 'sitekicker.yml')
+        site_yml_path = self.get_sitekicker_yml_path()
         if os.path.isfile(site_yml_path):
             with open(site_yml_path, 'rt', encoding='utf8') as site_config:
-                user_options = dotdict(yaml.load(site_config, Loader=yaml.FullLoader))
+                user_options = dotdict(yaml.load(site_config, Loader=YamlLoader))
                 return user_options
         else:
             raise Exception("sitekicker.yml is not found!")
@@ -111,13 +222,55 @@ class Site:
         else:
             raise Exception("Invalid Entry Hook name: %s" % hook)
 
+    def run_site_hooks(self, hook_names):
+        """
+        Run handlers of site hooks, tasks, file writes and build cache changes not dumped yet
+        are dropped when the build is cancelled or fails
+        """
+        self.open_task_pool()
+        if self.profiler:
+            # full builds and rebuilds each get their own trace and a profiled task pool
+            self.profiler.start(self)
+        try:
+            for hook in hook_names:
+                for handler in self.site_hooks[hook]:
+                    self.check_cancelled()
+                    handler(self)
+        except BaseException:
+            self.close_task_pool(terminate=True)
+            self.file_sync.cancel()
+            # records of dropped tasks and writes must not be kept, the cache is read from database again
+            self.build_cache.load()
+            raise
+
     def build(self):
         """ Default build operation, lazy, only build parts that need to be built """
         self.reset()
-        for hook in SITE_HOOK_NAMES:
-            if self.site_hooks[hook]:
-                for handler in self.site_hooks[hook]:
-                    handler(self)
+        try:
+            self.run_site_hooks(SITE_HOOK_NAMES)
+        except BaseException:
+            # the scanned site is incomplete, the next rebuild is a full build
+            self.folders = {}
+            raise
+
+    def rebuild(self, changed_paths):
+        """ Rebuild after some paths changed, the scanned site is kept, only affected items are rebuilt """
+        if not self.folders or self.get_sitekicker_yml_path() in changed_paths:
+            logging.info("Full rebuild: %s", self)
+            self.load_options()
+            self.build()
+            return
+        self.changed_paths = set(changed_paths)
+        # scan and mark phases are replaced by refreshing the changed items
+        if not refresh_changed_items(self):
+            logging.info("Changes outside of known folders, full rebuild: %s", self)
+            self.changed_paths = None
+            self.build()
+            return
+        try:
+            self.run_site_hooks(SITE_HOOK_NAMES[SITE_HOOK_NAMES.index('pre-build'):])
+        finally:
+            self.changed_paths = None
 
     def watch(self, serve_site=False):
         """ Watch for changes inside the site folder, rebuild items that changed """
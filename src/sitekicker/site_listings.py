@@ -0,0 +1,154 @@
+import os
+import json
+import logging
+import datetime
+import collections
+
+import sitekicker
+from .util import get_content_hash, get_file_signature
+
+LISTING_TYPES = ['tag', 'year', 'month', 'prefix']
+
+DEFAULT_LISTING_PATHS = {
+    'tag': 'tags/{key}',
+    'year': 'archive/{key}',
+    'month': 'archive/{key}',
+    'prefix': '{key}',
+}
+
+def get_listing_keys(listing_type, entry):
+    """ Keys of listings of the type an entry belongs to """
+    if listing_type == 'tag':
+        return list(entry.options.get('tags', []))
+    if listing_type in ('year', 'month') and not isinstance(entry.date, datetime.date):
+        # like a quoted date in front matter, it is a string
+        logging.warning("Entry [%s] is not listed by %s, its date is not a date: %r", entry.id, listing_type, entry.date)
+        return []
+    if listing_type == 'year':
+        return ['{:04d}'.format(entry.date.year)]
+    if listing_type == 'month':
+        return ['{:04d}/{:02d}'.format(entry.date.year, entry.date.month)]
+    if listing_type == 'prefix':
+        prefix = '/'.join(str(p) for p in entry.options.get('prefix', []))
+        # entries without prefix are listed by the site index
+        return [prefix] if prefix else []
+    raise Exception("Invalid listing type: {}, should be one of {}".format(listing_type, ', '.join(LISTING_TYPES)))
+
+def group_listing_entries(site, listing):
+    """ Group sorted entries by listing key, newest first """
+    exclude_types = listing.get('exclude_types', ['page', 'hidden'])
+    groups = collections.OrderedDict()
+    for entry in site.sorted_entries:
+        if entry.options.get('type') in exclude_types:
+            continue
+        for key in get_listing_keys(listing['type'], entry):
+            groups.setdefault(key, []).append(entry)
+    return groups
+
+def get_listing_link(path, page=None):
+    link = '/' + path.strip('/')
+    if page is not None:
+        link = link.rstrip('/') + '/page/' + str(page)
+    return link
+
+def paginate(entries, page_size):
+    """
+    Split entries(newest first) to pages, numbered from the oldest entries, so a new entry only changes the newest page.
+    The front page always lists the newest page_size entries, it may overlap with the newest numbered page.
+    Yield (page number or None for front page, entries of the page newest first, older page, newer page)
+    """
+    pages = max(1, (len(entries) + page_size - 1) // page_size)
+    oldest_first = list(reversed(entries))
+    front = entries[:page_size]
+    # numbered page holding the entry right after the front page
+    older = (len(entries) - page_size - 1) // page_size + 1 if len(entries) > page_size else None
+    yield None, front, older, None
+    if len(entries) <= page_size:
+        # all entries are on the front page
+        return
+    for page in range(1, pages + 1):
+        page_entries = list(reversed(oldest_first[(page - 1) * page_size:page * page_size]))
+        yield page, page_entries, page - 1 if page > 1 else None, page + 1 if page < pages else 0
+
+class ListingPage:
+    """ A page of a listing, rendered with only the entries of the page """
+    def __init__(self, listing, key, page, entries, older_page, newer_page):
+        self.type = listing['type']
+        self.key = key
+        self.layout = listing.get('layout', 'listing')
+        self.path = listing.get('path', DEFAULT_LISTING_PATHS[self.type]).format(key=key)
+        self.page = page
+        self.entries = entries
+        self.link = get_listing_link(self.path, page)
+        self.older_link = get_listing_link(self.path, older_page) if older_page else None
+        # the newest numbered page links to front page, 0 stands for it
+        self.newer_link = None if newer_page is None else get_listing_link(self.path, newer_page or None)
+
+    def __str__(self):
+        return "ListingPage(%s): [%s], %d entries" % (self.type, self.link, len(self.entries))
+
+    def get_template_name(self):
+        return self.layout + '.j2'
+
+    def get_output_file(self, site):
+        return os.path.join(site.output_path, self.link.strip('/'), 'index.html')
+
+    def fingerprint(self, site, template):
+        """ Changes when anything shown on the page changes: template, its entries, links of the page """
+        parts = [
+            sitekicker.__version__,
+            json.dumps(site.build_options, sort_keys=True, default=str),
+            self.type, self.key, self.link, self.older_link, self.newer_link,
+        ]
+        for path in template.dependencies:
+            parts.append(path)
+            parts.append(get_file_signature(path))
+        for entry in self.entries:
+            parts.append(entry.path)
+            parts.append(entry.source_hash)
+        return get_content_hash(*parts)
+
+    def render(self, site, template):
+        return template.render({
+            'sitekicker': sitekicker,
+            'site': site,
+            'listing': self,
+            'entries': self.entries,
+        })
+
+def find_listing_pages(site):
+    page_size = int(site.build_options['listing_page_size'])
+    for listing in site.build_options['listings'] or []:
+        if listing.get('type') not in LISTING_TYPES:
+            raise Exception("Invalid listing type: {}, should be one of {}".format(listing.get('type'), ', '.join(LISTING_TYPES)))
+        for key, entries in group_listing_entries(site, listing).items():
+            for page, page_entries, older_page, newer_page in paginate(entries, page_size):
+                yield ListingPage(listing, key, page, page_entries, older_page, newer_page)
+
+def build_listings(site):
+    """ Render paginated listings, pages not changed since last build are skipped, stale pages are removed """
+    built, output_files, fingerprints = 0, [], {}
+    for listing_page in find_listing_pages(site):
+        template = site.template_registry.get(listing_page.get_template_name())
+        if not template:
+            raise Exception("Listing[{}] using invalid template: [{}]".format(listing_page.link, listing_page.get_template_name()))
+        output_file = listing_page.get_output_file(site)
+        output_files.append(output_file)
+        fingerprint = listing_page.fingerprint(site, template)
+        key = "{}-listing-fingerprint".format(output_file)
+        if not site.cli_options.full_build and site.file_sync.exists(output_file) and site.build_cache.get(key) == fingerprint:
+            continue
+        logging.debug("Building %s", listing_page)
+        site.file_sync.submit_write(output_file, listing_page.render(site, template))
+        fingerprints[key] = fingerprint
+        built += 1
+    # pages are only recorded once they are written
+    site.file_sync.wait()
+    for key, fingerprint in fingerprints.items():
+        site.build_cache[key] = fingerprint
+    for output_file in set(site.build_cache.get('listing-output-files', [])) - set(output_files):
+        logging.debug("Remove stale listing page: %s", output_file)
+        site.file_sync.remove(output_file)
+    site.build_cache['listing-output-files'] = output_files
+    if output_files:
+        print("{} listing pages found, {} built!".format(len(output_files), built))
@@ -0,0 +1,107 @@
+import os
+import gzip
+import logging
+
+def is_compressed_uptodate(path, gz_path):
+    """ A .gz variant carries the mtime of its source, it is up to date when they are the same """
+    try:
+        return os.stat(gz_path).st_mtime_ns == os.stat(path).st_mtime_ns
+    except OSError:
+        return False
+
+def gzip_file(path):
+    """ Write path.gz at maximum compression, through a temp file, return whether it is written """
+    gz_path = path + '.gz'
+    if is_compressed_uptodate(path, gz_path):
+        return False
+    logging.debug("Compress %s", path)
+    stat = os.stat(path)
+    temp_path = os.path.join(os.path.dirname(path), '.{}.gz.tmp'.format(os.path.basename(path)))
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(temp_path, 'wb') as raw, gzip.GzipFile('', 'wb', 9, raw, stat.st_mtime) as gz:
+            gz.write(data)
+        os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(temp_path, gz_path)
+    finally:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+    return True
+
+def is_shipped_compressed(path, compressed_files):
+    """ Whether path has a .gz not written by precompress, like one shipped in an asset folder """
+    gz_path = path + '.gz'
+    if gz_path in compressed_files or not os.path.isfile(gz_path) or is_compressed_uptodate(path, gz_path):
+        return False
+    logging.debug("Keep compressed file not written by precompress: %s", gz_path)
+    return True
+
+def find_compressible_files(site, compressed_files):
+    """
+    Output files with the configured extensions, and .gz variants written by precompress whose source is gone.
+    A .gz not written by precompress, like one shipped in an asset folder, is left as it is, and its source is not compressed.
+    """
+    extensions = get_extensions(site)
+    compressible = []
+    for root, dirs, files in os.walk(site.output_path):
+        # caches of sitekicker are hidden folders
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            if name.startswith('.') or not name.lower().endswith(extensions):
+                continue
+            path = os.path.join(root, name)
+            if not is_shipped_compressed(path, compressed_files):
+                compressible.append(path)
+    written = set(p + '.gz' for p in compressible)
+    stale = [p for p in compressed_files if p not in written and os.path.isfile(p)]
+    return compressible, written, stale
+
+def find_changed_compressible_files(site, compressed_files, changed_files):
+    """
+    Same as find_compressible_files, only for output files written or copied in this build,
+    sources of .gz variants written by precompress are checked with a stat, the output dir is not walked
+    """
+    extensions = get_extensions(site)
+    compressible = []
+    for path in changed_files:
+        relative_path = os.path.relpath(path, site.output_path)
+        # caches of sitekicker are hidden
+        if relative_path.startswith(os.pardir) or any(p.startswith('.') for p in relative_path.split(os.sep)):
+            continue
+        if path.lower().endswith(extensions) and os.path.isfile(path) and not is_shipped_compressed(path, compressed_files):
+            compressible.append(path)
+    stale = set(p for p in compressed_files if not os.path.isfile(p[:-3]))
+    written = (compressed_files - stale) | set(p + '.gz' for p in compressible)
+    return compressible, written, [p for p in stale if os.path.isfile(p)]
+
+def get_extensions(site):
+    return tuple(e.lower() for e in site.build_options['precompress_extensions'])
+
+def precompress_output(site):
+    """
+    Write .gz variants of text output, only for files changed in this build, in thread pool.
+    The whole output dir is checked on the first build with precompress, with --full-build, or when extensions change.
+    """
+    if not site.build_options['precompress']:
+        return
+    if site.file_sync.is_memory_only():
+        # pages in memory are served uncompressed, output dir is not changed
+        return
+    # .gz variants written by precompress, the ones of removed files are removed
+    compressed_files = set(site.build_cache.get('precompressed-files', []))
+    extensions = sorted(get_extensions(site))
+    if 'precompressed-files' not in site.build_cache or site.cli_options.full_build or site.build_cache.get('precompress-extensions') != extensions:
+        compressible, written, stale = find_compressible_files(site, compressed_files)
+    else:
+        # files not changed in this build have up to date .gz variants already
+        changed_files = site.file_sync.get_changed_files()
+        compressible, written, stale = find_changed_compressible_files(site, compressed_files, changed_files)
+    for gz_path in stale:
+        logging.debug("Remove stale compressed file: %s", gz_path)
+        os.remove(gz_path)
+    compressed = sum(site.file_sync.get_executor().map(gzip_file, compressible))
+    site.build_cache['precompressed-files'] = sorted(written)
+    site.build_cache['precompress-extensions'] = extensions
+    if compressed:
+        print("{} of {} files compressed!".format(compressed, len(compressible)))
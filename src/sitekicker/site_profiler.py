@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+import collections
+
+def now_us():
+    # wall clock, comparable between worker processes
+    return int(time.time() * 1000000)
+
+class ProfiledTask:
+    """ Wrap a task of the task pool, so its timing is sent back with the result """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        start = now_us()
+        result = self.func(*args, **kwargs)
+        return result, start, now_us(), os.getpid()
+
+class ProfiledPool:
+    """ Wrap the site task pool, record timing of every task """
+    def __init__(self, pool, profiler):
+        self.pool = pool
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def apply_async(self, func, args=(), kwds=None, callback=None, error_callback=None):
+        def record(profiled_result):
+            result, start, end, pid = profiled_result
+            self.profiler.add_event(func.__name__, 'task', start, end - start, pid, {'src': str(args[0]) if args else ''})
+            if callback:
+                callback(result)
+        return self.pool.apply_async(ProfiledTask(func), args, kwds or {}, record, error_callback)
+
+class ProfiledEntryHandler:
+    """ Entry hook handler timed by the profiler, it is sent to task pool workers with the site """
+    def __init__(self, profiler, hook, handler):
+        self.profiler = profiler
+        self.hook = hook
+        self.handler = handler
+        self.__name__ = handler.__name__
+
+    def __call__(self, entry):
+        start = now_us()
+        try:
+            return self.handler(entry)
+        finally:
+            self.profiler.add_event(self.__name__, 'entry:' + self.hook, start, now_us() - start, args={'entry': str(entry.id)})
+
+class BuildProfiler:
+    """
+    Time every site hook, every entry hook of every entry and every task of the task pool,
+    optionally with peak memory of each site hook, write a Chrome/Perfetto trace and a report of slowest entries.
+    """
+    def __init__(self, site, trace_path, trace_memory=False, top=20):
+        self.site = site
+        self.trace_path = trace_path
+        self.trace_memory = trace_memory
+        self.top = top
+        self.events = []
+        self.memory_peaks = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "BuildProfiler: [%s], %d events" % (self.trace_path, len(self.events))
+
+    def __getstate__(self):
+        # workers start with no events, theirs are sent back with built entries
+        state = dict(self.__dict__)
+        state['events'] = []
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add_event(self, name, category, start, duration, pid=None, args=None):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': start,
+            'dur': duration,
+            'pid': pid or os.getpid(),
+            'tid': pid or os.getpid(),
+            'args': args or {},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def pop_events(self):
+        """ Events of a worker process, sent back to parent process """
+        with self.lock:
+            events = self.events
+            self.events = []
+        return events
+
+    def merge(self, events):
+        with self.lock:
+            self.events.extend(events)
+
+    def install(self):
+        self.site.profiler = self
+        for hook, handlers in self.site.site_hooks.items():
+            self.site.site_hooks[hook] = [self.wrap_site_handler(hook, h) for h in handlers]
+        for hook, handlers in self.site.entry_hooks.items():
+            self.site.entry_hooks[hook] = [self.wrap_entry_handler(hook, h) for h in handlers]
+        self.site.site_hooks['post-summary'].append(self.finish)
+
+    def wrap_site_handler(self, hook, handler):
+        def run(site):
+            if self.trace_memory:
+                reset_peak = getattr(tracemalloc, 'reset_peak', None)
+                if reset_peak:
+                    reset_peak()
+            start = now_us()
+            try:
+                return handler(site)
+            finally:
+                self.add_event(handler.__name__, 'site:' + hook, start, now_us() - start)
+                if self.trace_memory:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    self.memory_peaks[hook] = max(peak, self.memory_peaks.get(hook, 0))
+                    with self.lock:
+                        self.events.append({'name': 'memory', 'ph': 'C', 'ts': now_us(), 'pid': os.getpid(), 'args': {'peak': peak}})
+        run.__name__ = handler.__name__
+        return run
+
+    def wrap_entry_handler(self, hook, handler):
+        return ProfiledEntryHandler(self, hook, handler)
+
+    def start(self, site):
+        """ Called by the site when a build starts, events of previous build are dropped """
+        self.events = []
+        self.memory_peaks = collections.OrderedDict()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if not isinstance(site.task_pool, ProfiledPool):
+            site.task_pool = ProfiledPool(site.task_pool, self)
+
+    def finish(self, site):
+        if self.trace_memory:
+            tracemalloc.stop()
+        self.write_trace()
+        self.print_report()
+
+    def write_trace(self):
+        pids = set(e['pid'] for e in self.events)
+        metadata = [
+            {'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'sitekicker' if pid == os.getpid() else 'worker {}'.format(pid)}}
+            for pid in pids
+        ]
+        with open(self.trace_path, 'wt', encoding='utf8') as tf:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, tf)
+        print("Profile trace written to {}, open it with chrome://tracing or https://ui.perfetto.dev".format(self.trace_path))
+
+    def print_report(self):
+        site_hooks = collections.OrderedDict()
+        entry_hooks = collections.OrderedDict()
+        entries = collections.defaultdict(float)
+        tasks = []
+        for e in self.events:
+            if e['ph'] != 'X':
+                continue
+            if e['cat'].startswith('site:'):
+                site_hooks[e['cat'][5:]] = site_hooks.get(e['cat'][5:], 0) + e['dur']
+            elif e['cat'].startswith('entry:'):
+                entry_hooks[e['cat'][6:]] = entry_hooks.get(e['cat'][6:], 0) + e['dur']
+                entries[e['args']['entry']] += e['dur']
+            elif e['cat'] == 'task':
+                tasks.append(e['dur'])
+        print("Site hooks:")
+        for hook, duration in site_hooks.items():
+            memory = " peak memory {:.1f}MB".format(self.memory_peaks[hook] / 1048576) if hook in self.memory_peaks else ''
+            print("  {:>14}: {:10.3f}s{}".format(hook, duration / 1000000, memory))
+        print("Entry hooks, all entries:")
+        for hook, duration in entry_hooks.items():
+            print("  {:>14}: {:10.3f}s".format(hook, duration / 1000000))
+        if tasks:
+            print("Pool tasks: {}, {:.3f}s in total, slowest {:.3f}s".format(len(tasks), sum(tasks) / 1000000, max(tasks) / 1000000))
+        print("Slowest {} entries:".format(min(self.top, len(entries))))
+        for eid, duration in sorted(entries.items(), key=lambda e: e[1], reverse=True)[:self.top]:
+            print("  {:10.3f}s {}".format(duration / 1000000, eid))
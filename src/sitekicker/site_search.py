@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import html
+import logging
+import collections
+
+# terms in title and tags weigh more than the ones in content
+TITLE_WEIGHT = 5
+TAG_WEIGHT = 5
+
+TAG_PATTERN = re.compile(r'<[^>]*>')
+TERM_PATTERN = re.compile(r'\w\w+', re.UNICODE)
+ASCII_SHARD_PATTERN = re.compile(r'[a-z0-9_]+')
+
+def tokenize(text):
+    return TERM_PATTERN.findall(text.lower())
+
+def get_search_terms(title, tags, content_html):
+    """ Term frequencies of an entry, from its title, tags and compiled html """
+    terms = collections.Counter(tokenize(html.unescape(TAG_PATTERN.sub(' ', content_html or ''))))
+    for term in tokenize(title or ''):
+        terms[term] += TITLE_WEIGHT
+    for tag in tags or []:
+        for term in tokenize(str(tag)):
+            terms[term] += TAG_WEIGHT
+    return dict(terms)
+
+def collect_search_terms(entry):
+    """ Entry hook, runs after compiling, compiled html is still in memory """
+    entry.search_terms = get_search_terms(entry.options.get('title'), entry.options.get('tags', []), entry.compile_output)
+
+def stream_search_terms(entry):
+    """ Entry hook, streaming build, terms are added to postings of the search index, the entry does not keep them """
+    terms = getattr(entry, 'search_terms', None)
+    if terms is None:
+        return
+    del entry.search_terms
+    if is_indexed(entry):
+        entry.site.search_index.add(entry, terms)
+
+def is_indexed(entry):
+    return entry.id and entry.date and entry.options.get('type') != 'hidden'
+
+def get_shard_name(term):
+    """ Terms are sharded by their first two chars, non ascii prefixes are hex encoded """
+    prefix = term[:2]
+    if ASCII_SHARD_PATTERN.fullmatch(prefix):
+        return prefix
+    return 'u' + prefix.encode('utf8').hex()
+
+def encode_postings(postings):
+    """ {doc id: term frequency} to a flat list of doc id gaps and term frequencies, sorted by doc id """
+    encoded = []
+    last_doc = 0
+    for doc in sorted(postings):
+        encoded.append(doc - last_doc)
+        encoded.append(postings[doc])
+        last_doc = doc
+    return encoded
+
+def decode_postings(encoded):
+    postings = {}
+    doc = 0
+    for i in range(0, len(encoded), 2):
+        doc += encoded[i]
+        postings[doc] = encoded[i + 1]
+    return postings
+
+class SearchIndex:
+    """
+    Inverted index of entries, written to <search_index_dir> in output dir:
+    docs.json lists [link, title] of every doc id, shards/<shard>.json maps terms of a shard to their postings,
+    so a browser only downloads the shards of the terms it searches.
+    Terms of every entry are kept in build cache, only shards with terms of changed entries are written again.
+    Terms of changed entries are added to postings as they come, the shards are written by update() at the end.
+    """
+    def __init__(self, site):
+        self.site = site
+        # build cache records, saved once the shards are written
+        self.records = {}
+        # postings of changed entries, {term: {doc id: frequency}}, and the terms they add to every shard
+        self.new_postings = collections.defaultdict(dict)
+        self.affected_shards = {}
+        self.changed_doc_ids = set()
+        self.changed_paths = set()
+        self.path = os.path.join(site.output_path, site.build_options['search_index_dir'])
+        self.docs = site.build_cache.get('search-docs')
+        self.fresh = self.docs is None or not site.file_sync.exists(self.get_docs_path())
+        if self.fresh:
+            self.docs = {'ids': {}, 'list': []}
+
+    def __str__(self):
+        return "SearchIndex: [%s], %d docs" % (self.path, len(self.docs['ids']))
+
+    def get_docs_path(self):
+        return os.path.join(self.path, 'docs.json')
+
+    def get_shard_path(self, shard):
+        return os.path.join(self.path, 'shards', shard + '.json')
+
+    def read_shard(self, shard):
+        shard_path = self.get_shard_path(shard)
+        if self.fresh or not self.site.file_sync.exists(shard_path):
+            return {}
+        shard = json.loads(self.site.file_sync.read_file(shard_path).decode('utf8'))
+        return dict((term, decode_postings(encoded)) for term, encoded in shard.items())
+
+    def write_shard(self, shard, index):
+        shard_path = self.get_shard_path(shard)
+        if not index:
+            self.site.file_sync.remove(shard_path)
+            return
+        encoded = collections.OrderedDict((term, encode_postings(index[term])) for term in sorted(index))
+        self.site.file_sync.submit_write(shard_path, json.dumps(encoded, ensure_ascii=False, separators=(',', ':')))
+
+    def get_doc_id(self, entry):
+        doc_id = self.docs['ids'].get(entry.path)
+        if doc_id is None:
+            doc_id = len(self.docs['list'])
+            self.docs['ids'][entry.path] = doc_id
+            self.docs['list'].append(None)
+        self.docs['list'][doc_id] = [entry.link, entry.options.get('title')]
+        return doc_id
+
+    def add(self, entry, terms):
+        """ Add terms of a changed entry, its old terms are dropped from their shards by update() """
+        path = entry.path
+        if path in self.docs['ids']:
+            self.changed_doc_ids.add(self.docs['ids'][path])
+        for term in self.site.build_cache.get("{}-search-terms".format(path), {}):
+            self.affected_shards.setdefault(get_shard_name(term), set())
+        doc_id = self.get_doc_id(entry)
+        for term, frequency in terms.items():
+            self.new_postings[term][doc_id] = frequency
+            self.affected_shards.setdefault(get_shard_name(term), set()).add(term)
+        self.records["{}-search-terms".format(path)] = terms
+        self.changed_paths.add(path)
+
+    def update(self):
+        site = self.site
+        indexed_entries = dict((e.path, e) for e in site.entries.values() if is_indexed(e))
+        for path, entry in indexed_entries.items():
+            if path in self.changed_paths:
+                continue
+            if self.fresh or entry.dirty or path not in self.docs['ids']:
+                # entries not built in this build keep the terms of the last build
+                terms = getattr(entry, 'search_terms', None)
+                self.add(entry, terms if terms is not None else site.build_cache.get("{}-search-terms".format(path), {}))
+        removed = [path for path in self.docs['ids'] if path not in indexed_entries]
+        if self.fresh:
+            logging.debug("Building new search index: %s", self.path)
+            site.file_sync.remove(self.path)
+        for path in removed:
+            self.changed_doc_ids.add(self.docs['ids'][path])
+            for term in site.build_cache.get("{}-search-terms".format(path), {}):
+                self.affected_shards.setdefault(get_shard_name(term), set())
+            self.docs['list'][self.docs['ids'].pop(path)] = None
+            self.records["{}-search-terms".format(path)] = {}
+        for shard, terms in self.affected_shards.items():
+            index = self.read_shard(shard)
+            for term in list(index):
+                postings = dict((d, f) for d, f in index[term].items() if d not in self.changed_doc_ids)
+                if postings:
+                    index[term] = postings
+                else:
+                    del index[term]
+            for term in terms:
+                index.setdefault(term, {}).update(self.new_postings[term])
+            self.write_shard(shard, index)
+        if self.changed_paths or removed:
+            site.file_sync.submit_write(self.get_docs_path(), json.dumps(self.docs['list'], ensure_ascii=False, separators=(',', ':')))
+        self.records['search-docs'] = self.docs
+        return len(self.changed_paths), len(removed), len(self.affected_shards)
+
+def start_search_index(site):
+    """ Search index of this build, entries are added to it while they are built in streaming build """
+    site.search_index = SearchIndex(site) if site.build_options['search_index'] else None
+
+def build_search_index(site):
+    """ Update search index with entries built in this build, and remove deleted entries from it """
+    if not site.build_options['search_index']:
+        return
+    search_index = site.search_index or SearchIndex(site)
+    site.search_index = None
+    changed, removed, shards = search_index.update()
+    # the index is only recorded once it is written
+    site.file_sync.wait()
+    for key, value in search_index.records.items():
+        site.build_cache[key] = value
+    if changed or removed:
+        print("Search index: {} entries updated, {} removed, {} shards written!".format(changed, removed, shards))
@@ -1,15 +1,422 @@
 import os
+import re
+import json
+import logging
+import queue
+import shutil
+import posixpath
 import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler, SimpleHTTPRequestHandler
+import collections
+import urllib.parse
+from http import HTTPStatus
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+# hot files are kept in memory, large ones like videos are always streamed from disk
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+MAX_CACHED_FILE_BYTES = 4 * 1024 * 1024
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)')
+
+LIVE_RELOAD_PATH = '/_sitekicker/live-reload'
+# comments keep idle event streams open through proxies
+LIVE_RELOAD_PING_SECONDS = 15
+# a page reloads when its url or one of its stylesheets or scripts is pushed
+LIVE_RELOAD_SNIPPET = b"""<script>
+(function () {
+  if (!window.EventSource) return;
+  function normalize(path) { return path.replace(/index\\.html$/, '').replace(/\\/+$/, '') || '/'; }
+  var source = new EventSource('%s');
+  source.addEventListener('reload', function (event) {
+    var urls = JSON.parse(event.data).map(normalize);
+    var paths = [normalize(location.pathname)];
+    Array.prototype.forEach.call(document.querySelectorAll('link[href], script[src]'), function (el) {
+      paths.push(normalize(new URL(el.href || el.src, location.href).pathname));
+    });
+    if (paths.some(function (path) { return urls.indexOf(path) >= 0; })) {
+      source.close();
+      location.reload();
+    }
+  });
+})();
+</script>
+""" % LIVE_RELOAD_PATH.encode('ascii')
+
+def accepts_encoding(accept_encoding, encoding):
+    """ Whether an Accept-Encoding header value accepts the encoding, with a non zero q value, it takes precedence over * """
+    accepts_any = False
+    for item in accept_encoding.split(','):
+        parts = [p.strip() for p in item.split(';')]
+        name = parts[0].lower()
+        if name not in (encoding, '*'):
+            continue
+        accepted = True
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    accepted = float(param[2:]) > 0
+                except ValueError:
+                    accepted = False
+        if name == encoding:
+            return accepted
+        accepts_any = accepted
+    return accepts_any
+
+def parse_range(header, size):
+    """ (first, last) byte of a single byte range, None if there is no supported range, ValueError if it is not satisfiable """
+    match = RANGE_PATTERN.fullmatch(header.strip()) if header else None
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if match.group(1):
+        first = int(match.group(1))
+        last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    else:
+        suffix = int(match.group(2))
+        if suffix == 0:
+            raise ValueError(header)
+        first, last = max(0, size - suffix), size - 1
+    if first > last:
+        raise ValueError(header)
+    return first, last
+
+def inject_live_reload(data):
+    """ Html with the live reload client inserted before the last </body>, or at the end """
+    index = data.lower().rfind(b'</body>')
+    if index < 0:
+        return data + LIVE_RELOAD_SNIPPET
+    return data[:index] + LIVE_RELOAD_SNIPPET + data[index:]
+
+def get_changed_urls(site, changed_files):
+    """ Links of entries whose output changed, and urls of other changed files in output dir """
+    changed_files = set(os.path.normpath(p) for p in changed_files)
+    urls = []
+    for entry in site.entries.values():
+        output_file = getattr(entry, 'output_file', None)
+        if output_file is not None and os.path.normpath(output_file) in changed_files:
+            urls.append(entry.link)
+    for path in sorted(changed_files):
+        relative_path = os.path.relpath(path, site.output_path)
+        if relative_path.startswith(os.pardir) or relative_path.startswith('.'):
+            continue
+        url = '/' + relative_path.replace(os.sep, '/')
+        if url.endswith('.gz'):
+            continue
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+class LiveReload:
+    """ Server-Sent Events channel, pushes urls changed by a finished build to every connected browser """
+    def __init__(self):
+        self.clients = set()
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "LiveReload: %d clients" % len(self.clients)
+
+    def subscribe(self):
+        events = queue.Queue()
+        with self.lock:
+            self.clients.add(events)
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            self.clients.discard(events)
+
+    def publish(self, urls):
+        with self.lock:
+            clients = list(self.clients)
+        for events in clients:
+            events.put(list(urls))
+
+class CachedFile:
+    """ Metadata of a served file, with its content when it is small enough """
+    def __init__(self, path, stat, data, generation):
+        self.path = path
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.mtime_ns = stat.st_mtime_ns
+        self.etag = '"{:x}-{:x}"'.format(stat.st_size, stat.st_mtime_ns)
+        self.data = data
+        self.generation = generation
+
+    def __str__(self):
+        return "CachedFile: [%s], %d bytes" % (self.path, self.size)
+
+class FileCache:
+    """
+    LRU cache of served files. Files are not checked on disk again until a build finishes,
+    then files written by the build are dropped and the others are checked once by their size and mtime.
+    """
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, max_file_bytes=MAX_CACHED_FILE_BYTES):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.files = collections.OrderedDict()
+        # paths found missing, with the generation they are checked in
+        self.missing = {}
+        self.bytes = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "FileCache: %d files, %d bytes" % (len(self.files), self.bytes)
+
+    def get(self, path):
+        with self.lock:
+            cached = self.files.get(path)
+            if cached is not None:
+                self.files.move_to_end(path)
+                if cached.generation == self.generation:
+                    return cached
+            elif self.missing.get(path) == self.generation:
+                return None
+            generation = self.generation
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        if stat is None or not os.path.isfile(path):
+            self.drop(path)
+            with self.lock:
+                self.missing[path] = generation
+            return None
+        if cached is not None and cached.size == stat.st_size and cached.mtime_ns == stat.st_mtime_ns:
+            cached.generation = generation
+            return cached
+        data = None
+        if stat.st_size <= self.max_file_bytes:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) != stat.st_size:
+                # changed while reading, it is read again next time
+                return CachedFile(path, os.stat(path), None, -1)
+        cached = CachedFile(path, stat, data, generation)
+        with self.lock:
+            old = self.files.pop(path, None)
+            if old is not None and old.data is not None:
+                self.bytes -= old.size
+            self.files[path] = cached
+            if data is not None:
+                self.bytes += cached.size
+            while self.bytes > self.max_bytes and self.files:
+                evicted = self.files.popitem(last=False)[1]
+                if evicted.data is not None:
+                    self.bytes -= evicted.size
+        return cached
+
+    def drop(self, path):
+        with self.lock:
+            cached = self.files.pop(path, None)
+            if cached is not None and cached.data is not None:
+                self.bytes -= cached.size
+
+    def invalidate(self, paths=()):
+        """ Drop the paths, and check other files on disk again, called when a build finishes """
+        for path in paths:
+            self.drop(path)
+        with self.lock:
+            self.generation += 1
+            self.missing = {}
 
 class HttpHandler(SimpleHTTPRequestHandler):
-    pass
+    """ Serves build output, with keep-alive, conditional requests, byte ranges and precompressed variants """
+    protocol_version = 'HTTP/1.1'
+
+    def translate_path(self, path):
+        """ Path of a url in output dir, the process working dir is not used """
+        path = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+        trailing_slash = path.endswith('/')
+        words = [w for w in posixpath.normpath(path).split('/') if w and w not in (os.curdir, os.pardir)]
+        path = os.path.join(self.server.root, *words)
+        if trailing_slash:
+            path += '/'
+        return path
+
+    def do_GET(self):
+        if self.server.live_reload is not None and urllib.parse.urlsplit(self.path).path == LIVE_RELOAD_PATH:
+            self.serve_events(self.server.live_reload)
+            return
+        self.serve_file(head=False)
+
+    def do_HEAD(self):
+        self.serve_file(head=True)
+
+    def get_file(self, path):
+        """ File to serve, from memory output first, then from disk, and whether it is in memory """
+        memory_output = self.server.memory_output
+        if memory_output is not None:
+            memory_file = memory_output.get(path)
+            if memory_file is not None or memory_output.is_removed(path):
+                # removed in memory, the file in output dir is not served
+                return memory_file, True
+        return self.server.file_cache.get(path), False
+
+    def serve_file(self, head):
+        path = self.translate_path(self.path)
+        memory_output = self.server.memory_output
+        index_path = os.path.join(path, 'index.html')
+        is_dir = os.path.isdir(path) and not (memory_output is not None and memory_output.is_removed(path))
+        if is_dir or memory_output is not None and memory_output.get(index_path) is not None:
+            if not urllib.parse.urlsplit(self.path).path.endswith('/'):
+                self.send_redirect(urllib.parse.urlsplit(self.path).path + '/')
+                return
+            if self.get_file(index_path)[0] is None:
+                self.send_listing(path, head)
+                return
+            path = index_path
+        file_cache = self.server.file_cache
+        cached, in_memory = self.get_file(path)
+        if cached is None:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return
+        # pages get the live reload client, they are always served whole and uncompressed then
+        body = None
+        if self.server.live_reload is not None and cached.data is not None and self.guess_type(path) == 'text/html':
+            body = inject_live_reload(cached.data)
+        # precompressed variant written by precompress, ranges are always served from the original file,
+        # variants on disk are outdated for pages in memory
+        compressed = None if in_memory or body is not None else file_cache.get(path + '.gz')
+        has_variant = compressed is not None
+        if has_variant and not self.headers.get('Range') and accepts_encoding(self.headers.get('Accept-Encoding', ''), 'gzip'):
+            cached = compressed
+        else:
+            compressed = None
+        if self.is_not_modified(cached):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_file_headers(cached, has_variant)
+            self.end_headers()
+            return
+        byte_range = None
+        if compressed is None and body is None and self.headers.get('If-Range', cached.etag) == cached.etag:
+            try:
+                byte_range = parse_range(self.headers.get('Range'), cached.size)
+            except ValueError:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", "bytes */{}".format(cached.size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        first, last = byte_range or (0, (cached.size if body is None else len(body)) - 1)
+        self.send_response(HTTPStatus.PARTIAL_CONTENT if byte_range else HTTPStatus.OK)
+        self.send_header("Content-type", self.guess_type(path))
+        self.send_header("Content-Length", str(last - first + 1))
+        if byte_range:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(first, last, cached.size))
+        if compressed is not None:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_file_headers(cached, has_variant)
+        self.end_headers()
+        if head:
+            return
+        try:
+            if body is not None:
+                self.wfile.write(body)
+            else:
+                self.write_body(cached, first, last)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client is gone, e.g. video seeking
+            self.close_connection = True
+
+    def serve_events(self, live_reload):
+        """ Event stream of urls changed by builds, open until the browser leaves the page """
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        # without a length, the stream ends with the connection
+        self.close_connection = True
+        events = live_reload.subscribe()
+        try:
+            self.wfile.write(b'retry: 1000\n\n')
+            while True:
+                try:
+                    urls = events.get(timeout=LIVE_RELOAD_PING_SECONDS)
+                except queue.Empty:
+                    self.wfile.write(b': ping\n\n')
+                    continue
+                self.wfile.write('event: reload\ndata: {}\n\n'.format(json.dumps(urls)).encode('utf8'))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            live_reload.unsubscribe(events)
+
+    def send_file_headers(self, cached, has_variant):
+        self.send_header("ETag", cached.etag)
+        self.send_header("Last-Modified", self.date_time_string(cached.mtime))
+        self.send_header("Accept-Ranges", "bytes")
+        # always revalidated, so pages of a new build are seen at once
+        self.send_header("Cache-Control", "no-cache")
+        if has_variant:
+            self.send_header("Vary", "Accept-Encoding")
+
+    def is_not_modified(self, cached):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return if_none_match.strip() == '*' or cached.etag in [t.strip() for t in if_none_match.split(',')]
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            return if_modified_since == self.date_time_string(cached.mtime)
+        return False
+
+    def write_body(self, cached, first, last):
+        if cached.data is not None:
+            self.wfile.write(memoryview(cached.data)[first:last + 1])
+            return
+        with open(cached.path, 'rb') as f:
+            f.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                block = f.read(min(remaining, 1024 * 1024))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    def send_redirect(self, location):
+        self.send_response(HTTPStatus.MOVED_PERMANENTLY)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_listing(self, path, head):
+        f = self.list_directory(path)
+        if f is None:
+            return
+        try:
+            if not head:
+                shutil.copyfileobj(f, self.wfile)
+        finally:
+            f.close()
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def refresh_server_cache(site):
+    """
+    Site hook, after a build, swap in pages kept in memory, drop files written by the build from cache of the server,
+    then tell browsers which urls changed, so no page reloads while the build is running
+    """
+    changed_files = site.file_sync.pop_changed_files()
+    if site.memory_output is not None:
+        changed_files.update(site.memory_output.commit())
+    if site.server is not None:
+        site.server.file_cache.invalidate(changed_files)
+        if site.server.live_reload is not None and changed_files:
+            urls = get_changed_urls(site, changed_files)
+            logging.debug("Live reload: %s", urls)
+            site.server.live_reload.publish(urls)
 
 def serve(site):
     server_address = ('', int(site.cli_options.port) or 0)
-    httpd = HTTPServer(server_address, HttpHandler)
-    os.chdir(site.output_path)
-    print("Listening on {}:{} from {}".format(httpd.server_name, httpd.server_port, os.getcwd()))
+    httpd = ThreadedHTTPServer(server_address, HttpHandler)
+    httpd.root = site.output_path
+    httpd.file_cache = FileCache()
+    httpd.memory_output = site.memory_output
+    # only builds in watch mode change the pages
+    httpd.live_reload = LiveReload() if site.cli_options.watch and site.cli_options.live_reload else None
+    site.server = httpd
+    print("Listening on {}:{} from {}".format(httpd.server_name, httpd.server_port, httpd.root))
     httpd.serve_forever()
 
 def serve_standalone(site):
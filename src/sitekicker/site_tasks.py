@@ -1,31 +1,57 @@
 import os
 import logging
 import jinja2
+import jinja2.meta
+import jinja2.nodes
+import copy
 import json
 import time
-import collections
+import pickle
+import tempfile
 
-from .util import check_is_ignored
+import sitekicker
+from .util import check_is_ignored, get_content_hash, get_file_signature
 from .entry.entry_template import EntryTemplate
+from .entry.entry_tasks import prune_markdown_cache
 from .folder.enclosure_folder import EnclosureFolder
 from .folder.template_folder import TemplateFolder
 from .folder.asset_folder import AssetFolder
 from .folder.entry_folder import EntryFolder
+from .site_listings import build_listings
+from .site_search import start_search_index, build_search_index
+from .site_precompress import precompress_output
+from .site_server import refresh_server_cache
+from .jinja2_extensions import FragmentCache, FragmentCacheExtension
+
+# attributes of the site holding entries, pages of templates reading them are linked again when any entry changes
+SITE_ENTRY_ATTRIBUTES = ('entries', 'sorted_entries', 'grouped_entries', 'folder_entries')
 
 def register_site_tasks(site):
     site.register_site('pre-scan', start_building)
-    site.register_site('pre-scan', load_templates)
     site.register_site('pre-scan', prepare_output_path)
-    site.register_site('pre-scan', load_previous_build_snapshot)
+    site.register_site('pre-scan', load_build_cache)
+    site.register_site('pre-scan', load_templates)
     site.register_site('scan', scan_site_folders)
-    site.register_site('pre-build', convert_entry_folders)
+    site.register_site('post-scan', convert_entry_folders)
+    site.register_site('mark', mark_dirty_entries)
     site.register_site('pre-build', sort_entries_by_date)
     site.register_site('pre-build', group_entries_by_tag)
+    site.register_site('pre-build', reset_fragment_cache)
+    site.register_site('pre-build', reset_shared_images)
+    site.register_site('pre-build', start_search_index)
     site.register_site('build', build_site_entries)
+    site.register_site('post-build', build_listings)
+    site.register_site('post-build', build_search_index)
     site.register_site('post-build', end_building)
-    site.register_site('pre-summary', dump_build_snapshot)
+    site.register_site('post-build', record_entry_fingerprints)
+    site.register_site('post-build', prune_markdown_cache)
+    site.register_site('post-build', remove_unused_shared_images)
     site.register_site('pre-summary', copy_assets)
+    site.register_site('pre-summary', precompress_output)
+    # after copying and compressing, so their records are saved too
+    site.register_site('pre-summary', dump_build_cache)
     site.register_site('summary', summary)
+    site.register_site('post-summary', refresh_server_cache)
 
 def start_building(site):
     print(site)
@@ -33,52 +59,205 @@ def start_building(site):
 
 def summary(site):
     site.end_build_time = time.time()
-    print("%d seconds used to build!" % int(site.end_build_time - site.start_build_time))
+    print("%.2f seconds used to build!" % (site.end_build_time - site.start_build_time))
 
 def end_building(site):
-    # wait until all tasks are done
-    site.task_pool.close()
-    site.task_pool.join()
-
-def dump_build_snapshot(site):
-    snpashot_path = os.path.join(site.output_path, '.snapshot')
-    # manually dump to json to make the output predictable
-    with open(snpashot_path, 'wt', encoding='utf8') as sf:
-        ordered_data = collections.OrderedDict(sorted(site.snapshots.items(), key=lambda e: e[0]))
-        sf.write('{\n')
-        for k, v in ordered_data.items():
-            sf.write('  {}:{},\n'.format(json.dumps(k), json.dumps(v)))
-        sf.write('"":""')
-        sf.write('\n}')
-
-def load_previous_build_snapshot(site):
-    snpashot_path = os.path.join(site.output_path, '.snapshot')
-    if os.path.isfile(snpashot_path):
-        with open(snpashot_path, 'rt', encoding="utf8") as sf:
-            site.snapshots.clear()
-            try:
-                data = json.loads(sf.read())
-            except:
-                data = {}
-            site.snapshots.update(data)
+    # wait until all tasks and file copies are done
+    site.close_task_pool()
+    site.file_sync.wait()
+
+def load_build_cache(site):
+    site.build_cache.load()
+
+def dump_build_cache(site):
+    site.build_cache.dump()
 
 def copy_assets(site):
     for path, folder in site.folders.items():
         if isinstance(folder, AssetFolder):
-            folder.copy()
+            if site.changed_paths is None:
+                folder.copy()
+            else:
+                for changed_path in site.changed_paths:
+                    if is_same_or_sub_path(changed_path, path):
+                        folder.copy_path(changed_path)
 
-def build_site_entries(site):
-    print("{} entries found!".format(len(site.entries)))
+def get_site_fingerprint(site):
+    """ Fingerprint of site options, templates may use any of them, so all entries are dirty when it changes """
+    return get_content_hash(sitekicker.__version__, json.dumps(site.build_options, sort_keys=True, default=str))
+
+def get_entries_fingerprint(site):
+    """ Fingerprint of options of all entries, entries of templates reading entries of the site are relinked when it changes """
+    # meta tags are resolved when building entries, they are not part of the scanned data
+    entry_options = sorted(
+        (str(eid), dict((k, v) for k, v in entry.options.items() if k != 'meta_tags'))
+        for eid, entry in site.entries.items()
+    )
+    return get_content_hash(json.dumps(entry_options, sort_keys=True, default=str))
+
+def update_site_fingerprints(site):
+    """ Compute fingerprints of the site, recorded once the build is done, return whether entries changed since last build """
+    site.fingerprint = get_site_fingerprint(site)
+    site.entries_fingerprint = get_entries_fingerprint(site)
+    return site.build_cache.get('site-entries-fingerprint') != site.entries_fingerprint
+
+def mark_dirty_entries(site):
+    """
+    Compare entries with previous build, mark the ones need to be rebuilt: entries with changed sources,
+    templates or files are compiled again, entries of templates reading other entries are linked again when they change
+    """
+    entries_changed = update_site_fingerprints(site)
+    full_build = site.cli_options.full_build or site.build_cache.get('site-fingerprint') != site.fingerprint
+    for eid, entry in site.entries.items():
+        if full_build:
+            entry.dirty = True
+        else:
+            mark_entry(site, entry)
+            if not entry.dirty and entries_changed:
+                mark_entry_reading_site_entries(site, entry)
+
+def mark_entry_reading_site_entries(site, entry):
+    template = site.template_registry.get(entry.get_template_name())
+    if template and template.reads_entries:
+        # compiled html is kept when it is still in memory
+        entry.dirty = True
+        entry.relink = hasattr(entry, 'compile_output')
+
+def mark_entry(site, entry):
+    if not site.file_sync.exists(entry.output_file):
+        entry.dirty = True
+        return
+    dependencies = site.build_cache.get("{}-dependencies".format(entry.path), [])
+    previous_fingerprint = site.build_cache.get("{}-fingerprint".format(entry.path))
+    entry.dirty = previous_fingerprint != entry.fingerprint(dependencies)
+    if not entry.dirty:
+        # meta tags are resolved when compiling, keep the ones from previous build
+        entry.options['meta_tags'] = set(site.build_cache.get("{}-meta-tags".format(entry.path), []))
+        logging.debug("Entry not changed: %s", entry.path)
+
+def get_entry_template_dependencies(site, entry):
+    template = site.template_registry.get(entry.get_template_name())
+    return template.dependencies if template else []
+
+def record_entry_fingerprints(site):
     for eid, entry in site.entries.items():
-        if entry.id and entry.date:
+        if entry.dirty and entry.id and entry.date:
+            dependencies = entry.get_dependencies()
+            site.build_cache["{}-dependencies".format(entry.path)] = dependencies
+            site.build_cache["{}-fingerprint".format(entry.path)] = entry.fingerprint(dependencies)
+            site.build_cache["{}-meta-tags".format(entry.path)] = sorted(entry.options.get('meta_tags', []))
+        entry.relink = False
+    site.build_cache['site-fingerprint'] = site.fingerprint
+    site.build_cache['site-entries-fingerprint'] = site.entries_fingerprint
+    site.template_dependents = map_template_dependents(site)
+    site.build_cache['template-dependents'] = site.template_dependents
+
+def build_site_entries(site):
+    dirty_entries = [entry for entry in site.entries.values() if entry.dirty]
+    print("{} entries found, {} to build!".format(len(site.entries), len(dirty_entries)))
+    buildable_entries = [entry for entry in dirty_entries if entry.id and entry.date]
+    if not can_build_entries_in_parallel(site, buildable_entries) or not build_entries_in_parallel(site, buildable_entries):
+        for entry in buildable_entries:
+            site.check_cancelled()
             logging.debug("Building %s", entry)
-            entry.build()
+            entry.build(get_entry_hook_names(site, entry))
+
+def get_entry_hook_names(site, entry):
+    """ Entry hooks to run, an entry only relinked keeps its compiled html, compile hooks are skipped """
+    hook_names = list(site.entry_hooks.keys())
+    if entry.relink:
+        return hook_names[hook_names.index('pre-link'):]
+    return hook_names
+
+# site of current build in task pool worker, loaded from the state file written by parent process
+worker_site = None
+worker_state_path = None
+
+def can_build_entries_in_parallel(site, entries):
+    return not site.cli_options.no_parallel and site.build_options['parallel_entries'] and len(entries) >= 2
+
+def write_worker_state(site):
+    """
+    Pickle the site to a temp file once per build, workers load it before their first entry of the build,
+    None when the site could not be pickled, like entry hooks that are not module level functions
+    """
+    fd, state_path = tempfile.mkstemp(prefix='sitekicker-', suffix='.state')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # records not dumped yet are sent along, workers read the others from database
+            pickle.dump((site, site.build_cache.updates), f, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        logging.warning("Entries are built in this process, the site could not be sent to workers: %s", e)
+        os.remove(state_path)
+        return None
+    return state_path
+
+def load_worker_site(state_path):
+    global worker_site, worker_state_path
+    if state_path != worker_state_path:
+        with open(state_path, 'rb') as f:
+            site, cache_updates = pickle.load(f)
+        site.build_cache.records.update(cache_updates)
+        load_templates(site)
+        reset_fragment_cache(site)
+        worker_site, worker_state_path = site, state_path
+    return worker_site
+
+def compile_and_link_entry(task):
+    """
+    Runs in task pool worker, the entry, build cache changes, rendered fragments and profile events
+    are sent back to parent process
+    """
+    state_path, eid, hook_names = task
+    site = load_worker_site(state_path)
+    entry = site.entries[eid]
+    entry.build(hook_names)
+    profile_events = site.profiler.pop_events() if site.profiler else []
+    if site.build_options['streaming_build']:
+        # a copy is sent back, the worker does not keep content of entries it built
+        built_entry = copy.copy(entry)
+        entry.release_content()
+        entry = built_entry
+    return entry, site.build_cache.pop_updates(), site.template_env.fragment_cache.pop_rendered(), profile_events
+
+def build_entries_in_parallel(site, entries):
+    """
+    Compile and link entries in the task pool, post-link hooks still run in this process, in order.
+    Workers get the scanned site explicitly, they are not forked from this process, see get_task_pool_context
+    """
+    state_path = write_worker_state(site)
+    if state_path is None:
+        return False
+    hook_names = list(site.entry_hooks.keys())
+    split_index = hook_names.index('post-link')
+    worker_hook_names, parent_hook_names = hook_names[:split_index], hook_names[split_index:]
+    try:
+        chunk_size = max(1, len(entries) // (4 * (os.cpu_count() or 1)))
+        tasks = [(state_path, entry.id, [n for n in get_entry_hook_names(site, entry) if n in worker_hook_names]) for entry in entries]
+        # a cancelled build does not wait for the remaining entries, the task pool is terminated by run_site_hooks
+        built_entries = site.task_pool.imap(compile_and_link_entry, tasks, chunk_size)
+        for entry, (built_entry, cache_updates, fragments, profile_events) in zip(entries, built_entries):
+            site.check_cancelled()
+            logging.debug("Building %s", entry)
+            entry.adopt_build_state(built_entry)
+            site.build_cache.merge(cache_updates)
+            site.template_env.fragment_cache.merge(fragments)
+            if site.profiler:
+                site.profiler.merge(profile_events)
+            entry.build(parent_hook_names)
+    finally:
+        os.remove(state_path)
+    return True
 
 def sort_entries_by_date(site):
     valid_entries = [entry for entry in site.entries.values() if entry.id and entry.date]
     site.sorted_entries = sorted(valid_entries, reverse=True)
+    if site.build_options['streaming_build']:
+        # lists of entries only hold their records
+        site.sorted_entries = [entry.get_record() for entry in site.sorted_entries]
 
 def group_entries_by_tag(site):
+    site.grouped_entries = {}
     for entry in site.sorted_entries:
         for t in entry.options.get('tags', []):
             if t not in site.grouped_entries:
@@ -89,38 +268,47 @@ def group_entries_by_tag(site):
 def convert_entry_folders(site):
     for path, folder in site.folders.items():
         if isinstance(folder, EntryFolder):
-            folder_entries = folder.find_entries()
-            for entry in folder_entries:
-                if not entry.id:
-                    continue
-                if entry.id not in site.entries:
-                    site.entries[entry.id] = entry
-                else:
-                    raise Exception("More than one entry with id: [%s]" % entry.id)
-            site.folder_entries[path] = folder_entries
+            add_folder_entries(site, path, folder)
+
+def add_folder_entries(site, path, folder):
+    folder_entries = folder.find_entries()
+    for entry in folder_entries:
+        if not entry.id:
+            continue
+        if entry.id not in site.entries:
+            site.entries[entry.id] = entry
+        else:
+            raise Exception("More than one entry with id: [%s]" % entry.id)
+    site.folder_entries[path] = folder_entries
+
+def detect_folder(site, path):
+    logging.debug("Detecting Folder: [%s]" % path)
+    items = os.scandir(path)
+    for item in items:
+        if item.is_file() and not item.name == 'folder.yml' and not item.name.startswith('.'):
+            logging.debug("Skipping folder file: [%s]", item.path)
+        elif item.is_dir():
+            detect_sub_folder(site, item.path)
+
+def detect_sub_folder(site, path):
+    """ Detect a folder inside an enclosure folder, it could be an entry folder or a nested enclosure folder """
+    if check_is_ignored(site.build_options['ignore_dirs'], path):
+        logging.warn("User ignore folder: %s", path)
+        return
+    if os.path.basename(path).startswith('.'):
+        logging.debug("Skipping Folder: [%s]", path)
+        return
+    # entry files are read only once, found entries are kept by the entry folder
+    entry_files = EntryFolder.read_entry_files(site, path)
+    if entry_files:
+        site.folders[path] = EntryFolder(site, path, entry_files)
+        logging.debug("Found New %s", site.folders[path])
+    else:
+        site.folders[path] = EnclosureFolder(site, path)
+        logging.debug("Found New %s", site.folders[path])
+        detect_folder(site, path)
 
 def scan_site_folders(site):
-    def detect_folder(path):
-        logging.debug("Detecting Folder: [%s]" % path)
-        items = os.scandir(path)
-        for item in items:
-            if item.is_dir() and check_is_ignored(site.build_options['ignore_dirs'], item.path):
-                logging.warn("User ignore folder: %s", item.path)
-                continue
-            if item.is_file() and not item.name == 'folder.yml' and not item.name.startswith('.'):
-                logging.debug("Skipping folder file: [%s]", item.path)
-            elif not item.is_dir():
-                continue
-            elif item.name.startswith('.'):
-                logging.debug("Skipping Folder: [%s]", item.path)
-                continue
-            elif EntryFolder.is_entry_folder(item.path):
-                site.folders[item.path] = EntryFolder(site, item.path)
-                logging.debug("Found New %s", site.folders[item.path])
-            else:
-                site.folders[item.path] = EnclosureFolder(site, item.path)
-                logging.debug("Found New %s", site.folders[item.path])
-                detect_folder(item.path)
     site_dirs = os.scandir(site.working_path)
     for sdir in site_dirs:
         if check_is_ignored(site.build_options['ignore_dirs'], sdir.path):
@@ -136,7 +324,104 @@ def scan_site_folders(site):
             else:
                 site.folders[sdir.path] = EnclosureFolder(site, sdir.path)
                 logging.debug("Found New %s", site.folders[sdir.path])
-                detect_folder(sdir.path)
+                detect_folder(site, sdir.path)
+
+def is_same_or_sub_path(path, parent):
+    return path == parent or path.startswith(parent + os.sep)
+
+def find_known_folder(site, path):
+    """ Find the folder a path belongs to, None if it is outside of all scanned folders """
+    while is_same_or_sub_path(path, site.working_path) and path != site.working_path:
+        if path in site.folders:
+            return path
+        path = os.path.dirname(path)
+    return None
+
+def remove_folder(site, path):
+    """ Remove a folder, its sub folders and their entries from the scanned site """
+    for folder_path in [p for p in site.folders if is_same_or_sub_path(p, path)]:
+        del site.folders[folder_path]
+        for entry in site.folder_entries.pop(folder_path, []):
+            if site.entries.get(entry.id) is entry:
+                del site.entries[entry.id]
+
+def rescan_folder(site, path):
+    if os.path.dirname(path) == site.working_path:
+        site.folders[path] = EnclosureFolder(site, path)
+        detect_folder(site, path)
+    else:
+        detect_sub_folder(site, path)
+    for folder_path, folder in list(site.folders.items()):
+        if is_same_or_sub_path(folder_path, path) and isinstance(folder, EntryFolder):
+            add_folder_entries(site, folder_path, folder)
+
+def refresh_changed_items(site):
+    """
+    Refresh the scanned site with changed paths in watch mode, and mark the entries need to be rebuilt.
+    Return False when changes could not be handled, then a full build is needed.
+    """
+    start_building(site)
+    rescan_paths = set()
+    other_paths = set()
+    changed_templates = set()
+    for path in site.changed_paths:
+        if is_same_or_sub_path(path, site.output_path):
+            continue
+        folder_path = find_known_folder(site, path)
+        if folder_path is None:
+            return False
+        folder = site.folders[folder_path]
+        if isinstance(folder, TemplateFolder):
+            changed_templates.add(path)
+        elif isinstance(folder, AssetFolder):
+            # copied by copy_assets
+            continue
+        elif isinstance(folder, EntryFolder):
+            rescan_paths.add(folder_path)
+        elif path == folder_path or os.path.basename(path) == 'folder.yml' or os.path.dirname(path) == folder_path and path.endswith('.md'):
+            rescan_paths.add(folder_path)
+        elif os.path.dirname(path) == folder_path and not os.path.isdir(path):
+            other_paths.add(path)
+        else:
+            # a new or removed folder inside the enclosure folder
+            rescan_paths.add(os.path.join(folder_path, os.path.relpath(path, folder_path).split(os.sep)[0]))
+    for entry in site.entries.values():
+        entry.dirty = False
+        entry.relink = False
+    # remove all first, an entry may be moved from one folder to another
+    for path in rescan_paths:
+        remove_folder(site, path)
+    rescanned_entries = set()
+    for path in rescan_paths:
+        if os.path.isdir(path):
+            rescan_folder(site, path)
+            for folder_path in site.folder_entries:
+                if is_same_or_sub_path(folder_path, path):
+                    rescanned_entries.update(e.path for e in site.folder_entries[folder_path])
+    # entries rendered through changed templates, in last build, or with the reloaded templates
+    template_dependents = set()
+    for path in changed_templates:
+        template_dependents.update(site.template_dependents.get(path, []))
+    if changed_templates:
+        load_templates(site)
+    entries_changed = update_site_fingerprints(site)
+    full_build = site.build_cache.get('site-fingerprint') != site.fingerprint
+    for eid, entry in site.entries.items():
+        if full_build:
+            entry.dirty = True
+        elif entry.path in rescanned_entries:
+            mark_entry(site, entry)
+            if not entry.dirty and entries_changed:
+                mark_entry_reading_site_entries(site, entry)
+        elif entry.path in template_dependents or changed_templates and changed_templates.intersection(get_entry_template_dependencies(site, entry)):
+            # the compiled html from last build is kept, only link it again
+            entry.dirty = True
+            entry.relink = hasattr(entry, 'compile_output')
+        elif other_paths and other_paths.intersection(site.build_cache.get("{}-dependencies".format(entry.path), [])):
+            entry.dirty = True
+        elif entries_changed:
+            mark_entry_reading_site_entries(site, entry)
+    return True
 
 def prepare_output_path(site):
     if not os.path.isdir(site.output_path):
@@ -148,16 +433,16 @@ def prepare_output_path(site):
         logging.debug("Output path: [%s] is ok!", site.output_path)
 
 
-def load_templates(site):
-    template_dir = site.build_options['template_dir']
-    full_template_path = os.path.realpath(os.path.join(site.working_path, template_dir))
-    logging.debug("Scanning template dir: [%s]" % full_template_path)
-    site.template_registry = {}
+def create_template_env(site, full_template_path):
+    # compiled templates are cached in output dir, they are only compiled again when their source changes
+    bytecode_cache_path = os.path.join(site.output_path, '.jinjacache')
+    os.makedirs(bytecode_cache_path, exist_ok=True)
     env = jinja2.Environment(
         loader=jinja2.FileSystemLoader(full_template_path),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(bytecode_cache_path),
         trim_blocks=True,
         lstrip_blocks=True,
-        extensions=['jinja2.ext.i18n']
+        extensions=['jinja2.ext.i18n', FragmentCacheExtension]
     )
     env.install_null_translations()
     # Load Jinja2 Custom Filters
@@ -166,9 +451,114 @@ def load_templates(site):
     env.filters['date_to_rfc822'] = date_to_rfc822
     env.filters['date_to_iso8601'] = date_to_iso8601
     env.filters['escape_quote'] = escape_quote
+    return env
+
+def load_templates(site):
+    template_dir = site.build_options['template_dir']
+    full_template_path = os.path.realpath(os.path.join(site.working_path, template_dir))
+    logging.debug("Scanning template dir: [%s]" % full_template_path)
+    site.template_registry = {}
+    # the environment is kept between builds in watch mode, it only loads templates changed since last build
+    env_key = (full_template_path, site.output_path)
+    if site.template_env is None or site.template_env_key != env_key:
+        site.template_env = create_template_env(site, full_template_path)
+        site.template_env_key = env_key
+    env = site.template_env
     template_items = os.scandir(full_template_path)
     for it in template_items:
         if it.is_file() and not it.name.startswith('.') and it.name.endswith('.j2'):
             logging.debug("Find template [%s]@[%s]", it.name, full_template_path)
-            site.template_registry[it.name] = EntryTemplate(it.name, env.get_template(it.name))
+            dependencies, reads_entries = find_template_dependencies(site, env, it.name)
+            site.template_registry[it.name] = EntryTemplate(it.name, env.get_template(it.name), dependencies, reads_entries)
     logging.debug("%d templates are found!", len(site.template_registry))
+
+def reads_site_entries(ast):
+    """ Whether a template uses entries of the site, through site.<entries attribute>, or the site passed on as a whole """
+    safe_names = set()
+    for node in ast.find_all(jinja2.nodes.Getattr):
+        if isinstance(node.node, jinja2.nodes.Name) and node.node.name == 'site' and node.attr not in SITE_ENTRY_ATTRIBUTES:
+            safe_names.add(id(node.node))
+    return any(id(n) not in safe_names for n in ast.find_all(jinja2.nodes.Name) if n.name == 'site' and n.ctx == 'load')
+
+def get_template_record(site, env, source, filename):
+    """ Templates referenced by a template file, and whether it reads entries of the site, kept in build cache until the file changes """
+    key = "{}-template-references".format(filename)
+    signature = get_file_signature(filename)
+    record = site.build_cache.get(key)
+    if record and record['signature'] == signature and 'reads_entries' in record:
+        return record
+    ast = env.parse(source)
+    record = {
+        'signature': signature,
+        # dynamic references are None, they could not be tracked
+        'references': [r for r in jinja2.meta.find_referenced_templates(ast) if r is not None],
+        'reads_entries': reads_site_entries(ast),
+    }
+    site.build_cache[key] = record
+    return record
+
+def find_template_dependencies(site, env, name):
+    """
+    Find all template files used by a template, through extends, includes and imports,
+    and whether any of them reads entries of the site
+    """
+    dependencies = []
+    reads_entries = False
+    pending = [name]
+    while pending:
+        current = pending.pop()
+        try:
+            source, filename, uptodate = env.loader.get_source(env, current)
+        except jinja2.TemplateNotFound:
+            continue
+        if filename in dependencies:
+            continue
+        dependencies.append(filename)
+        record = get_template_record(site, env, source, filename)
+        pending.extend(record['references'])
+        reads_entries = reads_entries or record['reads_entries']
+    return dependencies, reads_entries
+
+def reset_fragment_cache(site):
+    """ Fragments of {% cache %} tags are shared by all pages in a build, see FragmentCache """
+    site.template_env.fragment_cache = FragmentCache(site, site.build_options['persistent_fragment_cache'])
+
+def reset_shared_images(site):
+    """ Shared images generated in this build, an image used by many entries is generated once """
+    site.shared_images = set()
+
+def remove_unused_shared_images(site):
+    """
+    Remove shared images no entry uses any more, and copies next to entries of images shared now.
+    Shared images of every entry are kept in build cache, entries not built in this build use the same ones.
+    """
+    used = set()
+    for entry in site.entries.values():
+        key = "{}-shared-images".format(entry.path)
+        if entry.dirty:
+            shared_images = [img for img in entry.linked_images if img.is_shared()]
+            site.build_cache[key] = [path for img in shared_images for path in img.get_output_paths(True)]
+            # links(<a href>) to an image are not rewritten, the copy next to the entry is kept for them
+            linked_paths = set(f.dest_fullpath for f in entry.linked_files)
+            for img in shared_images:
+                for path in img.get_output_paths(False):
+                    if path not in linked_paths:
+                        site.file_sync.remove(path)
+        used.update(site.build_cache.get(key, []))
+    for path in set(site.build_cache.get('shared-image-files', [])) - used:
+        logging.debug("Remove unused shared image: %s", path)
+        site.file_sync.remove(path)
+        try:
+            # folder of an image content hash, removed when it is empty
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+    site.build_cache['shared-image-files'] = sorted(used)
+
+def map_template_dependents(site):
+    """ Map every template file to the paths of entries rendered through it """
+    template_dependents = {}
+    for entry in site.entries.values():
+        for path in get_entry_template_dependencies(site, entry):
+            template_dependents.setdefault(path, []).append(entry.path)
+    return template_dependents
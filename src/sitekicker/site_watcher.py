@@ -1,29 +1,124 @@
 import time
 import os
 import logging
+import threading
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 from .site_server import serve_standalone
 
+# changes are collected until none comes in for this long, saving a file or switching a branch fires many events
+REBUILD_DELAY_SECONDS = 0.3
+
+class BuildCancelled(Exception):
+    """ A build is stopped because new changes came in, the changes are rebuilt in the next build """
+
+class RebuildScheduler:
+    """
+    Runs rebuilds on its own thread, one at a time. Changed paths are merged until no more come in for a while,
+    then rebuilt together. A build still running when new changes come in is cancelled,
+    and its paths are rebuilt with the new ones.
+    """
+    def __init__(self, site, delay=REBUILD_DELAY_SECONDS):
+        self.site = site
+        self.delay = delay
+        self.changed_paths = set()
+        self.last_change_time = 0
+        self.building = False
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="sitekicker-rebuild", daemon=True)
+
+    def __str__(self):
+        return "RebuildScheduler: %d changed paths, building: %s" % (len(self.changed_paths), self.building)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.site.cancel_build()
+            self.condition.notify()
+        self.thread.join()
+
+    def add(self, changed_paths):
+        with self.condition:
+            self.changed_paths.update(changed_paths)
+            self.last_change_time = time.monotonic()
+            if self.building:
+                self.site.cancel_build()
+            self.condition.notify()
+
+    def wait_for_changes(self):
+        """ Changed paths once no change comes in for the delay, None when stopped """
+        with self.condition:
+            while not self.stopped:
+                if not self.changed_paths:
+                    self.condition.wait()
+                    continue
+                remaining = self.last_change_time + self.delay - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                changed_paths = self.changed_paths
+                self.changed_paths = set()
+                self.building = True
+                self.site.cancel_event.clear()
+                return changed_paths
+            return None
+
+    def run(self):
+        while True:
+            changed_paths = self.wait_for_changes()
+            if changed_paths is None:
+                return
+            logging.info("Rebuild %d changed paths", len(changed_paths))
+            try:
+                self.site.rebuild(changed_paths)
+            except BuildCancelled:
+                logging.info("Rebuild cancelled, %d changed paths are rebuilt in next build", len(changed_paths))
+                with self.condition:
+                    self.changed_paths.update(changed_paths)
+            except Exception as e:
+                logging.exception("Rebuild failed: %s", e)
+            finally:
+                with self.condition:
+                    self.building = False
+
 class FsChangeHandler(FileSystemEventHandler):
-    def __init__(self, site):
+    def __init__(self, site, scheduler):
         self.site = site
+        self.scheduler = scheduler
 
     def on_any_event(self, event):
         if not event.is_directory and event.src_path.endswith('.swp'):
             return
         if event.is_directory and event.event_type=='modified':
             return
+        # files are opened when building, these events do not change anything
+        if event.event_type in ('opened', 'closed_no_write'):
+            return
+        changed_paths = [os.path.abspath(event.src_path)]
+        if getattr(event, 'dest_path', None):
+            changed_paths.append(os.path.abspath(event.dest_path))
+        # ignore changes of build output, it could be inside the site folder
+        changed_paths = [p for p in changed_paths if not (p == self.site.output_path or p.startswith(self.site.output_path + os.sep))]
+        if not changed_paths:
+            return
         logging.info("Change, DIR: %s, Type: %s, PATH: %s", event.is_directory, event.event_type, event.src_path)
-        self.site.build()
+        self.scheduler.add(changed_paths)
 
 def watch_site(site, serve_site=False):
     logging.info("Watching %s...", site)
     ob = Observer()
     serve_thread = None
-    change_handler = FsChangeHandler(site)
+    scheduler = RebuildScheduler(site)
+    scheduler.start()
+    change_handler = FsChangeHandler(site, scheduler)
+    # files in site folder, changes of sitekicker.yml will trigger a full rebuild
+    ob.schedule(change_handler, site.working_path, recursive=False)
     for item in os.scandir(site.working_path):
         if item.is_dir() and item.name[0] != '.':
             logging.info("Watching: %s", item.path)
@@ -38,3 +133,4 @@ def watch_site(site, serve_site=False):
     except KeyboardInterrupt:
         ob.stop()
     ob.join()
+    scheduler.stop()
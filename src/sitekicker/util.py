@@ -1,13 +1,21 @@
 import os
 import argparse
 import sitekicker
-import subprocess
 import re
+import hashlib
+import yaml
+
+# logging of sitekicker and its task pool workers
+LOG_FORMAT = "%(asctime)s::%(levelname)s::%(message)s"
+LOG_DATE_FORMAT = "%H:%M:%S"
 
 def resolve_path(path):
     path = os.path.expanduser(path)
     return os.path.abspath(path)
 
+# the C loader of libyaml is much faster, use it when it is available
+YamlLoader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
 def check_is_ignored(patterns, path):
     if not patterns:
         return False
@@ -16,6 +24,34 @@ def check_is_ignored(patterns, path):
             return True
     return False
 
+def get_file_signature(path):
+    """ A cheap change detector for a file, based on its size and mtime, None if the file does not exist """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+def get_file_hash(path):
+    """ sha1 of the content of a file, read in blocks """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_content_hash(*parts):
+    """ Hash of all the parts, parts could be bytes or str """
+    digest = hashlib.sha1()
+    for part in parts:
+        if part is None:
+            part = ''
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf8')
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
 def remove_list_duplicate(lst):
     """ Remove duplicate from a list, maintain original order """
     seen = set()
@@ -48,10 +84,17 @@ def parse_command_line_options(arguments):
         dest="log_level",
         help="Set log level, default is warning"
     )
-    ap.add_argument('--no-parallel', action="store_true", default=False, help="Do not use parallel image processing, this will make build slower, default is False")
+    ap.add_argument('--no-parallel', action="store_true", default=False, help="Do not use parallel entry building and image processing, this will make build slower, default is False")
     ap.add_argument('--serve', '-s', action="store_true", default=False, help="Serve the built contents with a local server for preview, default is False")
+    ap.add_argument('--memory-output', action="store_true", default=False, dest="memory_output", help="Keep written pages in memory and serve them from there, instead of writing them to output dir, only with --serve, default is False")
+    ap.add_argument('--flush-output', action="store_true", default=False, dest="flush_output", help="Also write pages kept in memory to output dir, with --memory-output, default is False")
+    ap.add_argument('--no-live-reload', action="store_false", default=True, dest="live_reload", help="Do not reload pages in the browser when a build in watch mode changes them, with --serve")
     ap.add_argument('--watch', '-w', action="store_true", default=False, help="Watch for changes and rebuild, default is False")
     ap.add_argument('--full-build', '-f', action="store_true", default=False, help="Build everything from scratch, ignore all caches, it would slow down the build, default is False")
+    ap.add_argument('--profile', action="store_true", default=False, help="Time every build phase, entry and task, write a Chrome trace and print the slowest entries, default is False")
+    ap.add_argument('--profile-output', default="sitekicker-trace.json", dest="profile_output", help="File to write the Chrome trace of profile mode")
+    ap.add_argument('--profile-memory', action="store_true", default=False, dest="profile_memory", help="Also trace peak memory of each build phase in profile mode, it slows down the build, default is False")
+    ap.add_argument('--profile-top', type=int, default=20, dest="profile_top", help="Number of slowest entries to report in profile mode")
     ap.add_argument('--version', '-V', action="version", version=sitekicker.__version__, help="Show version number")
     ap.add_argument('--port', '-p', default="8000", help="Default port for the local preview server to listen")
     ap.add_argument('--output-dir', '-o', default="", help="Directory to write build output")
@@ -70,12 +113,26 @@ def get_default_site_options():
         'content_dirs': [],
         'ignore_dirs': [],
         'copy_hidden': False,
+        'copy_method': 'copy',
+        'copy_check_hash': False,
+        'copy_threads': 8,
+        'parallel_entries': True,
+        'streaming_build': False,
+        'listings': [],
+        'persistent_fragment_cache': False,
+        'precompress': False,
+        'precompress_extensions': ['.html', '.css', '.js', '.svg', '.xml', '.json'],
+        'search_index': False,
+        'search_index_dir': 'search',
+        'listing_page_size': 10,
         'responsive_images': False,
+        'dedupe_images': False,
         'responsive_image_sizes': [500, 1000, 1500],
         'image_placeholder_size': 48,
         'image_placeholder_quality': 15,
         'maximum_image_width': '1500',
         'compress_image': True,
+        'image_engine': 'pillow',
         'compress_image_quality': 80
     })
 
@@ -100,6 +157,9 @@ class dotdict(dict):
                     self[k] = v
 
     def __getattr__(self, attr):
+        if attr.startswith('__'):
+            # special methods are not options, pickle and copy look them up
+            raise AttributeError(attr)
         return self.get(attr)
 
     def __setattr__(self, key, value):
@@ -119,11 +179,3 @@ class dotdict(dict):
     def update(self, *args, **kwargs):
         super(dotdict, self).update(*args, **kwargs)
         self._set_from_args(args, kwargs)
-
-def get_image_size(src):
-    im_raw_size = subprocess.check_output(['identify', src])
-    im_raw_size_match = re.search(r'\s(\d+)x(\d+)\s', im_raw_size.decode('utf8') if im_raw_size else '')
-    if im_raw_size_match:
-        return int(im_raw_size_match.group(1)), int(im_raw_size_match.group(2))
-    else:
-        return 0, 0
@@ -0,0 +1,25 @@
+import os
+import sys
+import shutil
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+EXAMPLE_SITE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples', 'simple-site')
+
+@pytest.fixture
+def example_site_path(tmp_path):
+    """ A copy of the example site, it could be changed by tests """
+    site_path = str(tmp_path / 'site')
+    shutil.copytree(EXAMPLE_SITE_PATH, site_path)
+    return site_path
+
+@pytest.fixture
+def make_site(example_site_path, tmp_path):
+    """ Create a site of the example site copy, output to a temp dir """
+    from sitekicker.site import Site
+    from sitekicker.util import parse_command_line_options
+    def make_site(*arguments):
+        return Site(parse_command_line_options(list(arguments) + ['-o', str(tmp_path / 'output'), example_site_path]))
+    return make_site
@@ -0,0 +1,69 @@
+import datetime
+
+import pytest
+
+from sitekicker.entry.entry import read_entry_file, encode_front_matter, decode_front_matter
+
+class FakeSite:
+    def __init__(self):
+        self.build_cache = {}
+
+ENTRY_TEXT = """---
+id: hello
+title: Hello
+date: 2020-01-02
+updated: 2020-01-02 03:04:05
+tags: [a, b]
+cover: {path: cover.jpg, size: [1, 2]}
+---
+Content
+"""
+
+def write_entry(tmp_path, text):
+    path = tmp_path / 'index.md'
+    path.write_text(text, encoding='utf8')
+    return str(path)
+
+def test_front_matter_round_trip():
+    options = {'date': datetime.date(2020, 1, 2), 'updated': datetime.datetime(2020, 1, 2, 3, 4, 5, 6), 'tags': ['a'], 'n': 1.5, 'x': None}
+    assert decode_front_matter(encode_front_matter(options)) == options
+
+@pytest.mark.parametrize('value', [(1, 2), {1: 'a'}, datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc)])
+def test_unsupported_front_matter(value):
+    with pytest.raises(TypeError):
+        encode_front_matter({'value': value})
+
+def test_indexed_front_matter_is_the_same_as_parsed(tmp_path):
+    site = FakeSite()
+    path = write_entry(tmp_path, ENTRY_TEXT)
+    parsed = read_entry_file(site, path)
+    assert parsed[0]['date'] == datetime.date(2020, 1, 2)
+    assert parsed[0]['updated'] == datetime.datetime(2020, 1, 2, 3, 4, 5)
+    assert parsed[1] == 'Content\n'
+    record = site.build_cache[path + '-front-matter']
+    assert isinstance(record['options'], dict)
+    assert read_entry_file(site, path) == parsed
+
+def test_front_matter_json_could_not_keep_is_parsed_again(tmp_path):
+    site = FakeSite()
+    path = write_entry(tmp_path, "---\nid: hello\ntitle: Hello\nsize: !!python/tuple [1, 2]\n---\nContent\n")
+    parsed = read_entry_file(site, path)
+    assert parsed[0]['size'] == (1, 2)
+    assert 'options' not in site.build_cache[path + '-front-matter']
+    assert read_entry_file(site, path) == parsed
+
+def test_streaming_build_records_keep_all_options(make_site, example_site_path):
+    with open(example_site_path + '/sitekicker.yml', 'at', encoding='utf8') as f:
+        f.write('\nstreaming_build: true\n')
+    path = example_site_path + '/articles/hello/hello.md'
+    with open(path, 'rt', encoding='utf8') as f:
+        text = f.read()
+    with open(path, 'wt', encoding='utf8') as f:
+        f.write(text.replace('title: Hello SiteKicker', 'title: Hello SiteKicker\ndescription: A custom field', 1))
+    site = make_site('--no-parallel')
+    site.build()
+    record = next(e for e in site.sorted_entries if e.id == 'hello')
+    assert not hasattr(record, '__dict__')
+    assert record.options['description'] == 'A custom field'
+    assert record.options['title'] == record.title == 'Hello SiteKicker'
+    assert site.entries['hello'].raw_content is None
@@ -0,0 +1,136 @@
+import pytest
+
+from sitekicker.entry import entry_image
+from sitekicker.entry.entry_image import pillow_resize_images, process_image
+
+Image = pytest.importorskip('PIL.Image')
+
+def test_multi_frame_mpo_photos_are_resized(tmp_path):
+    src, dest = str(tmp_path / 'photo.jpg'), str(tmp_path / 'photo-100px.jpg')
+    Image.new('RGB', (200, 100), 'red').save(src, 'MPO', save_all=True, append_images=[Image.new('RGB', (200, 100), 'blue')])
+    pillow_resize_images(src, [(dest, 100, 80)])
+    with Image.open(dest) as im:
+        assert (im.format, im.size) == ('JPEG', (100, 50))
+
+def test_animated_gifs_are_copied(tmp_path):
+    src, dest = str(tmp_path / 'anim.gif'), str(tmp_path / 'anim-100px.gif')
+    frames = [Image.new('RGB', (200, 100), color) for color in ('red', 'green', 'blue')]
+    frames[0].save(src, 'GIF', save_all=True, append_images=frames[1:])
+    pillow_resize_images(src, [(dest, 100, 80)])
+    with open(src, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
+
+def test_images_are_copied_without_any_engine(tmp_path, monkeypatch):
+    monkeypatch.setattr(entry_image, 'Image', None)
+    monkeypatch.setattr(entry_image.shutil, 'which', lambda name: None)
+    entry_image.get_image_engine.cache_clear()
+    try:
+        src, dest = str(tmp_path / 'photo.png'), str(tmp_path / 'photo-100px.png')
+        Image.new('RGB', (200, 100), 'red').save(src, 'PNG')
+        process_image(src, [(dest, 100, 80)])
+        with open(src, 'rb') as a, open(dest, 'rb') as b:
+            assert a.read() == b.read()
+    finally:
+        entry_image.get_image_engine.cache_clear()
+
+def add_image(site_path, entry_name, color):
+    entry_dir = '{}/articles/{}'.format(site_path, entry_name)
+    Image.new('RGB', (200, 100), color).save(entry_dir + '/photo.png', 'PNG')
+    with open('{}/{}.md'.format(entry_dir, entry_name), 'at', encoding='utf8') as f:
+        f.write('\n![photo](photo.png)\n')
+
+def set_site_option(site_path, line):
+    with open(site_path + '/sitekicker.yml', 'at', encoding='utf8') as f:
+        f.write('\n' + line + '\n')
+
+def list_output_images(site):
+    import os
+    return sorted(os.path.relpath(os.path.join(root, name), site.output_path)
+                  for root, dirs, files in os.walk(site.output_path) for name in files if name.endswith('.png'))
+
+def test_shared_images_are_written_once(make_site, example_site_path):
+    set_site_option(example_site_path, 'dedupe_images: true')
+    add_image(example_site_path, 'hello', 'red')
+    add_image(example_site_path, 'code', 'red')
+    site = make_site('--no-parallel')
+    site.build()
+    images = list_output_images(site)
+    assert len(images) == 1 and images[0].startswith('_img/')
+    with open(site.output_path + '/hello/index.html', 'rt', encoding='utf8') as f:
+        assert '/' + images[0] in f.read()
+
+def test_unused_shared_images_are_removed(make_site, example_site_path):
+    set_site_option(example_site_path, 'dedupe_images: true')
+    add_image(example_site_path, 'hello', 'red')
+    add_image(example_site_path, 'code', 'red')
+    site = make_site('--no-parallel')
+    site.build()
+    old_images = list_output_images(site)
+    for name in ('hello', 'code'):
+        Image.new('RGB', (200, 100), 'blue').save('{}/articles/{}/photo.png'.format(example_site_path, name), 'PNG')
+    site = make_site('--no-parallel')
+    site.build()
+    images = list_output_images(site)
+    assert len(images) == 1 and images != old_images
+    import os
+    # the folder of the old image content is removed too
+    assert not os.path.exists(os.path.join(site.output_path, os.path.dirname(old_images[0])))
+
+def test_entry_copies_are_removed_when_images_are_shared(make_site, example_site_path):
+    set_site_option(example_site_path, 'responsive_images: true')
+    add_image(example_site_path, 'hello', 'red')
+    site = make_site('--no-parallel')
+    site.build()
+    assert all(path.startswith('hello/') for path in list_output_images(site))
+    set_site_option(example_site_path, 'dedupe_images: true')
+    site = make_site('--no-parallel')
+    site.build()
+    images = list_output_images(site)
+    assert images and all(path.startswith('_img/') for path in images)
+
+def test_copies_of_shared_images_are_kept_for_links(make_site, example_site_path):
+    set_site_option(example_site_path, 'dedupe_images: true')
+    add_image(example_site_path, 'hello', 'red')
+    with open(example_site_path + '/articles/hello/hello.md', 'at', encoding='utf8') as f:
+        f.write('\n[![full size](photo.png)](photo.png)\n')
+    site = make_site('--no-parallel')
+    site.build()
+    images = list_output_images(site)
+    assert 'hello/photo.png' in images
+    assert len([path for path in images if path.startswith('_img/')]) == 1
+    with open(site.output_path + '/hello/index.html', 'rt', encoding='utf8') as f:
+        assert 'href="photo.png"' in f.read()
+
+def test_shared_images_are_cached_for_any_copy_of_the_image(tmp_path):
+    import os
+    src, copy, dest = str(tmp_path / 'a.png'), str(tmp_path / 'b.png'), str(tmp_path / 'shared.png')
+    Image.new('RGB', (20, 10), 'red').save(src, 'PNG')
+    Image.new('RGB', (20, 10), 'red').save(copy, 'PNG')
+    caches = {}
+    process_image(src, [(dest, 10, 80)], caches, shared=True)
+    mtime = os.path.getmtime(dest)
+    assert entry_image.is_image_cached(copy, dest, 10, 80, caches, shared=True)
+    assert not entry_image.is_image_cached(copy, dest, 10, 80, caches)
+    assert not entry_image.is_image_cached(copy, dest, 20, 80, caches, shared=True)
+    process_image(copy, [(dest, 10, 80)], caches, shared=True)
+    assert os.path.getmtime(dest) == mtime
+
+@pytest.mark.parametrize('arguments', [(), ('--no-parallel',)])
+def test_processed_images_are_changed_files(make_site, example_site_path, arguments):
+    import os
+    set_site_option(example_site_path, 'responsive_images: true')
+    add_image(example_site_path, 'hello', 'red')
+    def build():
+        site = make_site(*arguments)
+        changed_files = set()
+        # before refresh_server_cache pops them
+        site.register_site('pre-summary', lambda site: changed_files.update(site.file_sync.changed_files))
+        site.build()
+        return site, set(os.path.relpath(p, site.output_path) for p in changed_files if p.endswith('.png'))
+    site, changed_images = build()
+    assert changed_images and changed_images == set(list_output_images(site))
+    site, changed_images = build()
+    assert changed_images == set()
+    Image.new('RGB', (200, 100), 'blue').save(example_site_path + '/articles/hello/photo.png', 'PNG')
+    site, changed_images = build()
+    assert changed_images == set(list_output_images(site))
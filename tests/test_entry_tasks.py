@@ -0,0 +1,61 @@
+import os
+
+def list_markdown_cache(site):
+    cache_dir = os.path.join(site.output_path, '.markdowncache')
+    return sorted(name for root, dirs, files in os.walk(cache_dir) for name in files)
+
+def test_markdown_cache_only_keeps_html_of_current_content(make_site, example_site_path):
+    site = make_site('--no-parallel')
+    site.build()
+    cached = list_markdown_cache(site)
+    assert len(cached) == len([e for e in site.entries.values() if e.id and e.date])
+    path = os.path.join(example_site_path, 'articles', 'hello', 'hello.md')
+    for i in range(3):
+        with open(path, 'at', encoding='utf8') as f:
+            f.write('\nOne more line.\n')
+        site.rebuild([path])
+    assert len(list_markdown_cache(site)) == len(cached)
+
+def process_html(site, compile_output):
+    from sitekicker.entry.entry_tasks import process_compiled_html
+    entry = next(e for e in site.entries.values() if e.id == 'hello')
+    entry.compile_output = compile_output
+    process_compiled_html(entry)
+    return entry
+
+def test_compiled_html_finds_math_and_code_inside_links(make_site):
+    site = make_site('--no-parallel')
+    site.build()
+    entry = process_html(site, '<p><a href="https://a.b/">\\(x^2\\)</a></p>')
+    assert entry.options['meta_tags'] == {'math'}
+    entry = process_html(site, '<p><a href="https://a.b/"><code>x</code></a></p>')
+    assert entry.options['meta_tags'] == {'code'}
+    entry = process_html(site, '<p>\\(x<sup>2</sup>\\)</p>')
+    assert entry.options['meta_tags'] == {'math'}
+
+def test_compiled_html_collects_links_with_nested_tags(make_site):
+    site = make_site('--no-parallel')
+    site.build()
+    entry = process_html(site, '<p>get <a href="5k_1024.jpg">the <em>big</em> photo</a></p>')
+    assert [(f.title, f.name) for f in entry.linked_files] == [('the big photo', '5k_1024.jpg')]
+
+def test_compiled_html_only_rewrites_img_tags(make_site):
+    site = make_site('--no-parallel')
+    site.build()
+    site.build_options['responsive_images'] = True
+    source = '<p title="a &amp; b">x &lt; y</p>\n<p>\n<img alt="A" src="5k_1024.jpg"/> <img src="//a.b/c.png">\n</p>'
+    entry = process_html(site, source)
+    assert [img.name for img in entry.linked_images] == ['5k_1024.jpg']
+    assert entry.external_images == ['//a.b/c.png']
+    assert entry.compile_output.startswith('<p title="a &amp; b">x &lt; y</p>\n<p>\n<img ')
+    assert 'data-src="//a.b/c.png" class="lazyload"' in entry.compile_output
+    assert entry.compile_output.endswith(' />\n</p>')
+    assert {'image', 'lazyload-image'} <= entry.options['meta_tags']
+
+def test_compiled_html_with_other_line_breaks(make_site):
+    site = make_site('--no-parallel')
+    site.build()
+    site.build_options['responsive_images'] = True
+    source = '<p>page\x0cbreak line\x85</p>\n<p> <img src="//a.b/c.png"> after</p>'
+    entry = process_html(site, source)
+    assert entry.compile_output == '<p>page\x0cbreak line\x85</p>\n<p> <img data-src="//a.b/c.png" class="lazyload" /> after</p>'
@@ -0,0 +1,200 @@
+import os
+import pytest
+
+from sitekicker.build_cache import BuildCache
+from sitekicker.file_sync import FileSync
+from sitekicker.util import get_file_signature
+from sitekicker.memory_output import MemoryOutput
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wt', encoding='utf8') as f:
+        f.write(content)
+
+def list_files(folder):
+    return sorted(os.path.relpath(os.path.join(root, name), folder) for root, dirs, files in os.walk(folder) for name in files)
+
+def test_memory_output_leaves_output_dir_as_it_is(tmp_path):
+    src, out = str(tmp_path / 'src'), str(tmp_path / 'out')
+    write(os.path.join(src, 'a.css'), 'a')
+    write(os.path.join(src, 'b.css'), 'b')
+    FileSync().sync_tree(src, os.path.join(out, 'assets'))
+    write(os.path.join(out, 'old', 'index.html'), 'old')
+    before = list_files(out)
+    memory_output = MemoryOutput()
+    file_sync = FileSync(memory_output=memory_output)
+    write(os.path.join(src, 'a.css'), 'a2')
+    os.remove(os.path.join(src, 'b.css'))
+    write(os.path.join(src, 'c.css'), 'c')
+    assert file_sync.sync_tree(src, os.path.join(out, 'assets')) == (2, 1)
+    file_sync.write_file(os.path.join(out, 'new', 'index.html'), 'new')
+    file_sync.remove(os.path.join(out, 'old'))
+    memory_output.commit()
+    assert list_files(out) == before
+    with open(os.path.join(out, 'assets', 'a.css'), 'rt', encoding='utf8') as f:
+        assert f.read() == 'a'
+    assert memory_output.get(os.path.join(out, 'assets', 'a.css')).data == b'a2'
+    assert memory_output.get(os.path.join(out, 'assets', 'c.css')).data == b'c'
+    assert memory_output.is_removed(os.path.join(out, 'assets', 'b.css'))
+    assert memory_output.is_removed(os.path.join(out, 'old', 'index.html'))
+    assert not file_sync.exists(os.path.join(out, 'assets', 'b.css'))
+    # nothing changed, nothing is copied or removed again
+    file_sync.pop_changed_files()
+    assert file_sync.sync_tree(src, os.path.join(out, 'assets')) == (0, 0)
+    assert file_sync.pop_changed_files() == set()
+    # a file copied to memory only is removed from memory when its source is gone
+    os.remove(os.path.join(src, 'c.css'))
+    assert file_sync.sync_tree(src, os.path.join(out, 'assets')) == (0, 1)
+    assert memory_output.lookup(os.path.join(out, 'assets', 'c.css')) is None
+
+def test_flushed_memory_output_changes_output_dir_too(tmp_path):
+    src, out = str(tmp_path / 'src'), str(tmp_path / 'out')
+    write(os.path.join(src, 'a.css'), 'a')
+    memory_output = MemoryOutput()
+    file_sync = FileSync(memory_output=memory_output, flush=True)
+    file_sync.sync_tree(src, os.path.join(out, 'assets'))
+    file_sync.write_file(os.path.join(out, 'index.html'), 'page')
+    assert list_files(out) == ['assets/a.css', 'index.html']
+    file_sync.remove(os.path.join(out, 'index.html'))
+    assert list_files(out) == ['assets/a.css']
+
+def test_stale_files_are_removed_when_their_sources_are_deleted(tmp_path):
+    src, dest = str(tmp_path / 'src'), str(tmp_path / 'out' / 'assets')
+    write(os.path.join(src, 'a.css'), 'a')
+    write(os.path.join(src, 'js', 'b.js'), 'b')
+    file_sync = FileSync()
+    assert file_sync.sync_tree(src, dest) == (2, 0)
+    assert list_files(dest) == ['a.css', 'js/b.js']
+    os.remove(os.path.join(src, 'js', 'b.js'))
+    os.rmdir(os.path.join(src, 'js'))
+    file_sync.pop_changed_files()
+    assert file_sync.sync_tree(src, dest) == (0, 2)
+    assert list_files(dest) == ['a.css']
+    assert not os.path.exists(os.path.join(dest, 'js'))
+    assert file_sync.pop_changed_files() == {os.path.join(dest, 'js', 'b.js'), os.path.join(dest, 'js')}
+
+def test_unchanged_files_are_not_copied_again(tmp_path):
+    src, dest = str(tmp_path / 'src'), str(tmp_path / 'out')
+    write(os.path.join(src, 'a.css'), 'a')
+    file_sync = FileSync()
+    file_sync.sync_tree(src, dest)
+    before = os.stat(os.path.join(dest, 'a.css'))
+    file_sync.pop_changed_files()
+    assert file_sync.sync_tree(src, dest) == (0, 0)
+    after = os.stat(os.path.join(dest, 'a.css'))
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+    assert file_sync.pop_changed_files() == set()
+
+def test_copies_with_same_content_are_kept_with_check_hash(tmp_path):
+    src, dest = str(tmp_path / 'a.css'), str(tmp_path / 'out' / 'a.css')
+    write(src, 'a')
+    write(dest, 'a')
+    os.utime(dest, ns=(0, 0))
+    inode = os.stat(dest).st_ino
+    assert not FileSync(check_hash=True).copy_file(src, dest)
+    assert os.stat(dest).st_ino == inode
+    assert os.stat(dest).st_mtime_ns == os.stat(src).st_mtime_ns
+    # without check_hash, a different mtime means a new copy
+    os.utime(dest, ns=(0, 0))
+    assert FileSync().copy_file(src, dest)
+
+def test_hardlinks_fall_back_to_copy(tmp_path, monkeypatch):
+    src, dest = str(tmp_path / 'a.css'), str(tmp_path / 'out' / 'a.css')
+    write(src, 'a')
+    file_sync = FileSync('hardlink')
+    assert file_sync.copy_file(src, dest)
+    assert os.path.samefile(src, dest)
+    def link(src, dest):
+        raise OSError(18, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'link', link)
+    # source on another file system
+    dest = str(tmp_path / 'out' / 'b.css')
+    assert file_sync.copy_file(src, dest)
+    assert not os.path.samefile(src, dest)
+    with open(dest, 'rt', encoding='utf8') as f:
+        assert f.read() == 'a'
+    assert os.stat(dest).st_mtime_ns == os.stat(src).st_mtime_ns
+
+def test_reflinks_fall_back_to_copy(tmp_path, monkeypatch):
+    import sitekicker.file_sync as file_sync_module
+    src, dest = str(tmp_path / 'a.css'), str(tmp_path / 'out' / 'a.css')
+    write(src, 'a' * 100000)
+    def ioctl(*args):
+        raise OSError(95, 'Operation not supported')
+    if file_sync_module.fcntl is not None:
+        monkeypatch.setattr(file_sync_module.fcntl, 'ioctl', ioctl)
+    monkeypatch.setattr(file_sync_module, 'copy_in_kernel', lambda sf, df, size: False)
+    assert FileSync('reflink').copy_file(src, dest)
+    with open(dest, 'rt', encoding='utf8') as f:
+        assert f.read() == 'a' * 100000
+    assert os.stat(dest).st_mtime_ns == os.stat(src).st_mtime_ns
+
+def test_manifest_is_kept_in_build_cache(tmp_path, monkeypatch):
+    import sitekicker.file_sync as file_sync_module
+    dest = str(tmp_path / 'out' / 'index.html')
+    cache_path = str(tmp_path / 'out' / '.buildcache')
+    build_cache = BuildCache(cache_path)
+    assert FileSync(manifest=build_cache).write_file(dest, 'page')
+    build_cache.dump()
+    record = BuildCache(cache_path).get("{}-output".format(dest))
+    assert record['signature'] == get_file_signature(dest)
+    # next build knows the hash of output from manifest, without reading the file
+    def get_file_hash(path):
+        raise AssertionError("output file is read: {}".format(path))
+    monkeypatch.setattr(file_sync_module, 'get_file_hash', get_file_hash)
+    file_sync = FileSync(manifest=BuildCache(cache_path))
+    assert not file_sync.write_file(dest, 'page')
+    assert file_sync.write_file(dest, 'changed')
+    # output changed by others is read again
+    monkeypatch.undo()
+    write(dest, 'edited')
+    assert FileSync(manifest=file_sync.manifest).write_file(dest, 'changed')
+
+def test_files_are_written_to_temp_file_and_renamed(tmp_path, monkeypatch):
+    dest = str(tmp_path / 'out' / 'index.html')
+    write(dest, 'old')
+    replaced = []
+    replace = os.replace
+    def replace_and_check(src, dst):
+        # dest is not touched before the temp file is complete
+        with open(dst, 'rt', encoding='utf8') as f:
+            assert f.read() == 'old'
+        with open(src, 'rt', encoding='utf8') as f:
+            assert f.read() == 'new'
+        replaced.append((src, dst))
+        replace(src, dst)
+    monkeypatch.setattr(os, 'replace', replace_and_check)
+    assert FileSync().write_file(dest, 'new')
+    assert len(replaced) == 1
+    assert os.path.dirname(replaced[0][0]) == os.path.dirname(dest) and replaced[0][1] == dest
+    with open(dest, 'rt', encoding='utf8') as f:
+        assert f.read() == 'new'
+    assert list_files(str(tmp_path / 'out')) == ['index.html']
+
+def test_failed_writes_leave_no_partial_files(tmp_path, monkeypatch):
+    dest = str(tmp_path / 'out' / 'index.html')
+    write(dest, 'old')
+    def replace(src, dst):
+        raise OSError(28, 'No space left on device')
+    monkeypatch.setattr(os, 'replace', replace)
+    file_sync = FileSync()
+    with pytest.raises(OSError):
+        file_sync.write_file(dest, 'new')
+    with pytest.raises(OSError):
+        file_sync.write_file(str(tmp_path / 'out' / 'new.html'), 'new')
+    assert list_files(str(tmp_path / 'out')) == ['index.html']
+    with open(dest, 'rt', encoding='utf8') as f:
+        assert f.read() == 'old'
+    assert file_sync.pop_changed_files() == set()
+
+def test_same_content_is_not_written_again(tmp_path):
+    dest = str(tmp_path / 'out' / 'index.html')
+    file_sync = FileSync(manifest={})
+    assert file_sync.write_file(dest, 'page')
+    before = os.stat(dest)
+    file_sync.pop_changed_files()
+    assert not file_sync.write_file(dest, b'page')
+    assert not FileSync().write_file(dest, 'page')
+    after = os.stat(dest)
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+    assert file_sync.pop_changed_files() == set()
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from sitekicker.build_cache import BuildCache
+from sitekicker.image_index import ImageIndex, read_image_size
+
+Image = pytest.importorskip('PIL.Image')
+
+SIZE = (301, 157)
+
+def save_image(tmp_path, name, mode='RGB', **params):
+    path = str(tmp_path / name)
+    Image.new(mode, SIZE, 'red').save(path, **params)
+    return path
+
+@pytest.mark.parametrize('name, mode, params', [
+    ('a.png', 'RGB', {}),
+    ('a.gif', 'P', {}),
+    ('a.jpg', 'RGB', {}),
+    ('progressive.jpg', 'RGB', {'progressive': True}),
+    ('exif.jpg', 'RGB', {'exif': b'Exif\x00\x00' + b'\x00' * 64, 'icc_profile': b'\x00' * 300}),
+    ('grey.jpg', 'L', {}),
+])
+def test_size_of_png_gif_and_jpeg(tmp_path, name, mode, params):
+    assert read_image_size(save_image(tmp_path, name, mode, **params)) == SIZE
+
+@pytest.mark.parametrize('name, mode, params, chunk', [
+    ('lossy.webp', 'RGB', {'quality': 80}, b'VP8 '),
+    ('lossless.webp', 'RGB', {'lossless': True}, b'VP8L'),
+    ('exif.webp', 'RGB', {'quality': 80, 'exif': b'Exif\x00\x00' + b'\x00' * 64}, b'VP8X'),
+])
+def test_size_of_webp(tmp_path, name, mode, params, chunk):
+    path = save_image(tmp_path, name, mode, **params)
+    with open(path, 'rb') as f:
+        assert f.read(16)[12:16] == chunk
+    assert read_image_size(path) == SIZE
+
+def test_unknown_and_truncated_images(tmp_path):
+    assert read_image_size(save_image(tmp_path, 'a.bmp')) is None
+    path = save_image(tmp_path, 'a.jpg')
+    with open(path, 'rb') as f:
+        head = f.read(20)
+    with open(path, 'wb') as f:
+        f.write(head)
+    assert read_image_size(path) is None
+
+def test_images_are_probed_again_only_when_changed(tmp_path):
+    path = save_image(tmp_path, 'a.png')
+    index = ImageIndex(BuildCache(str(tmp_path / '.buildcache')))
+    record = index.lookup(path)
+    assert index.get_size(path) == SIZE
+    index.cache.dump()
+    index = ImageIndex(BuildCache(str(tmp_path / '.buildcache')))
+    assert index.lookup(path) == record
+    Image.new('RGB', (10, 20), 'blue').save(path)
+    os.utime(path, ns=(record['mtime'] + 1000, record['mtime'] + 1000))
+    assert index.get_size(path) == (10, 20)
+    assert index.get_hash(path) != record['hash']
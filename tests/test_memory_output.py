@@ -0,0 +1,51 @@
+import os
+import pickle
+
+from sitekicker.memory_output import MemoryOutput
+
+def test_staged_files_are_seen_after_commit():
+    output = MemoryOutput()
+    output.write('/out/a/index.html', b'a')
+    assert output.get('/out/a/index.html') is None
+    assert output.lookup('/out/a/./index.html').data == b'a'
+    assert output.commit() == {os.path.normpath('/out/a/index.html')}
+    assert output.get('/out/a//index.html').data == b'a'
+    assert output.commit() == set()
+
+def test_committed_files_are_kept_until_changes_are_committed():
+    output = MemoryOutput()
+    output.write('/out/a/index.html', b'a')
+    output.write('/out/a/b.css', b'b')
+    output.write('/out/ab.html', b'ab')
+    output.commit()
+    files = output.files
+    output.write('/out/a/index.html', b'a2')
+    output.remove('/out/a')
+    assert output.lookup('/out/a/b.css') is None
+    assert output.is_known('/out/a/b.css')
+    assert output.get('/out/a/index.html').data == b'a'
+    assert output.commit() == {os.path.normpath(p) for p in ('/out/a', '/out/a/index.html', '/out/a/b.css')}
+    # the server sees a new dict, the one it holds is not changed
+    assert sorted(files) == [os.path.normpath(p) for p in ('/out/a/b.css', '/out/a/index.html', '/out/ab.html')]
+    assert output.get('/out/ab.html').data == b'ab'
+    assert output.get('/out/a/b.css') is None and output.is_removed('/out/a/b.css')
+
+def test_removed_folders_hide_files_on_disk():
+    output = MemoryOutput()
+    output.remove('/out/a')
+    output.commit()
+    assert output.is_removed('/out/a/b/c.css')
+    assert not output.is_removed('/out/ab.html')
+    output.write('/out/a/b/index.html', b'new')
+    assert output.lookup('/out/a/b/index.html').data == b'new'
+    assert output.lookup('/out/a/b/c.css') is None and output.is_known('/out/a/b/c.css')
+    output.commit()
+    assert output.get('/out/a/b/index.html').data == b'new'
+    assert output.list_files('/out/a') == [os.path.normpath('/out/a/b/index.html')]
+
+def test_worker_processes_get_an_empty_output():
+    output = MemoryOutput()
+    output.write('/out/a.html', b'a')
+    output.commit()
+    copied = pickle.loads(pickle.dumps(output))
+    assert copied.files == {} and copied.staged == {}
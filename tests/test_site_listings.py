@@ -0,0 +1,46 @@
+import types
+import logging
+import datetime
+
+from sitekicker.site_listings import get_listing_keys, group_listing_entries, paginate
+
+def make_entry(eid, date, **options):
+    return types.SimpleNamespace(id=eid, date=date, options=options)
+
+def test_listing_keys_of_dates():
+    entry = make_entry('a', datetime.date(2017, 8, 22))
+    assert get_listing_keys('year', entry) == ['2017']
+    assert get_listing_keys('month', entry) == ['2017/08']
+    entry = make_entry('b', datetime.datetime(2017, 12, 1, 10, 30))
+    assert get_listing_keys('month', entry) == ['2017/12']
+
+def test_entries_with_quoted_dates_are_not_listed_by_month(caplog):
+    site = types.SimpleNamespace(sorted_entries=[
+        make_entry('a', datetime.date(2017, 8, 22), tags=['x']),
+        make_entry('b', '2017-08-21', tags=['x']),
+    ])
+    with caplog.at_level(logging.WARNING):
+        groups = group_listing_entries(site, {'type': 'month'})
+    assert [(key, [e.id for e in entries]) for key, entries in groups.items()] == [('2017/08', ['a'])]
+    assert "Entry [b] is not listed by month" in caplog.text
+    groups = group_listing_entries(site, {'type': 'tag'})
+    assert [e.id for e in groups['x']] == ['a', 'b']
+
+def test_paginate_numbers_pages_from_oldest_entries():
+    entries = list(range(25, 0, -1))
+    pages = list(paginate(entries, 10))
+    assert pages[0] == (None, entries[:10], 2, None)
+    assert pages[1:] == [
+        (1, list(range(10, 0, -1)), None, 2),
+        (2, list(range(20, 10, -1)), 1, 3),
+        (3, list(range(25, 20, -1)), 2, 0),
+    ]
+    # a new entry only changes the newest numbered page and the front page
+    assert list(paginate([26] + entries, 10))[1:3] == pages[1:3]
+
+def test_paginate_keeps_few_entries_on_front_page():
+    assert list(paginate([3, 2, 1], 10)) == [(None, [3, 2, 1], None, None)]
+    assert list(paginate([], 10)) == [(None, [], None, None)]
+    pages = list(paginate(list(range(11, 0, -1)), 10))
+    assert pages[0] == (None, list(range(11, 1, -1)), 1, None)
+    assert pages[1:] == [(1, list(range(10, 0, -1)), None, 2), (2, [11], 1, 0)]
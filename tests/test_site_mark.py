@@ -0,0 +1,107 @@
+import os
+
+def build_and_plan(make_site, *arguments):
+    """ Build the site, return {entry id: 'compile' or 'link'} of the entries built """
+    site = make_site('--no-parallel', *arguments)
+    plans = {}
+    def record_plan(site):
+        for entry in site.entries.values():
+            if entry.dirty:
+                plans[entry.id] = 'link' if entry.relink else 'compile'
+    site.register_site('pre-build', record_plan)
+    site.build()
+    return site, plans
+
+def edit(path, old, new):
+    with open(path, 'rt', encoding='utf8') as f:
+        text = f.read()
+    assert old in text
+    with open(path, 'wt', encoding='utf8') as f:
+        f.write(text.replace(old, new, 1))
+
+def test_unchanged_entries_are_skipped(make_site):
+    site, plans = build_and_plan(make_site)
+    assert plans == {'hello': 'compile', 'code-test': 'compile', 'index': 'compile'}
+    site, plans = build_and_plan(make_site)
+    assert plans == {}
+
+def test_entry_with_changed_content_is_built(make_site, example_site_path):
+    build_and_plan(make_site)
+    edit(os.path.join(example_site_path, 'articles', 'hello', 'hello.md'), 'Hello SiteKicker\n\n', 'Hello again\n\n')
+    site, plans = build_and_plan(make_site)
+    assert plans == {'hello': 'compile'}
+
+def test_changed_title_rebuilds_pages_reading_entries(make_site, example_site_path):
+    build_and_plan(make_site)
+    edit(os.path.join(example_site_path, 'articles', 'hello', 'hello.md'), 'title: Hello SiteKicker', 'title: Hello')
+    site, plans = build_and_plan(make_site)
+    # index.j2 lists site.sorted_entries, post.j2 only reads site options
+    assert plans == {'hello': 'compile', 'index': 'compile'}
+    with open(site.entries['index'].output_file, 'rt', encoding='utf8') as f:
+        assert 'Hello SiteKicker' not in f.read()
+
+def test_changed_title_relinks_pages_reading_entries_in_watch_mode(make_site, example_site_path):
+    site, plans = build_and_plan(make_site)
+    relinked = []
+    site.register_site('pre-build', lambda site: relinked.extend(e.id for e in site.entries.values() if e.relink))
+    path = os.path.join(example_site_path, 'articles', 'hello', 'hello.md')
+    edit(path, 'title: Hello SiteKicker', 'title: Hello')
+    site.rebuild([path])
+    assert relinked == ['index']
+    assert sorted(plans) == ['code-test', 'hello', 'index']
+
+def test_entries_of_changed_template_are_built(make_site, example_site_path):
+    build_and_plan(make_site)
+    edit(os.path.join(example_site_path, 'templates', 'post.j2'), '{% block title %}', '{% block title %}<!-- post -->')
+    site, plans = build_and_plan(make_site)
+    assert plans == {'hello': 'compile', 'code-test': 'compile'}
+
+def test_entries_of_changed_included_template_are_built(make_site, example_site_path):
+    templates_path = os.path.join(example_site_path, 'templates')
+    with open(os.path.join(templates_path, 'post_tags.j2'), 'wt', encoding='utf8') as f:
+        f.write('<strong>Tags: </strong>\n')
+    edit(os.path.join(templates_path, 'post.j2'), '<strong>Tags: </strong>', '{% include "post_tags.j2" %}')
+    build_and_plan(make_site)
+    edit(os.path.join(templates_path, 'post_tags.j2'), 'Tags: ', 'Tagged: ')
+    site, plans = build_and_plan(make_site)
+    assert plans == {'hello': 'compile', 'code-test': 'compile'}
+    with open(site.entries['hello'].output_file, 'rt', encoding='utf8') as f:
+        assert 'Tagged: ' in f.read()
+
+def test_entries_of_changed_base_template_are_built(make_site, example_site_path):
+    templates_path = os.path.join(example_site_path, 'templates')
+    with open(os.path.join(templates_path, 'plain.j2'), 'wt', encoding='utf8') as f:
+        f.write('<html><body>{% block content %}{% endblock %}</body></html>\n')
+    edit(os.path.join(templates_path, 'index.j2'), '{% extends "default.j2" %}', '{% extends "plain.j2" %}')
+    build_and_plan(make_site)
+    edit(os.path.join(templates_path, 'default.j2'), '</head>', '<!-- default --></head>')
+    site, plans = build_and_plan(make_site)
+    # index.j2 does not extend default.j2 any more
+    assert plans == {'hello': 'compile', 'code-test': 'compile'}
+    edit(os.path.join(templates_path, 'plain.j2'), '<body>', '<body class="plain">')
+    site, plans = build_and_plan(make_site)
+    assert plans == {'index': 'compile'}
+    with open(site.entries['index'].output_file, 'rt', encoding='utf8') as f:
+        assert '<body class="plain">' in f.read()
+
+def test_entry_with_deleted_output_is_built(make_site):
+    site, plans = build_and_plan(make_site)
+    os.remove(site.entries['code-test'].output_file)
+    site, plans = build_and_plan(make_site)
+    assert plans == {'code-test': 'compile'}
+
+def test_changed_site_options_rebuild_all_entries(make_site, example_site_path):
+    build_and_plan(make_site)
+    with open(os.path.join(example_site_path, 'sitekicker.yml'), 'at', encoding='utf8') as f:
+        f.write('\nlisting_page_size: 5\n')
+    site, plans = build_and_plan(make_site)
+    assert sorted(plans) == ['code-test', 'hello', 'index']
+
+def test_templates_reading_entries_of_the_site():
+    import jinja2
+    from sitekicker.site_tasks import reads_site_entries
+    env = jinja2.Environment()
+    assert not reads_site_entries(env.parse("{{ site.user_options['name'] }} {{ entry.title }}"))
+    assert reads_site_entries(env.parse("{% for e in site.sorted_entries %}{{ e.title }}{% endfor %}"))
+    assert reads_site_entries(env.parse("{{ site['grouped_entries'] }}"))
+    assert reads_site_entries(env.parse("{{ render_menu(site) }}"))
@@ -0,0 +1,65 @@
+import os
+import gzip
+import shutil
+
+def enable_precompress(site_path):
+    with open(os.path.join(site_path, 'sitekicker.yml'), 'at', encoding='utf8') as f:
+        f.write('\nprecompress: true\n')
+
+def test_shipped_gz_files_are_kept(make_site, example_site_path):
+    enable_precompress(example_site_path)
+    css_path = os.path.join(example_site_path, 'assets', 'css')
+    with gzip.open(os.path.join(css_path, 'data.json.gz'), 'wb') as f:
+        f.write(b'{"shipped": true}')
+    with gzip.open(os.path.join(css_path, 'main.css.gz'), 'wb') as f:
+        f.write(b'shipped')
+    for i in range(2):
+        site = make_site('--no-parallel')
+        site.build()
+    output_css_path = os.path.join(site.output_path, 'assets', 'css')
+    with gzip.open(os.path.join(output_css_path, 'data.json.gz'), 'rb') as f:
+        assert f.read() == b'{"shipped": true}'
+    with gzip.open(os.path.join(output_css_path, 'main.css.gz'), 'rb') as f:
+        assert f.read() == b'shipped'
+    assert os.path.isfile(os.path.join(site.output_path, 'hello', 'index.html.gz'))
+
+def test_gz_of_removed_pages_are_removed(make_site, example_site_path):
+    enable_precompress(example_site_path)
+    site = make_site('--no-parallel')
+    site.build()
+    gz_path = os.path.join(site.output_path, 'hello', 'index.html.gz')
+    assert os.path.isfile(gz_path)
+    os.remove(os.path.join(site.output_path, 'hello', 'index.html'))
+    shutil.rmtree(os.path.join(example_site_path, 'articles', 'hello'))
+    site = make_site('--no-parallel')
+    site.build()
+    assert not os.path.isfile(gz_path)
+
+def test_only_files_changed_in_the_build_are_checked(make_site, example_site_path, monkeypatch):
+    import sitekicker.site_precompress
+    enable_precompress(example_site_path)
+    make_site('--no-parallel').build()
+    checked = []
+    gzip_file = sitekicker.site_precompress.gzip_file
+    def record_gzip_file(path):
+        checked.append(path)
+        return gzip_file(path)
+    monkeypatch.setattr(sitekicker.site_precompress, 'gzip_file', record_gzip_file)
+    site = make_site('--no-parallel')
+    site.build()
+    assert checked == []
+    with open(os.path.join(example_site_path, 'articles', 'hello', 'hello.md'), 'at', encoding='utf8') as f:
+        f.write('\nMore text\n')
+    site = make_site('--no-parallel')
+    site.build()
+    assert checked == [site.entries['hello'].output_file]
+    with gzip.open(site.entries['hello'].output_file + '.gz', 'rb') as f:
+        assert b'More text' in f.read()
+    # all output is checked again when extensions change
+    del checked[:]
+    with open(os.path.join(example_site_path, 'sitekicker.yml'), 'at', encoding='utf8') as f:
+        f.write('\nprecompress_extensions: [.html]\n')
+    site = make_site('--no-parallel')
+    site.build()
+    assert checked and all(path.endswith('.html') for path in checked)
+    assert not os.path.isfile(os.path.join(site.output_path, 'assets', 'css', 'main.css.gz'))
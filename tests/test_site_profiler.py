@@ -0,0 +1,27 @@
+import os
+import json
+
+from sitekicker.site_profiler import BuildProfiler, ProfiledPool
+
+def read_trace_categories(trace_path):
+    with open(trace_path, 'rt', encoding='utf8') as f:
+        return set(e.get('cat') for e in json.load(f)['traceEvents'])
+
+def test_every_build_gets_its_own_trace(make_site, example_site_path, tmp_path):
+    site = make_site('--no-parallel')
+    trace_path = str(tmp_path / 'trace.json')
+    BuildProfiler(site, trace_path).install()
+    pools = []
+    site.register_site('pre-build', lambda site: pools.append(site.task_pool))
+    site.build()
+    assert 'site:scan' in read_trace_categories(trace_path)
+    path = os.path.join(example_site_path, 'articles', 'hello', 'hello.md')
+    with open(path, 'at', encoding='utf8') as f:
+        f.write('\nOne more line.\n')
+    os.remove(trace_path)
+    site.rebuild([path])
+    categories = read_trace_categories(trace_path)
+    assert 'site:pre-build' in categories
+    assert 'site:scan' not in categories
+    assert len(pools) == 2
+    assert all(isinstance(pool, ProfiledPool) for pool in pools)
@@ -0,0 +1,62 @@
+import os
+import json
+
+import pytest
+
+from sitekicker.site_search import encode_postings, decode_postings, get_search_terms, get_shard_name, TITLE_WEIGHT, TAG_WEIGHT
+
+def test_postings_are_doc_id_gaps_and_frequencies():
+    postings = {7: 1, 3: 2, 12: 5}
+    assert encode_postings(postings) == [3, 2, 4, 1, 5, 5]
+    assert decode_postings(encode_postings(postings)) == postings
+    assert encode_postings({}) == []
+    assert decode_postings([]) == {}
+    assert decode_postings(encode_postings({0: 3})) == {0: 3}
+
+def test_search_terms_of_entry():
+    terms = get_search_terms('Hello World', ['python'], '<p class="intro">hello &amp; <b>bye</b> a</p>')
+    assert terms == {'hello': 1 + TITLE_WEIGHT, 'world': TITLE_WEIGHT, 'python': TAG_WEIGHT, 'bye': 1}
+
+def test_shard_names():
+    assert get_shard_name('hello') == 'he'
+    assert get_shard_name('x1') == 'x1'
+    assert get_shard_name('日本') == 'u' + '日本'.encode('utf8').hex()
+
+def read_search_index(site):
+    index_path = os.path.join(site.output_path, site.build_options['search_index_dir'])
+    with open(os.path.join(index_path, 'docs.json'), 'rt', encoding='utf8') as f:
+        docs = json.load(f)
+    shards = {}
+    for name in os.listdir(os.path.join(index_path, 'shards')):
+        with open(os.path.join(index_path, 'shards', name), 'rt', encoding='utf8') as f:
+            shards[name] = json.load(f)
+    return docs, shards
+
+def set_site_option(site_path, line):
+    with open(os.path.join(site_path, 'sitekicker.yml'), 'at', encoding='utf8') as f:
+        f.write('\n' + line + '\n')
+
+@pytest.mark.parametrize('arguments', [(), ('--no-parallel',)])
+def test_streaming_build_adds_terms_to_search_index_as_entries_are_built(make_site, example_site_path, arguments):
+    set_site_option(example_site_path, 'search_index: true')
+    site = make_site('--no-parallel')
+    site.build()
+    expected = read_search_index(site)
+    set_site_option(example_site_path, 'streaming_build: true')
+    site = make_site('--full-build', *arguments)
+    streamed = []
+    # after entries are built, before the shards are written
+    site.register_site('build', lambda site: streamed.extend(site.search_index.changed_paths))
+    site.build()
+    assert sorted(streamed) == sorted(entry.path for entry in site.entries.values() if entry.id and entry.date)
+    # built entries do not keep their terms
+    assert not any(hasattr(entry, 'search_terms') for entry in site.entries.values())
+    assert read_search_index(site) == expected
+    with open(os.path.join(example_site_path, 'articles', 'hello', 'hello.md'), 'at', encoding='utf8') as f:
+        f.write('\nZebra crossing\n')
+    site = make_site(*arguments)
+    site.build()
+    docs, shards = read_search_index(site)
+    assert docs == expected[0]
+    zebra = decode_postings(shards['ze.json']['zebra'])
+    assert [docs[doc_id][0] for doc_id in zebra] == [site.entries['hello'].link]
@@ -0,0 +1,48 @@
+import pytest
+
+from sitekicker.site_server import accepts_encoding, parse_range
+
+@pytest.mark.parametrize('header, accepted', [
+    ('gzip', True),
+    ('GZip', True),
+    ('deflate, gzip;q=1.0, br', True),
+    ('gzip;q=0.5', True),
+    ('gzip;q=0', False),
+    ('gzip; q=0.000', False),
+    ('gzip;q=x', False),
+    ('*', True),
+    ('*;q=0', False),
+    ('*;q=0, gzip', True),
+    ('gzip;q=0, *', False),
+    ('deflate, br', False),
+    ('', False),
+    ('identity', False),
+])
+def test_accepts_encoding(header, accepted):
+    assert accepts_encoding(header, 'gzip') == accepted
+
+@pytest.mark.parametrize('header, byte_range', [
+    (None, None),
+    ('', None),
+    ('bytes=0-9', (0, 9)),
+    (' bytes=10-19 ', (10, 19)),
+    ('bytes=90-', (90, 99)),
+    ('bytes=0-1000', (0, 99)),
+    ('bytes=-10', (90, 99)),
+    ('bytes=-1000', (0, 99)),
+    ('bytes=-', None),
+    ('bytes=0-1,5-6', None),
+    ('items=0-1', None),
+])
+def test_parse_range(header, byte_range):
+    assert parse_range(header, 100) == byte_range
+
+@pytest.mark.parametrize('header, size', [
+    ('bytes=100-', 100),
+    ('bytes=5-2', 100),
+    ('bytes=-0', 100),
+    ('bytes=0-', 0),
+])
+def test_parse_unsatisfiable_range(header, size):
+    with pytest.raises(ValueError):
+        parse_range(header, size)
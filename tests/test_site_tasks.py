@@ -0,0 +1,77 @@
+import os
+import logging
+
+import jinja2
+
+import sitekicker.site_tasks
+from sitekicker.site import get_task_pool_context
+
+def get_html_outputs(site):
+    return dict((eid, entry.html_output) for eid, entry in site.entries.items() if entry.id and entry.date)
+
+def test_task_pool_workers_are_not_forked():
+    assert get_task_pool_context().get_start_method() != 'fork'
+
+def test_parallel_build_matches_serial_build(make_site, monkeypatch):
+    states = []
+    write_worker_state = sitekicker.site_tasks.write_worker_state
+    def record_worker_state(site):
+        states.append(write_worker_state(site))
+        return states[-1]
+    monkeypatch.setattr(sitekicker.site_tasks, 'write_worker_state', record_worker_state)
+    site = make_site()
+    site.build()
+    assert len(states) == 1 and states[0] is not None
+    serial_site = make_site('--no-parallel', '--full-build')
+    serial_site.build()
+    assert get_html_outputs(site) == get_html_outputs(serial_site)
+
+def test_entries_are_built_in_this_process_when_site_could_not_be_pickled(make_site, caplog):
+    site = make_site()
+    site.register_entry('link', lambda entry: entry.options.update({'built_here': True}))
+    with caplog.at_level(logging.WARNING):
+        site.build()
+    assert 'could not be sent to workers' in caplog.text
+    assert all(entry.options.get('built_here') for entry in site.entries.values() if entry.id and entry.date)
+
+def test_fragments_rendered_by_workers_are_reused_by_listings(make_site, example_site_path):
+    template_path = os.path.join(example_site_path, 'templates', 'default.j2')
+    with open(template_path, 'rt', encoding='utf8') as f:
+        template = f.read()
+    with open(template_path, 'wt', encoding='utf8') as f:
+        f.write(template.replace('</body>', '{% cache "footer" %}<footer>{{ site.entries|length }}</footer>{% endcache %}</body>'))
+    site = make_site()
+    site.build()
+    fragment_cache = site.template_env.fragment_cache
+    assert fragment_cache.fragments['footer']['html'] == '<footer>3</footer>'
+    # listings are rendered in this process, with the fragment sent back by workers
+    assert 'footer' not in fragment_cache.rendered
+
+def test_compiled_templates_are_loaded_from_bytecode_cache(make_site, example_site_path, monkeypatch):
+    compiled = []
+    compile_template = jinja2.Environment.compile
+    def record_compile(env, source, name=None, filename=None, *args, **kwargs):
+        compiled.append(name)
+        return compile_template(env, source, name, filename, *args, **kwargs)
+    monkeypatch.setattr(jinja2.Environment, 'compile', record_compile)
+    site = make_site('--no-parallel')
+    site.build()
+    assert 'post.j2' in compiled and 'default.j2' in compiled
+    cache_path = os.path.join(site.output_path, '.jinjacache')
+    assert len(os.listdir(cache_path)) >= len(set(compiled))
+    # a new process starts with a new environment, templates come from the cache
+    del compiled[:]
+    make_site('--no-parallel').build()
+    assert compiled == []
+    # an edited template is compiled again, and stored in the cache for the next run
+    path = os.path.join(example_site_path, 'templates', 'post.j2')
+    with open(path, 'at', encoding='utf8') as f:
+        f.write('\n{# edited #}\n')
+    site = make_site('--no-parallel')
+    site.build()
+    assert compiled == ['post.j2']
+    with open(site.entries['hello'].output_file, 'rt', encoding='utf8') as f:
+        assert 'Post: ' in f.read()
+    del compiled[:]
+    make_site('--no-parallel').build()
+    assert compiled == []
@@ -0,0 +1,133 @@
+import os
+import time
+import threading
+
+import pytest
+
+from sitekicker.site_watcher import RebuildScheduler, BuildCancelled
+from sitekicker.site_listings import build_listings
+
+class FakeSite:
+    """ Records rebuilds, the first one runs until it is cancelled when block_first is set """
+    def __init__(self, block_first=False):
+        self.cancel_event = threading.Event()
+        self.block_first = block_first
+        self.started = threading.Event()
+        self.builds = []
+
+    def cancel_build(self):
+        self.cancel_event.set()
+
+    def rebuild(self, changed_paths):
+        self.builds.append(set(changed_paths))
+        self.started.set()
+        if self.block_first and len(self.builds) == 1:
+            if self.cancel_event.wait(5):
+                raise BuildCancelled('cancelled')
+
+def wait_for_builds(site, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while len(site.builds) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # no more builds should follow
+    time.sleep(0.2)
+
+def test_changes_are_merged_into_one_rebuild():
+    site = FakeSite()
+    scheduler = RebuildScheduler(site, delay=0.1)
+    scheduler.start()
+    try:
+        for path in ['/a', '/b', '/a', '/c']:
+            scheduler.add([path])
+        wait_for_builds(site, 1)
+    finally:
+        scheduler.stop()
+    assert site.builds == [{'/a', '/b', '/c'}]
+
+def test_running_rebuild_is_cancelled_and_started_again_with_all_changes():
+    site = FakeSite(block_first=True)
+    scheduler = RebuildScheduler(site, delay=0.05)
+    scheduler.start()
+    try:
+        scheduler.add(['/a'])
+        assert site.started.wait(5)
+        scheduler.add(['/b'])
+        wait_for_builds(site, 2)
+    finally:
+        scheduler.stop()
+    assert site.builds == [{'/a'}, {'/a', '/b'}]
+
+def test_cancelled_rebuild_does_not_keep_records_of_dropped_writes(make_site, example_site_path):
+    site = make_site('--no-parallel')
+    site.build()
+    path = os.path.join(example_site_path, 'articles', 'hello', 'hello.md')
+    with open(path, 'rt', encoding='utf8') as f:
+        text = f.read()
+    with open(path, 'wt', encoding='utf8') as f:
+        f.write(text.replace('title: Hello SiteKicker', 'title: Hello Again'))
+    # writes of the cancelled build are lost, it is cancelled right after listings are built
+    site.file_sync.write_file = lambda dest, content: False
+    post_build_hooks = site.site_hooks['post-build']
+    cancel = lambda site: site.cancel_build()
+    post_build_hooks.insert(post_build_hooks.index(build_listings) + 1, cancel)
+    with pytest.raises(BuildCancelled):
+        site.rebuild([path])
+    del site.file_sync.write_file
+    post_build_hooks.remove(cancel)
+    site.cancel_event.clear()
+    site.rebuild([path])
+    with open(os.path.join(site.output_path, 'tags', 'hello', 'index.html'), 'rt', encoding='utf8') as f:
+        assert 'Hello Again' in f.read()
+
+def rebuild_and_plan(site, changed_paths):
+    """ Rebuild after changed_paths, return {entry id: 'compile' or 'link'} of the entries built """
+    plans = {}
+    def record_plan(site):
+        for entry in site.entries.values():
+            if entry.dirty:
+                plans[entry.id] = 'link' if entry.relink else 'compile'
+    site.register_site('pre-build', record_plan)
+    try:
+        site.rebuild(changed_paths)
+    finally:
+        site.site_hooks['pre-build'].remove(record_plan)
+    return plans
+
+def append(path, text):
+    with open(path, 'at', encoding='utf8') as f:
+        f.write(text)
+
+def test_changed_paths_rebuild_their_entries(make_site, example_site_path):
+    site = make_site('--no-parallel')
+    site.build()
+    path = os.path.join(example_site_path, 'articles', 'hello', 'hello.md')
+    append(path, '\nMore text\n')
+    assert rebuild_and_plan(site, [path]) == {'hello': 'compile'}
+    path = os.path.join(example_site_path, 'templates', 'post.j2')
+    append(path, '\n{# edited #}\n')
+    assert rebuild_and_plan(site, [path]) == {'hello': 'link', 'code-test': 'link'}
+    path = os.path.join(example_site_path, 'assets', 'css', 'main.css')
+    append(path, '\n/* edited */\n')
+    assert rebuild_and_plan(site, [path]) == {}
+    with open(os.path.join(site.output_path, 'assets', 'css', 'main.css'), 'rt', encoding='utf8') as f:
+        assert '/* edited */' in f.read()
+    # changes of build output are not changes of the site
+    assert rebuild_and_plan(site, [site.entries['hello'].output_file]) == {}
+
+def test_rebuild_publishes_changed_urls(make_site, example_site_path):
+    from types import SimpleNamespace
+    from sitekicker.site_server import FileCache, LiveReload
+    site = make_site('--no-parallel')
+    site.build()
+    site.server = SimpleNamespace(file_cache=FileCache(), live_reload=LiveReload())
+    events = site.server.live_reload.subscribe()
+    path = os.path.join(example_site_path, 'articles', 'hello', 'hello.md')
+    append(path, '\nMore text\n')
+    site.rebuild([path])
+    urls = events.get_nowait()
+    assert urls[0] == site.entries['hello'].link
+    assert all(url.startswith(site.entries['hello'].link) for url in urls)
+    assert events.empty()
+    # nothing changed, nothing is published
+    site.rebuild([path])
+    assert events.empty()